@@ -0,0 +1,164 @@
+# bench/aur.py
+# vim:ts=4:sw=4:noexpandtab
+#
+# Compares the pooled AUR requests with the old one-thread-and-connection-per-chunk
+# approach against a local stand-in for the AUR. The server delays the first
+# request of every connection to simulate the TLS handshake and every request
+# to simulate the round trip. Like the real AUR it rate-limits clients: requests
+# on connections beyond the concurrency limit are answered with 429. streamed
+# uses Aur.stream and also reports the time until the first record arrived.
+#
+#   python bench/aur.py [number of packages] [handshake ms] [latency ms] [limit]
+
+import sys
+
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from json import dumps, loads
+from os.path import dirname, join
+from shutil import rmtree
+from socketserver import ThreadingMixIn
+from tempfile import mkdtemp
+from threading import Lock, Thread
+from time import perf_counter, sleep
+from urllib.parse import parse_qs, urlencode, urlsplit
+from urllib.error import HTTPError
+from urllib.request import urlopen
+
+sys.path.insert(0, dirname(dirname(__file__)) or '..')
+
+from localrepo.aur import Aur, AurRequest
+from localrepo.config import Config
+
+class Server(ThreadingMixIn, HTTPServer):
+	''' A local stand-in for the AUR RPC interface '''
+
+	daemon_threads = True
+	request_queue_size = 256
+
+	def __init__(self, handshake, latency, limit):
+		super().__init__(('127.0.0.1', 0), Handler)
+		self.handshake, self.latency, self.limit = handshake, latency, limit
+		self.lock = Lock()
+		self.reset()
+
+	def reset(self):
+		self.connections, self.open, self.max_open, self.limited = 0, 0, 0, 0
+
+
+class Handler(BaseHTTPRequestHandler):
+
+	protocol_version = 'HTTP/1.1'
+	disable_nagle_algorithm = True
+
+	def log_message(self, *args):
+		pass
+
+	def setup(self):
+		super().setup()
+
+		with self.server.lock:
+			self.server.connections += 1
+			self.server.open += 1
+			self.server.max_open = max(self.server.max_open, self.server.open)
+			self.limited = self.server.open > self.server.limit
+
+		sleep(self.server.handshake)
+
+	def finish(self):
+		super().finish()
+
+		with self.server.lock:
+			self.server.open -= 1
+
+	def do_GET(self):
+		sleep(self.server.latency)
+
+		if self.limited:
+			with self.server.lock:
+				self.server.limited += 1
+
+			self.send_response(429)
+			self.send_header('Retry-After', '1')
+			self.send_header('Content-Length', '0')
+			self.send_header('Connection', 'close')
+			self.end_headers()
+			self.close_connection = True
+			return
+
+		names = parse_qs(urlsplit(self.path).query).get('arg[]', [])
+		results = [{'Name': n, 'Version': '1.0-1', 'URLPath': '/packages/{0}.tar.gz'.format(n)} for n in names]
+		body = dumps({'type': 'multiinfo', 'results': results}).encode('utf8')
+		self.send_response(200)
+		self.send_header('Content-Length', str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+
+
+def legacy(names):
+	''' The old implementation: one thread and one fresh connection per chunk '''
+	results = {}
+
+	def request(chunk):
+		query = urlencode([('type', 'multiinfo')] + [('arg[]', n) for n in chunk])
+
+		try:
+			with urlopen(AurRequest.HOST + AurRequest.API + '?' + query) as res:
+				for r in loads(res.read().decode('utf8'))['results']:
+					results[r['Name']] = AurRequest.decode_result(r)
+		except HTTPError:
+			pass
+
+	threads = [Thread(target=request, args=(names[i:i + AurRequest.MAX],))
+	           for i in range(0, len(names), AurRequest.MAX)]
+
+	for t in threads:
+		t.start()
+
+	for t in threads:
+		t.join()
+
+	return results
+
+def pooled(names):
+	''' The blocking API '''
+	results, errors = Aur.packages(names)
+	return results
+
+def streamed(names):
+	''' The streaming API, reports the time until the first record arrived '''
+	start, results = perf_counter(), {}
+
+	for info in Aur.stream(names, []):
+		if not results:
+			print('{0:12} {1:8.3f}s until the first record'.format('', perf_counter() - start))
+
+		results[info['name']] = info
+
+	return results
+
+if __name__ == '__main__':
+	n = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+	handshake = float(sys.argv[2]) / 1000 if len(sys.argv) > 2 else 0.1
+	latency = float(sys.argv[3]) / 1000 if len(sys.argv) > 3 else 0.05
+	limit = int(sys.argv[4]) if len(sys.argv) > 4 else 8
+
+	server = Server(handshake, latency, limit)
+	Thread(target=server.serve_forever, daemon=True).start()
+	AurRequest.HOST = 'http://127.0.0.1:{0}'.format(server.server_address[1])
+	names = ['package-{0}'.format(i) for i in range(n)]
+	cache = mkdtemp(prefix='local-repo-bench-')
+	Config._parser.read_dict({Config.ALL: {'aur-cache': join(cache, 'aur.json'), 'aur-cache-ttl': '0'}})
+
+	print('{0} packages, {1:.0f}ms handshake, {2:.0f}ms latency, limit {3}'.format(n, handshake * 1000, latency * 1000, limit))
+
+	for kind, func in (('legacy', legacy), ('pooled', pooled), ('pooled-warm', pooled), ('streamed', streamed)):
+		server.reset()
+		start = perf_counter()
+		results = func(names)
+		elapsed = perf_counter() - start
+		print('{0:12} {1:8.3f}s {2:5} connections {3:5} max concurrent {4:5} rate-limited {5:6} of {6} found'.format(
+		      kind, elapsed, server.connections, server.max_open, server.limited, len(results), n))
+
+	AurRequest.pool().close()
+	server.shutdown()
+	rmtree(cache)
@@ -0,0 +1,86 @@
+# bench/cache.py
+# vim:ts=4:sw=4:noexpandtab
+#
+# Compares the memory mapped cache with the old pickle cache. Every run
+# loads the cache in a fresh process and lists all packages like -l does.
+# mmap-all creates all (lazy) package objects instead of reading the records.
+#
+#   python bench/cache.py [number of packages]
+
+import sys
+
+from os.path import dirname, join
+from pickle import dump as pickle, load as unpickle
+from shutil import rmtree
+from subprocess import check_output
+from tempfile import mkdtemp
+from time import perf_counter
+
+sys.path.insert(0, dirname(dirname(__file__)) or '..')
+
+from localrepo.cache import Cache
+from localrepo.package import Package
+
+def make_packages(n):
+	''' Creates n packages with realistic info dicts '''
+	packages = {}
+
+	for i in range(n):
+		name = 'package-{0}'.format(i)
+		info = {'desc': 'A package with a description of typical length, number {0}'.format(i),
+		        'csize': 123456 + i, 'isize': 654321 + i, 'md5sum': '{0:032x}'.format(i),
+		        'sha256sum': '{0:064x}'.format(i), 'url': 'http://example.com/' + name,
+		        'license': 'GPL', 'arch': 'x86_64', 'builddate': '1332727351',
+		        'packager': 'Somebody <somebody@example.com>', 'pgpsig': False}
+		packages[name] = Package(name, '1.0-1', '/repo/{0}-1.0-1-x86_64.pkg.tar.xz'.format(name), info)
+
+	return packages
+
+def child(kind, path):
+	''' Loads a cache, lists all packages and prints time and peak RSS '''
+	start = perf_counter()
+
+	if kind == 'pickle':
+		with open(path, 'rb') as f:
+			packages = unpickle(f)
+
+		lines = ['{0} {1}'.format(name, packages[name].version) for name in sorted(packages)]
+	elif kind == 'mmap':
+		packages = Cache(path, '/repo')
+		lines = ['{0} {1}'.format(name, version) for name, version in packages.field('version')]
+	else:
+		packages = Cache(path, '/repo')
+		loaded = list(packages.values())
+		lines = ['{0} {1}'.format(pkg.name, pkg.version) for pkg in loaded]
+
+	lookup = packages['package-1'].info['sha256sum']
+	elapsed = perf_counter() - start
+
+	with open('/proc/self/status') as f:
+		rss = next(l.split()[1] for l in f if l.startswith('VmHWM:'))
+
+	print(elapsed, rss)
+
+if __name__ == '__main__':
+	if len(sys.argv) == 4 and sys.argv[1] == 'child':
+		child(sys.argv[2], sys.argv[3])
+		exit(0)
+
+	n = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+	path = mkdtemp(prefix='local-repo-bench-')
+
+	try:
+		packages = make_packages(n)
+
+		with open(join(path, 'pickle'), 'wb') as f:
+			pickle(packages, f)
+
+		Cache.write(join(path, 'mmap'), packages)
+		print('{0} packages'.format(n))
+
+		for kind, filename in (('pickle', 'pickle'), ('mmap', 'mmap'), ('mmap-all', 'mmap')):
+			out = check_output([sys.executable, '-W', 'ignore', __file__, 'child', kind, join(path, filename)])
+			elapsed, rss = out.decode('utf8').split()
+			print('{0:10} {1:8.3f}s {2:>10} KiB max RSS'.format(kind, float(elapsed), rss))
+	finally:
+		rmtree(path)
@@ -0,0 +1,77 @@
+# bench/db.py
+# vim:ts=4:sw=4:noexpandtab
+#
+# Compares the native database writer with repo-add.
+#
+#   python bench/db.py [number of packages]
+
+import sys
+
+from io import BytesIO
+from os import access, remove, X_OK
+from os.path import dirname, isfile, join
+from shutil import rmtree
+from tarfile import TarInfo, open as open_tarfile
+from tempfile import mkdtemp
+from time import perf_counter
+
+sys.path.insert(0, dirname(dirname(__file__)) or '..')
+
+from localrepo.config import Config
+from localrepo.package import Package
+from localrepo.pacman import Pacman
+from localrepo.repo import Database
+
+PKGINFO = '''pkgname = {0}
+pkgver = 1.0-1
+pkgdesc = Benchmark package {0}
+url = http://example.com/{0}
+builddate = 1332727351
+packager = Bench <bench@example.com>
+size = 1024
+arch = any
+license = GPL
+depend = glibc
+'''
+
+def make_package(path, name):
+	''' Writes a minimal package file '''
+	data = PKGINFO.format(name).encode('utf8')
+	info = TarInfo('.PKGINFO')
+	info.size = len(data)
+	path = join(path, '{0}-1.0-1-any.pkg.tar.gz'.format(name))
+
+	with open_tarfile(path, 'w:gz') as pkg:
+		pkg.addfile(info, BytesIO(data))
+
+	return Package.from_file(path)
+
+def bench(name, db, fn):
+	''' Runs fn on an empty database and prints the elapsed time '''
+	if isfile(db):
+		remove(db)
+
+	start = perf_counter()
+	fn()
+	print('{0:30} {1:8.3f}s'.format(name, perf_counter() - start))
+
+if __name__ == '__main__':
+	n = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+	path = mkdtemp(prefix='local-repo-bench-')
+	db = join(path, 'bench.db.tar.gz')
+	Config.init('bench')
+
+	try:
+		pkgs = [make_package(path, 'pkg{0}'.format(i)) for i in range(n)]
+		print('{0} packages'.format(n))
+
+		bench('native, one rewrite', db, lambda: Database(db).update(pkgs))
+		bench('native, rewrite per package', db, lambda: [Database(db).update([p]) for p in pkgs])
+
+		if access(Pacman.REPO_ADD, X_OK):
+			bench('repo-add, one call', db, lambda: Pacman.repo_add(db, [p.path for p in pkgs]))
+			bench('repo-add, call per package', db, lambda: [Pacman.repo_add(db, [p.path]) for p in pkgs])
+		else:
+			print('{0} not found, skipping repo-add'.format(Pacman.REPO_ADD))
+	finally:
+		rmtree(path)
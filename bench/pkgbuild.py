@@ -0,0 +1,76 @@
+# bench/pkgbuild.py
+# vim:ts=4:sw=4:noexpandtab
+#
+# Parses a set of generated PKGBUILDs like a rebuild of stored PKGBUILDs does.
+# single spawns bash for every PKGBUILD, batch evaluates all of them in one
+# bash process and memo parses them again with a warm memo.
+#
+#   python bench/pkgbuild.py [number of PKGBUILDs]
+
+import sys
+
+from os.path import dirname, join
+from shutil import rmtree
+from tempfile import mkdtemp
+from time import perf_counter
+
+sys.path.insert(0, dirname(dirname(__file__)) or '..')
+
+import localrepo
+from localrepo.config import Config
+from localrepo.parser import PkgbuildParser
+
+PKGBUILD = '''pkgname=pkg{0}
+pkgver=1.{0}
+pkgrel=1
+arch=('any')
+depends=('glibc' 'pkg{1}')
+makedepends=('gcc')
+'''
+
+def single(paths):
+	''' Spawns bash for every PKGBUILD '''
+	for path in paths:
+		PkgbuildParser._memo = {}
+		PkgbuildParser(path).parse()
+
+def batch(paths):
+	''' Evaluates all PKGBUILDs in one bash process '''
+	PkgbuildParser._memo = {}
+	PkgbuildParser.parse_all(paths)
+
+def memo(paths):
+	''' Parses the memorized PKGBUILDs again '''
+	for path in paths:
+		PkgbuildParser(path).parse()
+
+def run(name, func, *args):
+	''' Runs func and prints the time '''
+	start = perf_counter()
+	func(*args)
+	print('{0:10} {1:8.3f}s'.format(name, perf_counter() - start))
+
+if __name__ == '__main__':
+	n = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+	tmpdir = mkdtemp(prefix='local-repo-bench-')
+	PkgbuildParser.MAKEPKG_CONF = join(tmpdir, 'makepkg.conf')
+	Config._parser.read_dict({Config.ALL: {'pkgbuild-cache': join(tmpdir, 'pkgbuild.json')}})
+	paths = []
+
+	with open(PkgbuildParser.MAKEPKG_CONF, 'w') as f:
+		f.write('CARCH=x86_64\n')
+
+	for i in range(n):
+		paths.append(join(tmpdir, 'PKGBUILD-{0}'.format(i)))
+
+		with open(paths[-1], 'w') as f:
+			f.write(PKGBUILD.format(i, i + 1))
+
+	print('{0} PKGBUILDs'.format(n))
+
+	try:
+		run('single', single, paths)
+		run('batch', batch, paths)
+		run('memo', memo, paths)
+	finally:
+		rmtree(tmpdir)
@@ -0,0 +1,51 @@
+# bench/search.py
+# vim:ts=4:sw=4:noexpandtab
+#
+# Runs searches against a memory mapped cache like -s does. linear is the old
+# 'q in name' scan over all names, the others use the search index of the
+# cache. Every query runs 100 times, the time is per query.
+#
+#   python bench/search.py [number of packages]
+
+import sys
+
+from os.path import dirname, join
+from shutil import rmtree
+from tempfile import mkdtemp
+from time import perf_counter
+
+sys.path.insert(0, dirname(dirname(__file__)) or '..')
+
+import localrepo
+from localrepo.cache import Cache
+from localrepo.search import Query
+
+from cache import make_packages
+
+def linear(cache, q):
+	''' The old implementation '''
+	return [(name, version) for name, version in cache.field('version') if q in name]
+
+def run(name, func, *args):
+	''' Runs func 100 times and prints the time per run '''
+	start = perf_counter()
+
+	for i in range(100):
+		res = func(*args)
+
+	print('{0:24} {1:8.3f}ms {2:6} results'.format(name, (perf_counter() - start) * 10, len(res)))
+
+if __name__ == '__main__':
+	n = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+	path = mkdtemp(prefix='local-repo-bench-')
+
+	try:
+		Cache.write(join(path, 'cache'), make_packages(n))
+		cache = Cache(join(path, 'cache'), '/repo')
+		print('{0} packages'.format(n))
+		run('linear package-12', linear, cache, 'package-12')
+
+		for q in ('package-12*', 'desc:number', 'desc:12', 'desc:12*', 'license:gpl desc:12', '/^package-12$/'):
+			run(q, Query(q).run, cache)
+	finally:
+		rmtree(path)
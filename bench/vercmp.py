@@ -0,0 +1,72 @@
+# bench/vercmp.py
+# vim:ts=4:sw=4:noexpandtab
+#
+# Compares the old LooseVersion based check with vercmp like aur_upgrade does
+# it: every local version is compared with its AUR version. cold clears the
+# key cache first, warm runs the same comparisons again. sort sorts all
+# versions with the Version class.
+#
+#   python bench/vercmp.py [number of packages]
+
+import sys
+
+from os.path import dirname
+from random import choice, randint, seed
+from time import perf_counter
+
+sys.path.insert(0, dirname(dirname(__file__)) or '..')
+
+from localrepo.vercmp import Version, key, vercmp
+
+def make_version():
+	''' Creates a random but realistic looking version '''
+	kind = randint(0, 9)
+
+	if kind == 0:
+		version = 'r{0}.{1:07x}'.format(randint(1, 5000), randint(0, 0xfffffff))
+	elif kind == 1:
+		version = '{0}.{1}{2}'.format(randint(0, 9), randint(0, 20), choice(('alpha', 'beta', 'rc1', 'b')))
+	else:
+		version = '.'.join(str(randint(0, 30)) for i in range(randint(1, 4)))
+
+	epoch = '{0}:'.format(randint(1, 3)) if randint(0, 19) == 0 else ''
+	return '{0}{1}-{2}'.format(epoch, version, randint(1, 5))
+
+def loose(pairs):
+	''' The old implementation '''
+	from distutils.version import LooseVersion
+	result = 0
+
+	for a, b in pairs:
+		try:
+			result += LooseVersion(a) < LooseVersion(b)
+		except:
+			result += a < b
+
+	return result
+
+def new(pairs):
+	''' The vercmp implementation '''
+	return sum(vercmp(a, b) < 0 for a, b in pairs)
+
+def run(name, func, *args):
+	''' Runs func and prints the time '''
+	start = perf_counter()
+	func(*args)
+	print('{0:10} {1:8.3f}s'.format(name, perf_counter() - start))
+
+if __name__ == '__main__':
+	n = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+	seed(0)
+	pairs = [(make_version(), make_version()) for i in range(n)]
+	print('{0} comparisons'.format(n))
+
+	try:
+		run('loose', loose, pairs)
+	except ImportError:
+		print('{0:10} distutils is not available'.format('loose'))
+
+	key.cache_clear()
+	run('cold', new, pairs)
+	run('warm', new, pairs)
+	run('sort', sorted, [Version(v) for pair in pairs for v in pair])
@@ -6,7 +6,8 @@ import builtins
 from os.path import dirname, exists, join
 from gettext import bindtextdomain, textdomain, gettext
 
-__all__ = ['aur', 'config', 'log', 'package', 'pacman', 'parser', 'repo', 'utils']
+__all__ = ['aur', 'build', 'cache', 'config', 'download', 'log', 'metrics', 'output', 'package', 'pacman',
+           'parser', 'plan', 'repo', 'search', 'utils', 'vercmp']
 
 locale = join(dirname(dirname(__file__)), 'share', 'locale')
 
@@ -1,12 +1,24 @@
 # aur.py
 # vim:ts=4:sw=4:noexpandtab
 
+from http.client import HTTPConnection, HTTPException, HTTPSConnection
+from urllib.parse import quote, urlencode, urlsplit
 from urllib.request import urlopen
-from urllib.parse import urlencode
-from json import loads as parse
-from threading import Thread
-
-from localrepo.utils import LocalRepoError
+from gzip import open as gzip_open
+from shutil import copyfileobj
+from sqlite3 import connect
+from json import dump, load, loads as parse
+from queue import Empty, LifoQueue
+from os import makedirs, remove
+from os.path import dirname, expanduser, isdir, isfile, join
+from tempfile import mkstemp
+from time import sleep, time
+from concurrent.futures import ThreadPoolExecutor
+from asyncio import as_completed, get_running_loop, new_event_loop
+
+from localrepo.utils import LocalRepoError, Utils
+from localrepo.config import Config
+from localrepo.metrics import Metrics
 
 class AurError(LocalRepoError):
 	''' Handles AUR errors '''
@@ -18,7 +30,66 @@ class AurRequestError(AurError):
 	pass
 
 
-class AurRequest(Thread):
+class AurTemporaryError(AurRequestError):
+	''' Handles AUR request errors, which are worth a retry '''
+	pass
+
+
+class AurConnectionPool:
+	''' A pool of persistent HTTP connections to a single host '''
+
+	#: Timeout in seconds
+	TIMEOUT = 30
+
+	def __init__(self, host):
+		''' Sets the host, like 'https://aur.archlinux.org' '''
+		url = urlsplit(host)
+		self._host = host
+		self._netloc = url.netloc
+		self._class = HTTPSConnection if url.scheme == 'https' else HTTPConnection
+		self._idle = LifoQueue()
+
+	@property
+	def host(self):
+		''' Returns the host '''
+		return self._host
+
+	def _get(self):
+		''' Returns an idle connection or a new one '''
+		try:
+			return self._idle.get_nowait()
+		except Empty:
+			return self._class(self._netloc, timeout=AurConnectionPool.TIMEOUT)
+
+	def request(self, path):
+		''' Sends a GET request and returns (status, reason, headers, body) '''
+		conn = self._get()
+
+		try:
+			conn.request('GET', path)
+			res = conn.getresponse()
+			body = res.read()
+		except:
+			conn.close()
+			raise
+
+		if res.will_close:
+			conn.close()
+		else:
+			self._idle.put(conn)
+
+		return res.status, res.reason, res.headers, body
+
+	def close(self):
+		''' Closes all idle connections '''
+		while True:
+			try:
+				self._idle.get_nowait().close()
+			except Empty:
+				return
+
+
+class AurRequest:
 	''' Handles parallel AUR requests '''
 
 	#: Uri of the AUR
@@ -30,30 +101,72 @@ class AurRequest(Thread):
 	#: Max number of packages per request
 	MAX = 50
 
+	#: Default max number of concurrent requests
+	JOBS = 4
+
+	#: Default number of retries of a failed request
+	RETRIES = 3
+
+	#: Seconds to wait before the first retry, doubled for every further retry
+	BACKOFF = 0.5
+
 	#: Translations from AUR to localrepo
 	TRANS = {'Name': 'name',
 	         'Version': 'version',
 	         'URLPath': lambda p: ('uri', AurRequest.HOST + p)}
 
+	#: The shared connection pool
+	_pool = None
+
 	@staticmethod
 	def decode_result(res):
 		''' Turns an AUR info dict into a localrepo style package info  dict '''
 		return dict(t(res[k]) if callable(t) else (t, res[k]) for k, t in AurRequest.TRANS.items())
 
 	@staticmethod
-	def forge(request, data):
-		''' Splits a request in to smaller ones - if needed - and sends them to the AUR '''
-		requests = []
+	def pool():
+		''' Returns the shared connection pool '''
+		if AurRequest._pool is None or AurRequest._pool.host != AurRequest.HOST:
+			AurRequest._pool = AurConnectionPool(AurRequest.HOST)
+
+		return AurRequest._pool
+
+	@staticmethod
+	def send(request, data):
+		''' Splits a request in to smaller ones - if needed - sends them to the AUR
+		using at most 'aur-jobs' concurrent connections and returns the finished requests '''
+		requests = [AurRequest(request, data[i:i + AurRequest.MAX]) for i in range(0, len(data), AurRequest.MAX)]
+		jobs = max(Config.get('aur-jobs', AurRequest.JOBS), 1)
+
+		with ThreadPoolExecutor(max_workers=jobs) as executor:
+			for r in requests:
+				executor.submit(r.run)
+
+		return requests
+
+	@staticmethod
+	async def stream(request, data):
+		''' Like send, but yields every request as soon as it is finished '''
+		requests = [AurRequest(request, data[i:i + AurRequest.MAX]) for i in range(0, len(data), AurRequest.MAX)]
+		executor = ThreadPoolExecutor(max_workers=max(Config.get('aur-jobs', AurRequest.JOBS), 1))
+		loop = get_running_loop()
+		futures = [loop.run_in_executor(executor, r.run) for r in requests]
 
-		for i in range(0, len(data), AurRequest.MAX):
-			r = AurRequest(request, data[i:i + AurRequest.MAX])
-			requests.append(r)
-			r.start()
+		try:
+			for future in as_completed(futures):
+				yield await future
+		finally:
+			for future in futures:
+				future.cancel()
+
+			executor.shutdown(wait=False)
 
+	@staticmethod
+	def forge(request, data):
+		''' Sends a request and merges the results and errors of all chunks '''
 		results, errors = {}, []
 
-		for r in requests:
-			r.join()
+		for r in AurRequest.send(request, data):
 			results.update(r.results)
 
 			if r.error is not None:
@@ -63,12 +176,16 @@ class AurRequest(Thread):
 
 	def __init__(self, request, data):
 		''' Sets the request type and the data '''
-		super().__init__()
 		self._request = request
 		self._data = data
 		self._results = {}
 		self._error = None
 
+	@property
+	def data(self):
+		''' Returns the data '''
+		return self._data
+
 	@property
 	def results(self):
 		''' Returns the results '''
@@ -80,17 +197,28 @@ class AurRequest(Thread):
 		return self._error
 
 	def run(self):
-		''' Thread entry point'''
-		try:
-			self._send()
-		except AurRequestError as e:
-			self._error = e
-
-	def _send(self):
-		''' Performs the AUR API request '''
-		if len(self._data) is 0:
-			return
-
+		''' Sends the request, retries temporary failures with exponential backoff
+		and returns the request itself '''
+		retries = Config.get('aur-retries', AurRequest.RETRIES)
+
+		for attempt in range(retries + 1):
+			try:
+				self._send()
+				break
+			except AurTemporaryError as e:
+				self._error = e
+				delay = e.delay if getattr(e, 'delay', None) else AurRequest.BACKOFF * 2 ** attempt
+
+				if attempt < retries:
+					sleep(delay)
+			except AurRequestError as e:
+				self._error = e
+				break
+
+		return self
+
+	def _query(self):
+		''' Returns the query path of the request '''
 		query = [('type', self._request)]
 
 		if self._request in ('info', 'search'):
@@ -98,16 +226,31 @@ class AurRequest(Thread):
 		else:
 			query += [('arg[]', d) for d in self._data]
 
+		return AurRequest.API + '?' + urlencode(query)
+
+	def _send(self):
+		''' Performs the AUR API request '''
+		self._error = None
+
+		if len(self._data) == 0:
+			return
+
 		try:
-			res = urlopen(AurRequest.HOST + AurRequest.API + '?' + urlencode(query))
-		except:
-			raise AurRequestError(_('Could not reach the AUR'))
+			status, reason, headers, body = AurRequest.pool().request(self._query())
+		except (OSError, HTTPException):
+			raise AurTemporaryError(_('Could not reach the AUR'))
 
-		if res.status is not 200:
-			raise AurRequestError(_('AUR responded with error: {0}').format(res.reason))
+		if status == 429 or status >= 500:
+			e = AurTemporaryError(_('AUR responded with error: {0}').format(reason))
+			retry = headers.get('Retry-After', '')
+			e.delay = int(retry) if retry.isdigit() else None
+			raise e
+
+		if status != 200:
+			raise AurRequestError(_('AUR responded with error: {0}').format(reason))
 
 		try:
-			info = parse(res.read().decode('utf8'))
+			info = parse(body.decode('utf8'))
 			error = info['type'] == 'error'
 			results = info['results']
 		except:
@@ -125,20 +268,279 @@ class AurRequest(Thread):
 			raise AurRequestError(_('AUR responded with invalid data'))
 
 
+class AurCache:
+	''' A persistent cache of AUR package infos, shared by all repos. Every entry
+	holds the time of the request and the info, or None if the AUR does not know
+	the package. '''
+
+	#: Default path to the cache file
+	PATH = expanduser(join('~', '.cache', 'local-repo', 'aur.json'))
+
+	#: Default time to live of an entry in seconds
+	TTL = 3600
+
+	def __init__(self, path=None):
+		''' Sets the path and loads the cache file, a broken file is just ignored '''
+		self._path = expanduser(path or Config.get('aur-cache', AurCache.PATH))
+		self._entries = {}
+
+		try:
+			with open(self._path, encoding='utf8') as f:
+				self._entries = load(f)
+		except:
+			pass
+
+	@property
+	def path(self):
+		''' Returns the path to the cache file '''
+		return self._path
+
+	def get(self, name, ttl=None):
+		''' Returns (True, info) if there is an entry younger than ttl seconds and
+		(False, None) otherwise. If ttl is None, every entry is good enough. '''
+		try:
+			timestamp, info = self._entries[name]
+		except (KeyError, TypeError, ValueError):
+			return False, None
+
+		if ttl is not None and time() - timestamp >= ttl:
+			return False, None
+
+		return True, info
+
+	def set(self, name, info):
+		''' Stores the info of a package '''
+		self._entries[name] = [time(), info]
+
+	def save(self):
+		''' Writes the cache atomically into the cache file '''
+		try:
+			if not isdir(dirname(self._path)):
+				makedirs(dirname(self._path), mode=0o755, exist_ok=True)
+
+			with Utils.atomic_write(self._path) as tmp, open(tmp, 'w', encoding='utf8') as f:
+				dump(self._entries, f, separators=(',', ':'))
+		except:
+			raise AurError(_('Could not write AUR cache: {0}').format(self._path))
+
+
+class AurSnapshot:
+	''' A local copy of the AUR package metadata dump in an indexed sqlite
+	database, which answers package lookups and searches offline '''
+
+	#: Default path to the snapshot database
+	PATH = expanduser(join('~', '.cache', 'local-repo', 'aur.sqlite'))
+
+	#: Path of the metadata dump on the AUR
+	DUMP = '/packages-meta-v1.json.gz'
+
+	#: Max number of names per query
+	MAX = 500
+
+	#: Columns and the AUR fields they are filled with
+	COLUMNS = (('name', 'Name'), ('version', 'Version'), ('urlpath', 'URLPath'), ('desc', 'Description'))
+
+	@staticmethod
+	def path():
+		''' Returns the path to the snapshot database or None if snapshots are disabled '''
+		path = Config.get('aur-snapshot', None)
+		return expanduser(path) if path else None
+
+	@staticmethod
+	def open():
+		''' Returns the snapshot or None if there is no snapshot '''
+		path = AurSnapshot.path()
+		return AurSnapshot(path) if path and isfile(path) else None
+
+	@staticmethod
+	def build(path, dump):
+		''' Builds the snapshot database from a - maybe gzipped - metadata dump file
+		and replaces the old one atomically. Returns the number of packages. '''
+		try:
+			if not isdir(dirname(path)):
+				makedirs(dirname(path), mode=0o755, exist_ok=True)
+		except:
+			raise AurError(_('Could not write AUR snapshot: {0}').format(path))
+
+		try:
+			with open(dump, 'rb') as f:
+				gzipped = f.read(2) == b'\x1f\x8b'
+
+			with (gzip_open if gzipped else open)(dump, 'rt', encoding='utf8') as f:
+				pkgs = load(f)
+
+			rows = [tuple(pkg[field] for column, field in AurSnapshot.COLUMNS) for pkg in pkgs]
+
+			with Utils.atomic_write(path) as tmp:
+				db = connect(tmp)
+
+				try:
+					db.execute('CREATE TABLE packages (name TEXT PRIMARY KEY, version TEXT, urlpath TEXT, desc TEXT)')
+					db.executemany('INSERT OR REPLACE INTO packages VALUES (?, ?, ?, ?)', rows)
+					db.commit()
+				finally:
+					db.close()
+		except:
+			raise AurError(_('Could not build AUR snapshot: {0}').format(dump))
+
+		return len(rows)
+
+	@staticmethod
+	def update():
+		''' Downloads the metadata dump, 'aur-snapshot-url' or the AUR's, and rebuilds
+		the snapshot database. Returns the number of packages. '''
+		path = AurSnapshot.path() or AurSnapshot.PATH
+		url = Config.get('aur-snapshot-url', AurRequest.HOST + AurSnapshot.DUMP)
+		fd, tmp = mkstemp(prefix='local-repo-aur-')
+
+		try:
+			try:
+				with open(fd, 'wb') as f, urlopen(url, timeout=AurConnectionPool.TIMEOUT) as res:
+					copyfileobj(res, f)
+			except:
+				raise AurError(_('Could not download AUR snapshot: {0}').format(url))
+
+			return AurSnapshot.build(path, tmp)
+		finally:
+			remove(tmp)
+
+	def __init__(self, path):
+		''' Opens the snapshot database '''
+		try:
+			self._db = connect('file:{0}?mode=ro'.format(quote(path)), uri=True)
+		except:
+			raise AurError(_('Could not open AUR snapshot: {0}').format(path))
+
+	def close(self):
+		''' Closes the snapshot database '''
+		self._db.close()
+
+	def _decode(self, row):
+		''' Turns a row into a localrepo style package info dict '''
+		return AurRequest.decode_result(dict(zip((field for column, field in AurSnapshot.COLUMNS), row)))
+
+	def _query(self, sql, args=()):
+		''' Runs a query and returns the infos of all found packages '''
+		try:
+			return [self._decode(row) for row in self._db.execute(sql, args)]
+		except:
+			raise AurError(_('Could not read AUR snapshot'))
+
+	def packages(self, names):
+		''' Returns the infos of all packages found by name '''
+		results = {}
+
+		for i in range(0, len(names), AurSnapshot.MAX):
+			chunk = names[i:i + AurSnapshot.MAX]
+			sql = 'SELECT * FROM packages WHERE name IN ({0})'.format(', '.join('?' * len(chunk)))
+			results.update((info['name'], info) for info in self._query(sql, chunk))
+
+		return results
+
+	def search(self, q):
+		''' Searches for packages with q in their name or description '''
+		q = '%{0}%'.format(q.replace('!', '!!').replace('%', '!%').replace('_', '!_'))
+		sql = 'SELECT * FROM packages WHERE name LIKE ? ESCAPE \'!\' OR desc LIKE ? ESCAPE \'!\' ORDER BY name'
+		return dict((info['name'], info) for info in self._query(sql, (q, q)))
+
+
 class Aur:
 	''' A class that manages request to the AUR '''
 
 	@staticmethod
 	def package(name):
 		''' Asks the AUR for informations about a single package '''
-		return AurRequest.forge('info', [name])
+		return Aur.packages([name])
 
 	@staticmethod
 	def packages(names):
-		''' Asks the AUR for informations about multiple packages '''
-		return AurRequest.forge('multiinfo', names)
+		''' Asks the AUR for informations about multiple packages and returns
+		the infos and the errors, when all requests are finished '''
+		errors = []
+		results = dict((info['name'], info) for info in Aur.stream(names, errors))
+		return results, errors
+
+	@staticmethod
+	def stream(names, errors):
+		''' Asks the AUR for informations about multiple packages and yields the
+		infos as soon as they arrive. Errors are appended to the errors list. '''
+		loop = new_event_loop()
+		records = Aur.records(names, errors)
+
+		try:
+			while True:
+				try:
+					with Metrics.timer('aur'):
+						info = loop.run_until_complete(records.__anext__())
+				except StopAsyncIteration:
+					return
+
+				Metrics.count('aur_packages')
+				yield info
+		finally:
+			loop.run_until_complete(records.aclose())
+			loop.run_until_complete(loop.shutdown_asyncgens())
+			loop.close()
+
+	@staticmethod
+	async def records(names, errors):
+		''' Asynchronously yields package infos. Infos younger than 'aur-cache-ttl'
+		seconds are taken from the cache, if the AUR fails to answer outdated infos
+		are used. Errors are appended to the errors list. '''
+		snapshot = AurSnapshot.open()
+
+		if snapshot is not None:
+			try:
+				for info in snapshot.packages(names).values():
+					yield info
+			finally:
+				snapshot.close()
+			return
+
+		cache = AurCache()
+		ttl = Config.get('aur-cache-ttl', AurCache.TTL)
+		missing = []
+
+		for name in names:
+			found, info = cache.get(name, ttl)
+
+			if not found:
+				missing.append(name)
+			elif info is not None:
+				yield info
+
+		if not missing:
+			return
+
+		try:
+			async for r in AurRequest.stream('multiinfo', missing):
+				if r.error is not None:
+					errors.append(r.error)
+
+				for name in r.data:
+					if r.error is None:
+						info = r.results.get(name)
+						cache.set(name, info)
+					else:
+						found, info = cache.get(name)
+
+					if info is not None:
+						yield info
+		finally:
+			try:
+				cache.save()
+			except AurError as e:
+				errors.append(e)
 
 	@staticmethod
 	def search(q):
-		''' Searches the AUR for packages '''
-		return AurRequest.forge('search', [q])
+		''' Searches the AUR or the snapshot for packages '''
+		snapshot = AurSnapshot.open()
+
+		if snapshot is None:
+			return AurRequest.forge('search', [q])
+
+		try:
+			return snapshot.search(q), []
+		finally:
+			snapshot.close()
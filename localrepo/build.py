@@ -0,0 +1,202 @@
+# build.py
+# vim:ts=4:sw=4:noexpandtab
+
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+from localrepo.package import Package, BuildError
+from localrepo.pacman import Pacman
+from localrepo.parser import PkgbuildParser
+
+class BuildJob:
+	''' A package, that has to be added to the repo '''
+
+	def __init__(self, path):
+		''' Sets the path, which may point to anything Package.forge understands '''
+		self.path = path
+		self.location = None
+		self.pkgbuild = None
+		self.info = None
+		self.pkg = None
+		self.requires = set()
+
+	@property
+	def name(self):
+		''' Returns the package name '''
+		return self.pkg.name if self.pkg else self.info['name']
+
+	@property
+	def deps(self):
+		''' Returns the names of all depends and makedepends without version requirements '''
+		if self.info is None:
+			return set()
+
+		return set(Pacman.VERSION_SEP.split(d)[0] for d in self.info['depends'] + self.info['makedepends'])
+
+	def locate(self, path=None):
+		''' Downloads and extracts everything needed to build the package. path may
+		point to an already downloaded copy of a remote file. '''
+		self.location = Package.locate(path or self.path)
+
+	@property
+	def is_pkgbuild(self):
+		''' Is the located path a pkgbuild dir? '''
+		return not self.location.endswith(Package.EXT)
+
+	def prepare(self, path=None):
+		''' Locates and parses everything needed to build the package '''
+		if self.location is None or path is not None:
+			self.locate(path)
+
+		if self.is_pkgbuild:
+			self.pkgbuild, self.info = Package.prepare(self.location)
+		else:
+			self.pkg = Package.from_file(self.location)
+
+
+class BuildScheduler:
+	''' Builds a set of packages. Packages depending on other packages of the set are
+	built after them, independent packages are built concurrently. '''
+
+	def __init__(self, paths, jobs=1, force=False):
+		''' Sets the paths, the max number of concurrent builds and the force flag '''
+		self._jobs = [BuildJob(path) for path in paths]
+		self._max = max(jobs, 1)
+		self._force = force
+
+	@property
+	def jobs(self):
+		''' Returns all build jobs '''
+		return self._jobs
+
+	def prepare(self, callback=None):
+		''' Downloads all remote files at once, prepares all jobs and works out the
+		dependencies between them '''
+		remote = [job.path for job in self._jobs if Package.is_remote(job.path)]
+		local = Package.download(remote) if remote else {}
+
+		for job in self._jobs:
+			if callback:
+				callback(job)
+
+			job.locate(local.get(job.path))
+
+		# Parse all PKGBUILDs with a single bash process, the jobs find them memorized
+		PkgbuildParser.parse_all([Package.find_pkgbuild(job.location) for job in self._jobs if job.is_pkgbuild])
+
+		for job in self._jobs:
+			job.prepare()
+
+		names = {job.name: job for job in self._jobs}
+
+		for job in self._jobs:
+			job.requires = set(names[d] for d in job.deps if d in names and names[d] is not job)
+
+	def _build(self, job):
+		''' Builds a single job, runs in a worker thread '''
+		job.pkg = Package.build(job.pkgbuild, job.info, force=self._force)
+		return job
+
+	def run(self, before=None):
+		''' Builds all jobs and yields them as soon as they are done, jobs done at the
+		same time in the given order. before is called with every job right before
+		its build starts. '''
+		pending = [job for job in self._jobs if job.pkg is None]
+		finished = set()
+
+		for job in (job for job in self._jobs if job.pkg is not None):
+			finished.add(job)
+			yield job
+
+		with ThreadPoolExecutor(max_workers=self._max) as pool:
+			running = {}
+
+			try:
+				while pending or running:
+					for job in [job for job in pending if job.requires <= finished]:
+						if before:
+							before(job)
+
+						pending.remove(job)
+						running[pool.submit(self._build, job)] = job
+
+					if not running:
+						names = ', '.join(job.name for job in pending)
+						raise BuildError(_('Circular dependencies: {0}').format(names))
+
+					done, not_done = wait(running, return_when=FIRST_COMPLETED)
+
+					for future in sorted(done, key=lambda f: self._jobs.index(running[f])):
+						job = future.result()
+						del(running[future])
+						finished.add(job)
+						yield job
+			except:
+				for future in running:
+					future.cancel()
+				raise
+
+
+class DependencyResolver:
+	''' Resolves the dependencies of a whole build set with a single 'pacman -T'.
+	Missing dependencies are split into packages of the sync repos, packages of
+	the local repo and packages built in the set. The first two are installed
+	before the builds start, the latter right before a package needs them. '''
+
+	def __init__(self, jobs, repo=()):
+		''' Sets the prepared build jobs and the local repo '''
+		self._jobs = jobs
+		self._repo = repo
+		self._built = {}
+		self.sync = []
+		self.files = []
+		self.installed = []
+
+	def resolve(self):
+		''' Queries all dependencies of the build set at once '''
+		deps = []
+
+		for job in self._jobs:
+			if job.info is not None:
+				deps += [d for d in job.info['depends'] + job.info['makedepends'] if d not in deps]
+
+		unresolved = Pacman.check_deps(deps) if deps else []
+		names = {job.name: job for job in self._jobs}
+
+		for dep in unresolved:
+			name = Pacman.VERSION_SEP.split(dep)[0]
+
+			if name in names:
+				self._built[name] = names[name]
+			elif name in self._repo:
+				self.files.append((name, self._repo[name].path))
+			else:
+				self.sync.append(dep)
+
+	@property
+	def missing(self):
+		''' Returns the missing dependencies, which are installed before the builds '''
+		return self.sync + [name for name, path in self.files]
+
+	def install(self):
+		''' Installs the missing dependencies of the sync repos and the local repo '''
+		if self.sync:
+			Pacman.install(self.sync, as_deps=True)
+			self.installed += self.sync
+
+		if self.files:
+			Pacman.install_files([path for name, path in self.files], as_deps=True)
+			self.installed += [name for name, path in self.files]
+
+	def prepare(self, job):
+		''' Installs the missing dependencies of a job, which were built in the set.
+		Call it right before the job is built. '''
+		files = []
+
+		for dep in job.requires:
+			if self._built.get(dep.name) is dep and dep.pkg is not None:
+				files.append(dep.pkg.path)
+				self.installed.append(dep.name)
+				del(self._built[dep.name])
+
+		if files:
+			Pacman.install_files(files, as_deps=True)
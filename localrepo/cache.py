@@ -0,0 +1,246 @@
+# cache.py
+# vim:ts=4:sw=4:noexpandtab
+
+from os.path import join
+from mmap import mmap, ACCESS_READ
+from struct import Struct
+from json import dumps, loads
+from functools import partial
+
+from localrepo.package import Package
+from localrepo.search import Index
+from localrepo.utils import LocalRepoError, Utils
+
+class CacheError(LocalRepoError):
+	''' Handles cache errors '''
+	pass
+
+
+class Cache:
+	''' A read only package dict backed by a memory mapped cache file.
+
+	The file starts with a header (magic, schema version, number of packages,
+	tokens and postings), followed by fixed-width records sorted by package name,
+	the search index and a string table. Every record holds (offset, length)
+	pairs pointing into the string table for the name, version, filename and the
+	JSON encoded remaining info.
+
+	The search index is the inverted index of search.Index: token records sorted
+	by their 'field:token' key, each pointing to a slice of the postings, which
+	are the sorted record numbers of the packages containing the token. '''
+
+	#: Magic bytes
+	MAGIC = b'LRPC'
+
+	#: Schema version, bump it whenever the format changes
+	VERSION = 3
+
+	#: Header: magic, version, reserved, number of records, tokens and postings
+	HEADER = Struct('<4sHHIII')
+
+	#: Record: (offset, length) of name, version, filename and info
+	RECORD = Struct('<8I')
+
+	#: Token: (offset, length) of the key, (start, count) of its postings
+	TOKEN = Struct('<4I')
+
+	#: Posting: a record number
+	POSTING = Struct('<I')
+
+	#: Fields stored in their own string instead of the info blob
+	FIELDS = ('name', 'version', 'filename')
+
+	@staticmethod
+	def write(path, packages, mode=0o644):
+		''' Writes a package dict and its search index into a cache file. The file
+		gets the mode of the old cache or mode, if there is none. '''
+		strings, size, records, postings = [], 0, [], {}
+
+		for i, name in enumerate(sorted(packages, key=lambda n: n.encode('utf8'))):
+			info = dict(packages[name].info)
+
+			for key in Index.keys(info):
+				postings.setdefault(key.encode('utf8'), []).append(i)
+
+			fields = [info.pop(f) for f in Cache.FIELDS]
+			fields.append(dumps(info, separators=(',', ':')))
+			record = []
+
+			for field in (f.encode('utf8') for f in fields):
+				record += [size, len(field)]
+				strings.append(field)
+				size += len(field)
+
+			records.append(Cache.RECORD.pack(*record))
+
+		tokens, start = [], 0
+
+		for key in sorted(postings):
+			tokens.append(Cache.TOKEN.pack(size, len(key), start, len(postings[key])))
+			strings.append(key)
+			size += len(key)
+			start += len(postings[key])
+
+		with Utils.atomic_write(path, mode) as tmp, open(tmp, 'wb') as f:
+			f.write(Cache.HEADER.pack(Cache.MAGIC, Cache.VERSION, 0, len(records), len(tokens), start))
+			f.writelines(records)
+			f.writelines(tokens)
+			f.writelines(Cache.POSTING.pack(i) for key in sorted(postings) for i in postings[key])
+			f.writelines(strings)
+
+	def __init__(self, path, repo_path):
+		''' Maps the cache file into memory and validates the header '''
+		self._repo_path = repo_path
+
+		try:
+			with open(path, 'rb') as f:
+				self._map = mmap(f.fileno(), 0, access=ACCESS_READ)
+		except:
+			raise CacheError(_('Could not load cache: {0}').format(path))
+
+		try:
+			magic, version, reserved, self._len, self._ntokens, postings = Cache.HEADER.unpack_from(self._map)
+		except:
+			raise CacheError(_('Could not load cache: {0}').format(path))
+
+		if magic != Cache.MAGIC or version != Cache.VERSION:
+			raise CacheError(_('Cache is outdated: {0}').format(path))
+
+		self._tokens = Cache.HEADER.size + self._len * Cache.RECORD.size
+		self._postings = self._tokens + self._ntokens * Cache.TOKEN.size
+		self._strings = self._postings + postings * Cache.POSTING.size
+
+		if len(self._map) < self._strings:
+			raise CacheError(_('Could not load cache: {0}').format(path))
+
+	def _record(self, i):
+		''' Returns the (offset, length) pairs of a record '''
+		return Cache.RECORD.unpack_from(self._map, Cache.HEADER.size + i * Cache.RECORD.size)
+
+	def _string(self, record, field):
+		''' Returns the raw bytes of a field of a record '''
+		offset = self._strings + record[2 * field]
+		return self._map[offset:offset + record[2 * field + 1]]
+
+	def _token(self, i):
+		''' Returns the key offset, key length, postings start and count of a token '''
+		return Cache.TOKEN.unpack_from(self._map, self._tokens + i * Cache.TOKEN.size)
+
+	def _name(self, i):
+		''' Returns the raw name of a record '''
+		return self._string(self._record(i), 0)
+
+	def _key(self, i):
+		''' Returns the raw key of a token '''
+		offset, length, start, count = self._token(i)
+		return self._map[self._strings + offset:self._strings + offset + length]
+
+	@staticmethod
+	def _bisect(key, n, get):
+		''' Returns the first index in [0, n), whose sorted value is not less than key '''
+		lo, hi = 0, n
+
+		while lo < hi:
+			mid = (lo + hi) // 2
+
+			if get(mid) < key:
+				lo = mid + 1
+			else:
+				hi = mid
+
+		return lo
+
+	def _find(self, name):
+		''' Finds the record index of a package by bisecting the sorted names '''
+		key = name.encode('utf8')
+		i = Cache._bisect(key, self._len, self._name)
+		return i if i < self._len and self._name(i) == key else None
+
+	def name(self, i):
+		''' Returns the name of the i-th package '''
+		return self._name(i).decode('utf8')
+
+	def prefix(self, prefix):
+		''' Returns the range of package numbers, whose names start with prefix '''
+		key = prefix.encode('utf8')
+		lo = hi = Cache._bisect(key, self._len, self._name)
+
+		while hi < self._len and self._name(hi).startswith(key):
+			hi += 1
+
+		return range(lo, hi)
+
+	def tokens(self, field, token, prefix=False):
+		''' Returns the set of package numbers, whose field contains the token or, if
+		prefix is set, a token starting with it '''
+		key = '{0}:{1}'.format(field, token).encode('utf8')
+		i, found = Cache._bisect(key, self._ntokens, self._key), set()
+
+		while i < self._ntokens and (self._key(i).startswith(key) if prefix else self._key(i) == key):
+			offset, length, start, count = self._token(i)
+			offset = self._postings + start * Cache.POSTING.size
+			found.update(r for r, in Cache.POSTING.iter_unpack(self._map[offset:offset + count * Cache.POSTING.size]))
+			i += 1
+
+			if not prefix:
+				break
+
+		return found
+
+	def _package(self, i):
+		''' Creates a package object from a record, the info is decoded on first access '''
+		record = self._record(i)
+		name, version, filename = (self._string(record, f).decode('utf8') for f in range(3))
+		return Package(name, version, join(self._repo_path, filename), partial(self._info, i))
+
+	def _info(self, i):
+		''' Decodes the info of a record '''
+		return loads(self._string(self._record(i), 3).decode('utf8'))
+
+	def field(self, field):
+		''' Yields (name, value) pairs of a record field without decoding the info '''
+		f = Cache.FIELDS.index(field)
+
+		for i in range(self._len):
+			record = self._record(i)
+			yield self._string(record, 0).decode('utf8'), self._string(record, f).decode('utf8')
+
+	def __len__(self):
+		''' Returns the number of packages '''
+		return self._len
+
+	def __iter__(self):
+		''' Returns an iterator over the sorted package names '''
+		return (self._string(self._record(i), 0).decode('utf8') for i in range(self._len))
+
+	def __contains__(self, name):
+		''' Tests if a package is in the cache '''
+		return self._find(name) is not None
+
+	def __getitem__(self, name):
+		''' Returns a package '''
+		i = self._find(name)
+
+		if i is None:
+			raise KeyError(name)
+
+		return self._package(i)
+
+	def get(self, name, default=None):
+		''' Returns a package or default '''
+		try:
+			return self[name]
+		except KeyError:
+			return default
+
+	def keys(self):
+		''' Returns an iterator over the sorted package names '''
+		return iter(self)
+
+	def values(self):
+		''' Returns an iterator over all packages '''
+		return (self._package(i) for i in range(self._len))
+
+	def items(self):
+		''' Returns an iterator over all (name, package) pairs '''
+		return ((pkg.name, pkg) for pkg in self.values())
@@ -22,12 +22,30 @@ class Config:
 	ALL = 'all'
 
 	#: Data types
-	TYPES = {'buildlog': str,
+	TYPES = {'aur-cache': str,
+	         'aur-cache-ttl': int,
+	         'aur-jobs': int,
+	         'aur-retries': int,
+	         'aur-snapshot': str,
+	         'aur-snapshot-url': str,
+	         'build-jobs': int,
+	         'buildlog': str,
 	         'cache': str,
+	         'check-jobs': int,
+	         'download-cache': str,
+	         'download-cache-size': int,
+	         'download-jobs': int,
+	         'download-segments': int,
 	         'log': str,
+	         'log-compress': bool,
+	         'log-format': str,
+	         'log-max-age': int,
+	         'log-max-size': int,
+	         'metrics': str,
 	         'no-aur-upgrade': list,
 	         'path': str,
 	         'pkgbuild': str,
+	         'pkgbuild-cache': str,
 	         'reponame': str,
 	         'sign': bool,
 	         'signdb': bool,
@@ -0,0 +1,401 @@
+# download.py
+# vim:ts=4:sw=4:noexpandtab
+
+from contextlib import contextmanager
+from fcntl import LOCK_EX, flock
+from os import chmod, close, link, makedirs, pwrite, remove, rename, truncate
+from os.path import dirname, expanduser, getsize, isfile, join
+from shutil import copyfile
+from tempfile import mkstemp
+from threading import Lock, RLock
+from time import sleep, time
+from json import dump, load
+from http.client import HTTPException
+from urllib.error import HTTPError
+from urllib.request import Request, urlopen
+from concurrent.futures import ThreadPoolExecutor
+
+from localrepo.utils import Checksum, LocalRepoError, Msg, Utils
+from localrepo.config import Config
+
+class DownloadError(LocalRepoError):
+	''' Handles download errors '''
+	pass
+
+
+class Progress:
+	''' Sums up the progress of several concurrent downloads for Msg.progress '''
+
+	def __init__(self):
+		''' Starts with nothing '''
+		self._lock = Lock()
+		self._done = 0
+		self._total = 0
+
+	def expect(self, size):
+		''' Adds the size of a new download '''
+		with self._lock:
+			self._total += size
+
+	def update(self, size):
+		''' Adds downloaded bytes and displays the progress '''
+		with self._lock:
+			self._done += size
+
+			if self._total:
+				Msg.progress(self._done, 1, self._total)
+
+
+class Transfer:
+	''' Downloads a single url into a file. Dropped connections are resumed with
+	range requests, large files are downloaded in parallel segments. '''
+
+	#: Timeout in seconds
+	TIMEOUT = 30
+
+	#: Number of reconnects per segment
+	RETRIES = 3
+
+	#: Seconds to wait before the first reconnect, doubled for every further one
+	BACKOFF = 0.5
+
+	#: Files smaller than this are never split into segments
+	SEGMENT_MIN = 16 * 1024 * 1024
+
+	#: Default number of segments
+	SEGMENTS = 4
+
+	def __init__(self, url, res, path, progress):
+		''' Sets the url, the already opened response, the destination path and the
+		progress. The validator of the response ensures, that ranges of a changed
+		file are never mixed with the old one. '''
+		self._url = url
+		self._res = res
+		self._path = path
+		self._progress = progress
+		self._size = int(res.headers.get('Content-Length') or 0) or None
+		self._ranges = res.headers.get('Accept-Ranges') == 'bytes'
+		self._validator = res.headers.get('ETag') or res.headers.get('Last-Modified')
+
+	def _range(self, start, end):
+		''' Requests the bytes [start, end) '''
+		headers = {'Range': 'bytes={0}-{1}'.format(start, end - 1)}
+
+		if self._validator:
+			headers['If-Range'] = self._validator
+
+		res = urlopen(Request(self._url, headers=headers), timeout=Transfer.TIMEOUT)
+
+		if res.status != 206:
+			res.close()
+			raise DownloadError(_('Server does not support resuming: {0}').format(self._url))
+
+		return res
+
+	def _copy(self, fd, res, start, end):
+		''' Copies a response into the bytes [start, end) of a file and reconnects,
+		if the connection drops. end is None for files of unknown size. '''
+		pos = start
+
+		for attempt in range(Transfer.RETRIES + 1):
+			try:
+				if res is None:
+					res = self._range(pos, end)
+
+				with res:
+					while end is None or pos < end:
+						data = res.read(min(Checksum.CHUNK, end - pos) if end else Checksum.CHUNK)
+
+						if not data:
+							break
+
+						pwrite(fd, data, pos)
+						pos += len(data)
+						self._progress.update(len(data))
+
+				if end is None or pos == end:
+					return
+
+				raise HTTPException('connection closed at {0} of {1}'.format(pos, end))
+			except (OSError, HTTPException):
+				if end is None or not self._ranges or attempt == Transfer.RETRIES:
+					raise
+
+				res = None
+				sleep(Transfer.BACKOFF * 2 ** attempt)
+
+	def run(self):
+		''' Downloads the file '''
+		segments = max(Config.get('download-segments', Transfer.SEGMENTS), 1)
+
+		if self._size:
+			self._progress.expect(self._size)
+
+		with open(self._path, 'wb') as f:
+			fd = f.fileno()
+
+			if not self._ranges or not self._size or segments == 1 or self._size < Transfer.SEGMENT_MIN:
+				self._copy(fd, self._res, 0, self._size)
+				return
+
+			truncate(fd, self._size)
+			self._res.close()
+			step = -(-self._size // segments)
+			bounds = [(start, min(start + step, self._size)) for start in range(0, self._size, step)]
+
+			with ThreadPoolExecutor(max_workers=segments) as executor:
+				futures = [executor.submit(self._copy, fd, None, start, end) for start, end in bounds]
+
+				for future in futures:
+					future.result()
+
+
+class DownloadCache:
+	''' A persistent download cache shared by all repos. Files are stored by their
+	sha256 in objects/<sha[:2]>/<sha>, the index maps urls to objects and their
+	validators. The least recently used objects are evicted, when the cache grows
+	beyond its max size. '''
+
+	#: Default path to the cache dir
+	PATH = expanduser(join('~', '.cache', 'local-repo', 'downloads'))
+
+	#: Default max size in MiB
+	SIZE = 1024
+
+	#: Index filename
+	INDEX = 'index.json'
+
+	#: Objects dir
+	OBJECTS = 'objects'
+
+	#: Lock file, serializes index updates of concurrent runs
+	LOCK = 'index.lock'
+
+	#: Default number of concurrent downloads
+	JOBS = 4
+
+	#: Guards the index, downloads may run in several threads
+	_lock = RLock()
+
+	def __init__(self, path=None, size=None):
+		''' Sets the cache dir and the max size in bytes and loads the index '''
+		self._path = expanduser(path or Config.get('download-cache', DownloadCache.PATH))
+		size = Config.get('download-cache-size', DownloadCache.SIZE) if size is None else size
+		self._size = size * 1024 * 1024
+		self._load()
+
+	@property
+	def enabled(self):
+		''' Is the cache enabled? '''
+		return self._size > 0
+
+	def _object(self, sha256):
+		''' Returns the path to an object '''
+		return join(self._path, DownloadCache.OBJECTS, sha256[:2], sha256)
+
+	def _cached(self, url):
+		''' Returns the index entry of an url, if its object exists '''
+		entry = self._index.get(url)
+
+		if entry and isfile(self._object(entry['sha256'])):
+			return entry
+
+		return None
+
+	def _load(self):
+		''' Loads the index, a missing or broken index is empty '''
+		self._index = {}
+
+		try:
+			with open(join(self._path, DownloadCache.INDEX), encoding='utf8') as f:
+				self._index = load(f)
+		except:
+			pass
+
+	@contextmanager
+	def _locked(self):
+		''' Locks the index against other threads and runs and reloads it, so changes
+		of other runs are not lost, when it is saved '''
+		with DownloadCache._lock:
+			try:
+				makedirs(self._path, mode=0o755, exist_ok=True)
+				f = open(join(self._path, DownloadCache.LOCK), 'a')
+			except OSError:
+				raise DownloadError(_('Could not lock download cache: {0}').format(self._path))
+
+			# The lock is released, when the file is closed
+			with f:
+				flock(f, LOCK_EX)
+				self._load()
+				yield
+
+	def _save(self):
+		''' Writes the index atomically '''
+		path = join(self._path, DownloadCache.INDEX)
+
+		try:
+			with Utils.atomic_write(path) as tmp, open(tmp, 'w', encoding='utf8') as f:
+				dump(self._index, f, separators=(',', ':'))
+		except:
+			raise DownloadError(_('Could not write download cache index: {0}').format(self._path))
+
+	def _release(self, sha256):
+		''' Removes an object, which is not referenced by the index anymore '''
+		if any(e['sha256'] == sha256 for e in self._index.values()):
+			return
+
+		try:
+			remove(self._object(sha256))
+		except OSError:
+			pass
+
+	def _evict(self):
+		''' Removes the least recently used objects, until the cache is small enough '''
+		objects = {}
+
+		for entry in self._index.values():
+			sha256 = entry['sha256']
+			size, atime = objects.get(sha256, (entry['size'], 0))
+			objects[sha256] = size, max(atime, entry['atime'])
+
+		total = sum(size for size, atime in objects.values())
+
+		for sha256, (size, atime) in sorted(objects.items(), key=lambda o: o[1][1]):
+			if total <= self._size:
+				break
+
+			self._index = dict((url, e) for url, e in self._index.items() if e['sha256'] != sha256)
+			total -= size
+
+			try:
+				remove(self._object(sha256))
+			except OSError:
+				pass
+
+	def _request(self, url, entry):
+		''' Sends a conditional request and returns the response or None, if the
+		cached file is still valid '''
+		headers = {}
+
+		if entry and entry.get('etag'):
+			headers['If-None-Match'] = entry['etag']
+
+		if entry and entry.get('modified'):
+			headers['If-Modified-Since'] = entry['modified']
+
+		try:
+			res = urlopen(Request(url, headers=headers), timeout=Transfer.TIMEOUT)
+		except HTTPError as e:
+			if e.code == 304 and entry:
+				return None
+			raise
+
+		# Without validators the size has to do
+		if entry and not headers and res.headers.get('Content-Length') == str(entry['size']):
+			res.close()
+			return None
+
+		return res
+
+	def _store(self, url, res, progress):
+		''' Downloads a response into the objects dir and returns the index entry '''
+		tmpdir = join(self._path, DownloadCache.OBJECTS)
+		makedirs(tmpdir, mode=0o755, exist_ok=True)
+		fd, tmp = mkstemp(prefix='.', dir=tmpdir)
+		close(fd)
+
+		try:
+			Transfer(url, res, tmp, progress).run()
+			size = getsize(tmp)
+			sha256 = Checksum.file(tmp)['sha256']
+			path = self._object(sha256)
+			makedirs(dirname(path), mode=0o755, exist_ok=True)
+
+			# Same content from another url, keep the existing object and its links
+			if isfile(path):
+				remove(tmp)
+			else:
+				chmod(tmp, 0o644)
+				rename(tmp, path)
+		except:
+			if isfile(tmp):
+				remove(tmp)
+			raise
+
+		return {'sha256': sha256, 'size': size, 'etag': res.headers.get('ETag'),
+		        'modified': res.headers.get('Last-Modified'), 'atime': time()}
+
+	def _link(self, src, dest):
+		''' Hardlinks an object into dest, falls back to a copy. dest is in a temporary
+		dir, Package.move copies linked files into the repo. '''
+		if isfile(dest):
+			remove(dest)
+
+		try:
+			link(src, dest)
+		except OSError:
+			copyfile(src, dest)
+
+	def fetch(self, url, dest, progress=None):
+		''' Downloads url to dest. Cached files are revalidated and linked into dest.
+		If the server is unreachable, cached files are used without validation. '''
+		progress = progress or Progress()
+
+		if not self.enabled:
+			return DownloadCache._download(url, dest, progress)
+
+		with DownloadCache._lock:
+			entry = self._cached(url)
+
+		try:
+			res = self._request(url, entry)
+
+			if res is not None:
+				with res:
+					fresh = self._store(url, res, progress)
+		except:
+			if entry is None:
+				raise DownloadError(_('Could not download file: {0}').format(url))
+
+			Msg.error(_('Using cached file: {0}').format(url))
+			res = None
+
+		with self._locked():
+			if res is not None:
+				old = self._index.get(url)
+				entry = self._index[url] = fresh
+
+				if old is not None:
+					self._release(old['sha256'])
+			else:
+				# Another run may have evicted the file meanwhile
+				entry = self._cached(url)
+
+				if entry is None:
+					raise DownloadError(_('Could not download file: {0}').format(url))
+
+			entry['atime'] = time()
+			self._link(self._object(entry['sha256']), dest)
+			self._evict()
+			self._save()
+
+		return dest
+
+	def fetch_all(self, downloads):
+		''' Downloads several (url, dest) pairs at once, up to 'download-jobs' '''
+		progress = Progress()
+		jobs = max(Config.get('download-jobs', DownloadCache.JOBS), 1)
+
+		with ThreadPoolExecutor(max_workers=jobs) as executor:
+			futures = [executor.submit(self.fetch, url, dest, progress) for url, dest in downloads]
+			return [future.result() for future in futures]
+
+	@staticmethod
+	def _download(url, dest, progress):
+		''' Downloads url to dest without caching '''
+		try:
+			Transfer(url, urlopen(url, timeout=Transfer.TIMEOUT), dest, progress).run()
+		except:
+			raise DownloadError(_('Could not download file: {0}').format(url))
+
+		return dest
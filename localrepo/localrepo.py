@@ -1,27 +1,89 @@
 # localrepo.py
 # vim:ts=4:sw=4:noexpandtab
 
-from localrepo.package import Package, DependencyError
-from localrepo.pacman import Pacman
+# Read-only commands like -l, -s and -i run thousands of times a day from scripts
+# and completions. Modules needed for building, writing the database, calling
+# pacman and talking to the AUR are heavy, so they are imported where they are
+# used, here and in the modules loaded by read-only commands.
+from localrepo.package import Package
 from localrepo.repo import Repo
-from localrepo.aur import Aur
 from localrepo.log import Log, BuildLog, PkgbuildLog
+from localrepo.metrics import Metrics
+from localrepo.output import Output
 from localrepo.utils import Msg, LocalRepoError
+from localrepo.vercmp import vercmp
 from localrepo.config import Config
 
+from sys import stderr
+from time import localtime, strftime
+
 class LocalRepo:
 	''' The main class for the local-repo programm '''
 
+	#: Fields and types of list and search records
+	LIST_FIELDS = (('name', str), ('version', str))
+
+	#: Fields and types of info records
+	INFO_FIELDS = (('name', str), ('version', str), ('filename', str), ('desc', str), ('url', str),
+	               ('license', str), ('arch', str), ('builddate', int), ('packager', str),
+	               ('csize', int), ('isize', int), ('md5sum', str), ('sha256sum', str), ('pgpsig', bool))
+
+	#: Fields and types of history records
+	HISTORY_FIELDS = (('time', float), ('pkg', str), ('action', str), ('version', str), ('old', str),
+	                  ('op', str))
+
 	#: The repo instance
 	_repo = None
 
+	#: Machine-readable output format of list, info and search, see Output
+	_format = None
+
+	#: If True, the phases of the run are printed on shutdown
+	_profile = False
+
 	@staticmethod
 	def shutdown(status=0):
 		''' Cleans up and exits with status '''
 		Package.clean()
+		LocalRepo._report()
 		Log.close()
 		exit(status)
 
+	@staticmethod
+	def profile(path=None):
+		''' Prints the time spent in each phase on shutdown. If path is set, cProfile
+		stats are written to it. '''
+		LocalRepo._profile = True
+
+		if path:
+			Metrics.profile(path)
+
+	@staticmethod
+	def _report():
+		''' Writes the profile and the metrics file and prints the phases of the run '''
+		try:
+			Metrics.dump()
+
+			if Config.get('metrics', False):
+				Metrics.export(Config.get('metrics'))
+		except LocalRepoError as e:
+			Msg.error(e.message)
+
+		if not LocalRepo._profile:
+			return
+
+		total = Metrics.elapsed()
+		Msg.msg(_('Time spent in each phase'), color='blue', stream=stderr)
+
+		for phase, calls, seconds in Metrics.phases():
+			line = '{0:12} {1:>6}x {2:>9.3f}s {3:>5.1f}%'.format(phase, calls, seconds, seconds / total * 100)
+			Msg.msg(line, stream=stderr)
+
+		for name, value in Metrics.counters():
+			Msg.msg('{0:20} {1}'.format(name, value), stream=stderr)
+
+		Msg.msg('{0:20} {1:.3f}s'.format(_('total'), total), stream=stderr)
+
 	@staticmethod
 	def error(error):
 		''' Prints the error message and shuts down '''
@@ -47,10 +109,23 @@ class LocalRepo:
 		except LocalRepoError as e:
 			LocalRepo.error(e)
 
+	@staticmethod
+	def output_format(fmt):
+		''' Switches list, info and search to a machine-readable output format '''
+		LocalRepo._format = fmt
+
+	@staticmethod
+	def _output(fields, records):
+		''' Streams records in the output format '''
+		with Output(LocalRepo._format, fields) as out:
+			for record in records:
+				out.write(record)
+
 	@staticmethod
 	def load_repo():
 		''' Loads the repo '''
-		Msg.process(_('Loading repo: {0}').format(LocalRepo._repo.path))
+		if not LocalRepo._format:
+			Msg.process(_('Loading repo: {0}').format(LocalRepo._repo.path))
 
 		try:
 			LocalRepo._repo.load()
@@ -65,12 +140,17 @@ class LocalRepo:
 	@staticmethod
 	def list():
 		''' Prints all repo packages '''
-		if len(LocalRepo._repo) is 0:
+		if LocalRepo._format:
+			versions = LocalRepo._repo.versions()
+			LocalRepo._output(LocalRepo.LIST_FIELDS, ({'name': n, 'version': v} for n, v in versions))
+			return
+
+		if len(LocalRepo._repo) == 0:
 			Msg.info(_('This repo has no packages'))
 			return
 
-		for name in sorted(LocalRepo._repo):
-			Msg.info(name, LocalRepo._repo[name].version)
+		for name, version in LocalRepo._repo.versions():
+			Msg.info(name, version)
 
 	@staticmethod
 	def info(names):
@@ -80,42 +160,56 @@ class LocalRepo:
 				Msg.error(_('Package does not exist: {0}').format(name))
 				LocalRepo.shutdown(1)
 
+		if LocalRepo._format:
+			LocalRepo._output(LocalRepo.INFO_FIELDS, (LocalRepo._repo[name].info for name in names))
+			return
+
+		for name in names:
 			Msg.process(_('Package information: {0}').format(name))
 			Msg.info(LocalRepo._repo[name])
 
 	@staticmethod
 	def find(q):
-		''' Searches the repo for packages '''
-		res = sorted((name for name in LocalRepo._repo if q in name))
+		''' Searches the repo for packages, see Query for the syntax '''
+		try:
+			names = LocalRepo._repo.search(q)
+		except LocalRepoError as e:
+			LocalRepo.error(e)
+
+		if LocalRepo._format:
+			records = ({'name': name, 'version': LocalRepo._repo[name].version} for name in names)
+			LocalRepo._output(LocalRepo.LIST_FIELDS, records)
+			return
 
-		if not res:
+		if not names:
 			Msg.error(_('No package found'))
 			return
 
-		for name in res:
+		for name in names:
 			Msg.info(name, LocalRepo._repo[name].version)
 
 	@staticmethod
-	def _install_deps(names):
-		''' Installs missing dependencies '''
-		Msg.info(_('Need following packages as dependencies:\n[{0}]').format(', '.join(names)))
+	def _install_deps(resolver):
+		''' Installs missing dependencies of all packages in one go '''
+		Msg.info(_('Need following packages as dependencies:\n[{0}]').format(', '.join(resolver.missing)))
 
 		if not Msg.ask(_('Install?')):
 			if Msg.ask(_('Try without installing dependencies?')):
-				return False
+				return
 
 			Msg.info(_('Bye'))
 			LocalRepo.shutdown(1)
 
 		try:
-			Pacman.install(names, as_deps=True)
-			return True
+			resolver.install()
 		except LocalRepoError as e:
 			LocalRepo.error(e)
 
 	@staticmethod
 	def _uninstall_deps(names):
 		''' Uninstalls previoulsy installed dependencies '''
+		from localrepo.pacman import Pacman
+
 		Msg.info(_('Installed following packages as dependencies:\n[{0}]').format(', '.join(names)))
 
 		if Msg.ask(_('Uninstall?')):
@@ -125,42 +219,65 @@ class LocalRepo:
 				LocalRepo.error(e)
 
 	@staticmethod
-	def _make_package(path, force=False):
-		''' Makes a new package '''
-		Msg.process(_('Forging a new package: {0}').format(path))
-		Log.log(_('Forging a new package: {0}').format(path))
+	def _forging(job):
+		''' Announces a new package '''
+		Msg.process(_('Forging a new package: {0}').format(job.path))
+		Log.log(_('Forging a new package: {0}').format(job.path))
 
-		try:
-			return Package.forge(path, force=force)
-		except DependencyError as e:
-			installed_deps = LocalRepo._install_deps(e.deps)
+	@staticmethod
+	def _make_packages(paths, force=False):
+		''' Makes new packages and yields them as soon as they are ready. Independent
+		packages are built concurrently, up to 'build-jobs' at once. The dependencies
+		of all packages are resolved up front and uninstalled at the end. '''
+		from localrepo.build import BuildScheduler, DependencyResolver
 
-			try:
-				pkg = Package.from_pkgbuild(e.pkgbuild, ignore_deps=True, force=force)
-			except LocalRepoError as e:
-				LocalRepo.error(e)
+		scheduler = BuildScheduler(paths, jobs=Config.get('build-jobs', 1), force=force)
+		resolver = DependencyResolver(scheduler.jobs, LocalRepo._repo)
 
-			if Config.get('uninstall-deps', True) and installed_deps:
-				LocalRepo._uninstall_deps(e.deps)
+		try:
+			scheduler.prepare(callback=LocalRepo._forging)
+			resolver.resolve()
 
-			return pkg
+			if resolver.missing:
+				LocalRepo._install_deps(resolver)
 
+			for job in scheduler.run(before=resolver.prepare):
+				yield job.pkg
 		except LocalRepoError as e:
 			LocalRepo.error(e)
 
+		if Config.get('uninstall-deps', True) and resolver.installed:
+			LocalRepo._uninstall_deps(resolver.installed)
+
+	@staticmethod
+	def _action(old, new):
+		''' Returns the logged action of a package change from version old to new '''
+		if old is None:
+			return 'add'
+
+		cmp = vercmp(new, old)
+		return 'upgrade' if cmp > 0 else 'downgrade' if cmp < 0 else 'rebuild'
+
 	@staticmethod
 	def add(paths, force=False):
 		''' Adds packages to the repo '''
-		for path in paths:
-			pkg = LocalRepo._make_package(path, force=force)
+		pkgs = []
 
+		with Log.operation('add'):
 			try:
-				Msg.process(_('Adding package to the repo: {0}').format(pkg.name))
-				LocalRepo._repo.add(pkg, force=force)
-				Log.log(_('Added Package: {0} {1}').format(pkg.name, pkg.version))
+				with LocalRepo._repo.batch():
+					for pkg in LocalRepo._make_packages(paths, force=force):
+						Msg.process(_('Adding package to the repo: {0}').format(pkg.name))
+						old = LocalRepo._repo[pkg.name].version if pkg.name in LocalRepo._repo else None
+						LocalRepo._repo.add(pkg, force=force)
+						pkgs.append((pkg, old))
 			except LocalRepoError as e:
 				LocalRepo.error(e)
 
+			for pkg, old in pkgs:
+				Log.log(_('Added Package: {0} {1}').format(pkg.name, pkg.version), pkg=pkg.name,
+				        version=pkg.version, old=old, action=LocalRepo._action(old, pkg.version))
+
 	@staticmethod
 	def rebuild(names):
 		''' Rebuilds the specified packages '''
@@ -179,16 +296,23 @@ class LocalRepo:
 			LocalRepo.shutdown(1)
 
 		Msg.process(_('Removing packages: {0}').format(', '.join(names)))
+		versions = [(name, LocalRepo._repo[name].version) for name in names]
 
-		try:
-			LocalRepo._repo.remove(names)
-			Log.log(_('Removed packages: {0}').format(', '.join(names)))
-		except LocalRepoError as e:
-			LocalRepo.error(e)
+		with Log.operation('remove'):
+			try:
+				LocalRepo._repo.remove(names)
+			except LocalRepoError as e:
+				LocalRepo.error(e)
+
+			for name, version in versions:
+				Log.log(_('Removed Package: {0} {1}').format(name, version), pkg=name,
+				        version=version, action='remove')
 
 	@staticmethod
 	def aur_add(names, force=False):
 		''' Downloads, makes and adds packages from the AUR '''
+		from localrepo.aur import Aur
+
 		Msg.process(_('Retrieving package info from the AUR'))
 		pkgs, errors = Aur.packages(names)
 
@@ -200,37 +324,48 @@ class LocalRepo:
 				Msg.error(_('Package is already in the repo: {0}').format(pkg['name']))
 				LocalRepo.shutdown(1)
 
-			LocalRepo.add([pkg['uri']], force=force)
+		LocalRepo.add([pkg['uri'] for pkg in pkgs.values()], force=force)
 
 	@staticmethod
-	def aur_upgrade():
-		''' Upgrades all packages from the AUR '''
-		pkgs = [pkg for pkg in LocalRepo._repo if pkg not in Config.get('no-aur-upgrade', [])]
-		Msg.info(_('{0} packages found').format(len(pkgs)))
+	def _plan_upgrade():
+		''' Compares the repo with the AUR and prints the upgrade plan '''
+		from localrepo.aur import Aur
+		from localrepo.plan import UpgradePlan
+
 		Log.log(_('Starting an AUR upgrade'))
+		ignored = Config.get('no-aur-upgrade', [])
+		pkgs = [name for name in LocalRepo._repo if name not in ignored]
+		Msg.info(_('{0} packages found').format(len(pkgs)))
 
-		if len(pkgs) is 0:
+		if len(pkgs) == 0:
 			Msg.info(_('Nothing to do'))
-			return
+			return None
 
-		Msg.process(_('Retrieving package info from the AUR'))
-		pkgs, errors = Aur.packages(pkgs)
+		Msg.process(_('Retrieving package info from the AUR and checking for updates'))
+		errors = []
+		plan = UpgradePlan.create(LocalRepo._repo.path, LocalRepo._repo.versions(),
+		                          Aur.stream(pkgs, errors), ignored)
 
 		for e in errors:
 			Msg.error(e)
 
-		Msg.info(_('{0} packages found').format(len(pkgs)))
-		Msg.process(_('Checking for updates'))
-		updates = []
+		Msg.info(_('{0} packages found').format(len(pkgs) - len(plan.missing)))
+		LocalRepo._print_plan(plan)
+		return plan
 
-		for name, pkg in ((name, pkg) for name, pkg in pkgs.items() if name in LocalRepo._repo):
-			oldpkg = LocalRepo._repo[name]
+	@staticmethod
+	def _print_plan(plan):
+		''' Prints the upgrades and downgrades of a plan '''
+		for c in plan.upgrades:
+			Msg.result('{0} ({1} -> {2})'.format(c['name'], c['old'], c['new']))
 
-			if oldpkg.has_smaller_version_than(pkg['version']):
-				updates.append(pkg)
-				Msg.result('{0} ({1} -> {2})'.format(name, oldpkg.version, pkg['version']))
+		for c in plan.downgrades:
+			Msg.info(_('Newer than in the AUR: {0} ({1} <- {2})').format(c['name'], c['old'], c['new']))
 
-		if not updates:
+	@staticmethod
+	def _apply_plan(plan):
+		''' Asks and applies the upgrades of a plan '''
+		if not plan.upgrades:
 			Msg.info(_('All packages are up to date'))
 			return
 
@@ -238,11 +373,69 @@ class LocalRepo:
 			Msg.info(_('Bye'))
 			LocalRepo.shutdown(1)
 
-		LocalRepo.add([pkg['uri'] for pkg in updates], force=True)
+		LocalRepo.add([c['uri'] for c in plan.upgrades], force=True)
+
+	@staticmethod
+	def aur_upgrade():
+		''' Upgrades all packages from the AUR '''
+		with Log.operation('aur-upgrade'):
+			plan = LocalRepo._plan_upgrade()
+
+			if plan is not None:
+				LocalRepo._apply_plan(plan)
+
+	@staticmethod
+	def save_plan(path):
+		''' Plans an AUR upgrade and saves the plan for later '''
+		plan = LocalRepo._plan_upgrade()
+
+		if plan is None:
+			return
+
+		try:
+			plan.save(path)
+			Msg.info(_('Saved upgrade plan: {0}').format(path))
+		except LocalRepoError as e:
+			LocalRepo.error(e)
+
+	@staticmethod
+	def apply_plan(path):
+		''' Loads a saved upgrade plan and applies it '''
+		from localrepo.plan import UpgradePlan
+
+		Msg.process(_('Loading upgrade plan: {0}').format(path))
+
+		try:
+			plan = UpgradePlan.load(path)
+		except LocalRepoError as e:
+			LocalRepo.error(e)
+
+		if plan.repo != LocalRepo._repo.path:
+			Msg.error(_('Upgrade plan was made for another repo: {0}').format(plan.repo))
+			LocalRepo.shutdown(1)
+
+		stale = plan.stale(LocalRepo._repo.versions())
+
+		if stale:
+			Msg.error(_('Packages changed since the plan was made: {0}').format(', '.join(stale)))
+			LocalRepo.shutdown(1)
+
+		LocalRepo._print_plan(plan)
+
+		with Log.operation('apply-plan'):
+			LocalRepo._apply_plan(plan)
 
 	@staticmethod
 	def vcs_upgrade():
 		''' Upgrades all VCS packages from the AUR '''
+		with Log.operation('vcs-upgrade'):
+			LocalRepo._vcs_upgrade()
+
+	@staticmethod
+	def _vcs_upgrade():
+		''' Asks the AUR for all VCS packages and rebuilds them '''
+		from localrepo.aur import Aur
+
 		Msg.process(_('Updating all VCS packages'))
 		Log.log(_('Starting a VCS upgrade'))
 		vcs = [pkg for pkg in LocalRepo._repo if LocalRepo._repo[pkg].is_vcs]
@@ -252,7 +445,11 @@ class LocalRepo:
 			return
 
 		Msg.process(_('Retrieving package info from the AUR'))
-		updates, errors = Aur.packages(vcs)
+		updates, errors = [], []
+
+		for pkg in Aur.stream(vcs, errors):
+			updates.append(pkg)
+			Msg.result(pkg['name'])
 
 		for e in errors:
 			Msg.error(e)
@@ -261,13 +458,28 @@ class LocalRepo:
 			Msg.info(_('No updates found'))
 			return
 
-		Msg.result('\n'.join(updates))
-
 		if not Msg.ask(_('Upgrade?')):
 			Msg.info(_('Bye'))
 			return
 
-		LocalRepo.add([pkg['uri'] for pkg in updates.values()], force=True)
+		LocalRepo.add([pkg['uri'] for pkg in updates], force=True)
+
+	@staticmethod
+	def refresh():
+		''' Ignores cached AUR package infos '''
+		Config.set('aur-cache-ttl', 0)
+
+	@staticmethod
+	def update_snapshot():
+		''' Downloads the AUR metadata and updates the local AUR snapshot '''
+		from localrepo.aur import AurSnapshot
+
+		Msg.process(_('Updating the AUR snapshot'))
+
+		try:
+			Msg.info(_('{0} packages found').format(AurSnapshot.update()))
+		except LocalRepoError as e:
+			LocalRepo.error(e)
 
 	@staticmethod
 	def clear_cache():
@@ -281,22 +493,46 @@ class LocalRepo:
 			LocalRepo.error(e)
 
 	@staticmethod
-	def check():
-		''' Run an integrity check '''
+	def check(deep=False):
+		''' Run an integrity check, deep rehashes all packages '''
 		Msg.info(_('{0} packages found').format(len(LocalRepo._repo)))
 		Msg.process(_('Running integrity check'))
-		errors = LocalRepo._repo.check()
+		Log.log(_('Starting integrity check'))
+		errors = 0
+
+		with Log.operation('check', deep=deep):
+			for e in LocalRepo._repo.check(progress=Msg.progress, deep=deep):
+				Msg.result(e)
+				Log.error(e)
+				errors += 1
 
 		if not errors:
 			Msg.info(_('No errors found'))
 			Log.log(_('Finished integrity check without any errors'))
 			return
 
-		Log.log(_('Finished integrity check with errors:'))
+		Log.log(_('Finished integrity check with {0} errors').format(errors))
 
-		for e in errors:
-			Msg.result(e)
-			Log.error(e)
+	@staticmethod
+	def history(names):
+		''' Prints the logged changes of packages from the oldest to the newest '''
+		records = [(name, Log.history(name)) for name in names]
+
+		if LocalRepo._format:
+			LocalRepo._output(LocalRepo.HISTORY_FIELDS, (r for name, rs in records for r in rs))
+			return
+
+		for name, rs in records:
+			if not rs:
+				Msg.info(_('No history found: {0}').format(name))
+				continue
+
+			Msg.process(name)
+
+			for r in rs:
+				version = r.get('version') if not r.get('old') else '{0} -> {1}'.format(r['old'], r['version'])
+				Msg.result('{0} {1} {2}'.format(strftime('%Y-%m-%d %H:%M', localtime(r['time'])),
+				                                r.get('action'), version))
 
 	@staticmethod
 	def restore_db():
@@ -312,6 +548,8 @@ class LocalRepo:
 	@staticmethod
 	def elephant():
 		''' The elephant never forgets '''
+		from localrepo.pacman import Pacman
+
 		try:
 			Pacman.repo_elephant()
 		except LocalRepoError as e:
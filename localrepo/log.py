@@ -1,12 +1,18 @@
 # log.py
 # vim:ts=4:sw=4:noexpandtab
 
-from os import makedirs, remove
-from os.path import basename, dirname, isabs, isdir, isfile, join
-from shutil import copytree, move, rmtree
-from time import strftime
-
-from localrepo.utils import LocalRepoError
+import re
+
+from atexit import register, unregister
+from contextlib import contextmanager
+from itertools import groupby
+from json import JSONEncoder, dump, load, loads
+from operator import itemgetter
+from os import SEEK_END, listdir, makedirs, remove, rename, stat, urandom
+from os.path import basename, dirname, getmtime, getsize, isabs, isdir, isfile, join
+from time import localtime, mktime, perf_counter, strftime, strptime, time
+
+from localrepo.utils import LocalRepoError, Msg, Utils
 from localrepo.config import Config
 
 class LogError(LocalRepoError):
@@ -25,21 +31,72 @@ class PkgbuildLogError(LogError):
 
 
 class Log:
-	''' Handles Logging '''
+	''' Handles Logging. The log is plain text or JSON lines (see FORMATS). Records
+	are buffered and written at once, when the buffer is full, an operation starts
+	or ends or the log is closed, which also happens at exit. JSON logs keep an index of the records of every package next to the log, so the
+	history of a package is read without scanning the whole log. '''
 
 	#: Default log filename
 	FILENAME = '.log'
 
+	#: Supported log formats
+	FORMATS = ('text', 'json')
+
+	#: Suffix of the package index of json logs
+	INDEX = '.idx'
+
+	#: Version of the package index format
+	INDEX_VERSION = 1
+
+	#: Size of the write buffer in bytes
+	BUFFER = 64 * 1024
+
+	#: Encoder of json records
+	ENCODER = JSONEncoder(ensure_ascii=False, sort_keys=True, separators=(',', ':'))
+
 	#: Path to the log file
 	_path = None
 
 	#: Log file object
 	_file = None
 
+	#: Log format
+	_format = 'text'
+
+	#: Buffered records
+	_chunks = []
+
+	#: Size of the buffered records
+	_size = 0
+
+	#: Index entries of the buffered records [(pkgname, offset in the buffer), ...]
+	_pending = []
+
+	#: Package index {pkgname: [[filename, offset], ...], ...}
+	_index = None
+
+	#: True, if the index has unsaved changes
+	_dirty = False
+
+	#: Running operations [(id, name, start), ...]
+	_ops = []
+
+	#: Minute and timestamp of the last text record
+	_stamp = (None, None)
+
+	#: True, if the last write failed, so the failure is reported only once
+	_failed = False
+
 	@staticmethod
 	def init(repo_path):
-		''' Sets the path and opens the log file '''
+		''' Sets the path, rotates and opens the log file '''
 		Log._path = Config.get('log', Log.FILENAME)
+		Log._format = Config.get('log-format', 'text')
+		Log._chunks, Log._size, Log._pending, Log._ops = [], 0, [], []
+		Log._index, Log._dirty, Log._failed = None, False, False
+
+		if Log._format not in Log.FORMATS:
+			raise LogError(_('Unknown log format: {0}').format(Log._format))
 
 		if not isabs(Log._path):
 			Log._path = join(repo_path, Log._path)
@@ -47,31 +104,326 @@ class Log:
 		try:
 			if not isdir(dirname(Log._path)):
 				makedirs(dirname(Log._path), mode=0o755, exist_ok=True)
-			Log._file = open(Log._path, 'a')
+			Log._rotate()
+			Log._file = open(Log._path, 'ab', buffering=0)
 		except:
 			raise LogError(_('Could not open log file: {0}').format(Log._path))
 
+		# Records of a run ending with an uncaught exception must not get lost
+		unregister(Log.close)
+		register(Log.close)
+
 	@staticmethod
-	def log(msg):
-		''' Logs a message '''
+	def _started(path):
+		''' Returns the time of the first record of a log file '''
 		try:
-			Log._file.write('[{0}] {1}\n'.format(strftime('%Y-%m-%d %H:%M'), msg))
+			with open(path, 'rb') as f:
+				line = f.readline().decode('utf8')
+
+			if line.startswith('{'):
+				return loads(line)['time']
+
+			return mktime(strptime(line[1:17], '%Y-%m-%d %H:%M'))
 		except:
+			return getmtime(path)
+
+	@staticmethod
+	def _rotate():
+		''' Rotates the log, if it is larger than log-max-size MiB or its first record
+		is older than log-max-age days. The rotated log is named after the time of the
+		rotation and compressed with gzip, unless log-compress is false. '''
+		size, age = Config.get('log-max-size', 0), Config.get('log-max-age', 0)
+
+		if not isfile(Log._path):
+			return
+
+		if not (size and getsize(Log._path) >= size << 20) and \
+		   not (age and time() - Log._started(Log._path) >= age * 86400):
+			return
+
+		target = '{0}.{1}'.format(Log._path, strftime('%Y%m%d-%H%M%S'))
+
+		if isfile(target) or isfile(target + '.gz'):
+			return
+
+		index = Log._load_index() if isfile(Log._path + Log.INDEX) else None
+		rename(Log._path, target)
+
+		if Config.get('log-compress', True):
+			import gzip
+			from shutil import copyfileobj
+
+			with open(target, 'rb') as src, gzip.open(target + '.gz', 'wb') as dst:
+				copyfileobj(src, dst)
+
+			remove(target)
+			target += '.gz'
+
+		if index is not None:
+			for entries in index.values():
+				for entry in entries:
+					if entry[0] == basename(Log._path):
+						entry[0] = basename(target)
+
+			Log._dirty = True
+			Log._save_index()
+
+	@staticmethod
+	def _files():
+		''' Returns the names of the rotated logs from the oldest to the newest and the
+		name of the current log '''
+		name = basename(Log._path)
+		pattern = re.compile(re.escape(name) + r'\.[0-9]{8}-[0-9]{6}(\.gz)?$')
+		files = sorted(f for f in listdir(dirname(Log._path)) if pattern.match(f))
+		return files + [name] if isfile(Log._path) else files
+
+	@staticmethod
+	def _open(name):
+		''' Opens a current or rotated log for reading '''
+		import gzip
+
+		path = join(dirname(Log._path), name)
+		return gzip.open(path, 'rb') if name.endswith('.gz') else open(path, 'rb')
+
+	@staticmethod
+	def _scan(index, name, offset=0):
+		''' Adds the json records of a log from offset on to the index '''
+		try:
+			with Log._open(name) as f:
+				f.seek(offset)
+
+				for line in f:
+					if line.startswith(b'{') and b'"pkg":' in line:
+						try:
+							index.setdefault(loads(line.decode('utf8'))['pkg'], []).append([name, offset])
+						except (KeyError, ValueError):
+							pass
+
+					offset += len(line)
+		except OSError:
 			pass
 
 	@staticmethod
-	def error(message):
+	def _reindex():
+		''' Builds the package index from all json records of all logs '''
+		index = {}
+
+		for name in Log._files():
+			Log._scan(index, name)
+
+		return index
+
+	@staticmethod
+	def _load_index():
+		''' Loads the package index. Records appended after the index was saved, e.g.
+		by a crashed run, are added. A missing or broken index is rebuilt. '''
+		if Log._index is not None:
+			return Log._index
+
+		try:
+			with open(Log._path + Log.INDEX, encoding='utf8') as f:
+				data = load(f)
+
+			if data['version'] != Log.INDEX_VERSION:
+				raise ValueError(data['version'])
+
+			size = getsize(Log._path) if isfile(Log._path) else 0
+
+			if size < data['size']:
+				raise ValueError(size)
+
+			Log._index = data['packages']
+
+			if size > data['size']:
+				Log._scan(Log._index, basename(Log._path), data['size'])
+				Log._dirty = True
+		except:
+			Log._index, Log._dirty = Log._reindex(), True
+
+		return Log._index
+
+	@staticmethod
+	def _save_index():
+		''' Writes the package index atomically '''
+		if not Log._dirty:
+			return
+
+		path = Log._path + Log.INDEX
+		size = getsize(Log._path) if isfile(Log._path) else 0
+		mode = stat(Log._path).st_mode if isfile(Log._path) else 0o644
+
+		with Utils.atomic_write(path, mode) as tmp, open(tmp, 'w', encoding='utf8') as f:
+			dump({'version': Log.INDEX_VERSION, 'packages': Log._index, 'size': size}, f,
+			     separators=(',', ':'))
+
+		Log._dirty = False
+
+	@staticmethod
+	def _timestamp(t):
+		''' Returns the timestamp of text records, which changes once a minute '''
+		minute = int(t // 60)
+
+		if Log._stamp[0] != minute:
+			Log._stamp = (minute, strftime('%Y-%m-%d %H:%M', localtime(t)))
+
+		return Log._stamp[1]
+
+	@staticmethod
+	def _record(msg, level, fields):
+		''' Buffers a record '''
+		t = time()
+
+		if Log._format == 'json':
+			record = {k: v for k, v in fields.items() if v is not None}
+			record.update(time=round(t, 3), level=level, msg=str(msg))
+
+			if Log._ops:
+				record.setdefault('op', Log._ops[-1][0])
+
+			if 'pkg' in record:
+				Log._pending.append((record['pkg'], Log._size))
+
+			data = Log.ENCODER.encode(record) + '\n'
+		else:
+			if level == 'error':
+				msg = _('[Error] {0}').format(msg)
+
+			data = '[{0}] {1}\n'.format(Log._timestamp(t), msg)
+
+		data = data.encode('utf8')
+		Log._chunks.append(data)
+		Log._size += len(data)
+
+		if Log._size >= Log.BUFFER:
+			Log.flush()
+
+	@staticmethod
+	def log(msg, **fields):
+		''' Logs a message. Fields like pkg, version or action are stored in json
+		records only. Records with a pkg field are indexed. '''
+		try:
+			Log._record(msg, 'info', fields)
+		except:
+			pass
+
+	@staticmethod
+	def error(message, **fields):
 		''' Logs an error '''
-		Log.log(_('[Error] {0}').format(message))
+		try:
+			Log._record(message, 'error', fields)
+		except:
+			pass
+
+	@staticmethod
+	@contextmanager
+	def operation(name, **fields):
+		''' Logs the start, the end, the status and the duration of an operation in
+		json logs. Records logged during the operation get its id. '''
+		op = (urandom(6).hex(), name, perf_counter())
+		parent = Log._ops[-1][0] if Log._ops else None
+
+		if Log._format == 'json':
+			Log.log(name, event='start', op=op[0], parent=parent, **fields)
+
+		Log.flush()
+		Log._ops.append(op)
+		status = 'error'
+
+		try:
+			yield op[0]
+			status = 'ok'
+		finally:
+			if op in Log._ops:
+				Log._ops.remove(op)
+				Log._end(op, status)
+
+			Log.flush()
+
+	@staticmethod
+	def _end(op, status):
+		''' Logs the end of an operation '''
+		if Log._format == 'json':
+			fields = {'event': 'end', 'op': op[0], 'status': status,
+			          'duration': round(perf_counter() - op[2], 3)}
+			Log.log(op[1], **fields) if status == 'ok' else Log.error(op[1], **fields)
+
+	@staticmethod
+	def flush():
+		''' Writes the buffered records at once and indexes them. Records, which could
+		not be written, stay in the buffer for the next flush. '''
+		if not Log._chunks or Log._file is None:
+			return
+
+		data, pending = b''.join(Log._chunks), Log._pending
+		offset, written = 0, 0
+
+		# Load the index first, a rebuilt index must not contain the new records
+		index = Log._load_index() if pending else None
+
+		try:
+			offset = Log._file.seek(0, SEEK_END)
+
+			while written < len(data):
+				written += Log._file.write(data[written:])
+
+			Log._failed = False
+		except:
+			if not Log._failed:
+				Msg.error(_('Could not write log file: {0}').format(Log._path))
+
+			Log._failed = True
+
+		Log._chunks = [data[written:]] if written < len(data) else []
+		Log._size = len(data) - written
+		Log._pending = [(pkg, pos - written) for pkg, pos in pending if pos >= written]
+
+		if written and pending:
+			name = basename(Log._path)
+
+			for pkg, pos in (e for e in pending if e[1] < written):
+				index.setdefault(pkg, []).append([name, offset + pos])
+
+			Log._dirty = True
+
+	@staticmethod
+	def history(pkgname):
+		''' Returns the json records of a package from the oldest to the newest '''
+		Log.flush()
+		records = []
+
+		for name, entries in groupby(Log._load_index().get(pkgname, []), key=itemgetter(0)):
+			try:
+				with Log._open(name) as f:
+					for entry in entries:
+						f.seek(entry[1])
+						record = loads(f.readline().decode('utf8'))
+
+						if record.get('pkg') == pkgname:
+							records.append(record)
+			except (OSError, ValueError):
+				pass
+
+		return records
 
 	@staticmethod
 	def close():
-		''' Closes the log file '''
+		''' Ends running operations, writes the buffered records and the index and
+		closes the log file '''
+		if Log._file is None:
+			return
+
 		try:
+			while Log._ops:
+				Log._end(Log._ops.pop(), 'aborted')
+
+			Log.flush()
 			Log._file.close()
+			Log._save_index()
 		except:
 			pass
 
+		Log._file = None
+
 
 class BuildLog:
 	''' Stores build logs '''
@@ -93,6 +445,8 @@ class BuildLog:
 	@staticmethod
 	def store(pkg_name, buildlog):
 		''' Stores a buildlog '''
+		from shutil import move
+
 		path = join(BuildLog._path, pkg_name)
 
 		try:
@@ -124,6 +478,8 @@ class PkgbuildLog:
 	@staticmethod
 	def _copy(src, dst):
 		''' Copies a PKGBUILD dir from src to  dst '''
+		from shutil import copytree, rmtree
+
 		if src == dst:
 			return
 
@@ -0,0 +1,171 @@
+# metrics.py
+# vim:ts=4:sw=4:noexpandtab
+
+from contextlib import contextmanager
+from functools import wraps
+from threading import Lock
+from time import perf_counter, time
+
+from localrepo.utils import LocalRepoError, Utils
+
+class MetricsError(LocalRepoError):
+	''' Handles metrics errors '''
+	pass
+
+
+class Metrics:
+	''' Collects timers and counters of the phases of a run, like AUR requests,
+	downloads, makepkg or repo-add. Timers of parallel or nested phases overlap,
+	so their sum may exceed the run time. '''
+
+	#: Prefix of the exported metric names
+	PREFIX = 'localrepo'
+
+	#: Phase timers {phase: [calls, seconds], ...}
+	_timers = {}
+
+	#: Counters {name: value, ...}
+	_counters = {}
+
+	#: Start of the run
+	_start = perf_counter()
+
+	#: Guards the timers and counters against concurrent updates
+	_lock = Lock()
+
+	#: Running cProfile.Profile instance
+	_profiler = None
+
+	#: Path of the cProfile stats file
+	_profile = None
+
+	@staticmethod
+	def reset():
+		''' Clears all timers and counters and restarts the run '''
+		with Metrics._lock:
+			Metrics._timers, Metrics._counters = {}, {}
+			Metrics._start = perf_counter()
+
+	@staticmethod
+	def add(phase, seconds, calls=1):
+		''' Adds seconds and calls to a phase timer '''
+		with Metrics._lock:
+			timer = Metrics._timers.setdefault(phase, [0, 0.0])
+			timer[0] += calls
+			timer[1] += seconds
+
+	@staticmethod
+	def count(name, n=1):
+		''' Increases a counter '''
+		with Metrics._lock:
+			Metrics._counters[name] = Metrics._counters.get(name, 0) + n
+
+	@staticmethod
+	@contextmanager
+	def timer(phase):
+		''' Times a block as phase '''
+		start = perf_counter()
+
+		try:
+			yield
+		finally:
+			Metrics.add(phase, perf_counter() - start)
+
+	@staticmethod
+	def timed(phase):
+		''' Decorator timing every call of a function as phase '''
+		def decorator(func):
+			@wraps(func)
+			def wrapper(*args, **kwargs):
+				start = perf_counter()
+
+				try:
+					return func(*args, **kwargs)
+				finally:
+					Metrics.add(phase, perf_counter() - start)
+
+			return wrapper
+
+		return decorator
+
+	@staticmethod
+	def elapsed():
+		''' Returns the seconds since the start of the run '''
+		return perf_counter() - Metrics._start
+
+	@staticmethod
+	def phases():
+		''' Returns (phase, calls, seconds) tuples, the slowest phase first '''
+		with Metrics._lock:
+			phases = [(phase, t[0], t[1]) for phase, t in Metrics._timers.items()]
+
+		return sorted(phases, key=lambda p: (-p[2], p[0]))
+
+	@staticmethod
+	def counters():
+		''' Returns (name, value) pairs sorted by name '''
+		with Metrics._lock:
+			return sorted(Metrics._counters.items())
+
+	@staticmethod
+	def prometheus():
+		''' Returns all metrics in the Prometheus text exposition format '''
+		p = Metrics.PREFIX
+		lines = ['# HELP {0}_phase_seconds_total Seconds spent in a phase'.format(p),
+		         '# TYPE {0}_phase_seconds_total counter'.format(p)]
+		phases = sorted(Metrics.phases())
+
+		for phase, calls, seconds in phases:
+			lines.append('{0}_phase_seconds_total{{phase="{1}"}} {2:.6f}'.format(p, phase, seconds))
+
+		lines += ['# HELP {0}_phase_calls_total Number of times a phase was entered'.format(p),
+		          '# TYPE {0}_phase_calls_total counter'.format(p)]
+
+		for phase, calls, seconds in phases:
+			lines.append('{0}_phase_calls_total{{phase="{1}"}} {2}'.format(p, phase, calls))
+
+		for name, value in Metrics.counters():
+			lines += ['# TYPE {0}_{1}_total counter'.format(p, name),
+			          '{0}_{1}_total {2}'.format(p, name, value)]
+
+		lines += ['# HELP {0}_run_seconds Duration of the run'.format(p),
+		          '# TYPE {0}_run_seconds gauge'.format(p),
+		          '{0}_run_seconds {1:.6f}'.format(p, Metrics.elapsed()),
+		          '# HELP {0}_last_run_timestamp_seconds End of the run'.format(p),
+		          '# TYPE {0}_last_run_timestamp_seconds gauge'.format(p),
+		          '{0}_last_run_timestamp_seconds {1:.3f}'.format(p, time())]
+
+		return '\n'.join(lines) + '\n'
+
+	@staticmethod
+	def export(path):
+		''' Writes the metrics atomically to path, e.g. for the textfile collector
+		of the node exporter '''
+		try:
+			with Utils.atomic_write(path) as tmp, open(tmp, 'w', encoding='utf8') as f:
+				f.write(Metrics.prometheus())
+		except:
+			raise MetricsError(_('Could not write metrics: {0}').format(path))
+
+	@staticmethod
+	def profile(path):
+		''' Runs cProfile until dump is called '''
+		from cProfile import Profile
+
+		Metrics._profiler, Metrics._profile = Profile(), path
+		Metrics._profiler.enable()
+
+	@staticmethod
+	def dump():
+		''' Stops cProfile and writes its stats file, if it is running '''
+		if Metrics._profiler is None:
+			return
+
+		profiler, path = Metrics._profiler, Metrics._profile
+		Metrics._profiler = Metrics._profile = None
+		profiler.disable()
+
+		try:
+			profiler.dump_stats(path)
+		except OSError:
+			raise MetricsError(_('Could not write profile: {0}').format(path))
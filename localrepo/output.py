@@ -0,0 +1,133 @@
+# output.py
+# vim:ts=4:sw=4:noexpandtab
+
+from sys import stdout
+from json import JSONEncoder
+
+from localrepo.utils import LocalRepoError
+
+class OutputError(LocalRepoError):
+	''' Handles output errors '''
+	pass
+
+
+class Output:
+	''' Streams records in a machine-readable format into a buffered binary stream.
+	Values are written as they are, without colors and without humanizing.
+
+	  json   a JSON array of objects
+	  jsonl  one JSON object per line
+	  tsv    one line per record, the fields separated by tabs. Backslashes, tabs
+	         and newlines in values are escaped as \\\\, \\t and \\n
+	  null   every field terminated by a NUL byte, e.g. for xargs -0
+
+	Records are projected onto the given (field, type) pairs, so every record
+	has the same keys and value types, no matter where its data came from.
+	Missing values are null, false or an empty list, values that cannot be
+	converted are null.
+
+	tsv and null write the fields in their order, lists are joined by spaces,
+	booleans are 'true' or 'false' and missing values are empty. '''
+
+	#: Supported formats
+	FORMATS = ('json', 'jsonl', 'tsv', 'null')
+
+	#: Buffered output is written in chunks of this size
+	CHUNK = 64 * 1024
+
+	#: Compact JSON encoder, dumps would create a new one for every record
+	ENCODER = JSONEncoder(ensure_ascii=False, sort_keys=True, separators=(',', ':'))
+
+	#: Escapes of the tsv format
+	ESCAPES = str.maketrans({'\\': '\\\\', '\t': '\\t', '\n': '\\n', '\r': '\\r'})
+
+	def __init__(self, fmt, fields, stream=None):
+		''' Sets the format, the (field, type) pairs of the records and the binary
+		stream, which defaults to stdout '''
+		if fmt not in Output.FORMATS:
+			raise OutputError(_('Unknown output format: {0}').format(fmt))
+
+		if stream is None:
+			stdout.flush()
+			stream = stdout.buffer
+
+		self._format = fmt
+		self._fields = fields
+		self._stream = stream
+		self._chunks = []
+		self._size = 0
+		self._count = 0
+
+		if fmt == 'json':
+			self._write(b'[')
+
+	@staticmethod
+	def cast(v, t):
+		''' Converts a value into the type t of its field '''
+		if v is None:
+			return False if t is bool else [] if t is list else None
+
+		if t is list:
+			return list(v) if type(v) in (list, tuple) else [v]
+
+		try:
+			return t(v)
+		except ValueError:
+			return None
+
+	@staticmethod
+	def value(v):
+		''' Converts a value into a string for tsv and null records '''
+		if v is None:
+			return ''
+
+		if type(v) is bool:
+			return 'true' if v else 'false'
+
+		if type(v) in (list, tuple):
+			return ' '.join(str(i) for i in v)
+
+		return str(v)
+
+	def _write(self, data):
+		''' Buffers data and writes full chunks '''
+		self._chunks.append(data)
+		self._size += len(data)
+
+		if self._size >= Output.CHUNK:
+			self.flush()
+
+	def write(self, record):
+		''' Writes a record dict '''
+		record = {f: Output.cast(record.get(f), t) for f, t in self._fields}
+
+		if self._format == 'json':
+			data = (',\n' if self._count else '\n') + Output.ENCODER.encode(record)
+		elif self._format == 'jsonl':
+			data = Output.ENCODER.encode(record) + '\n'
+		elif self._format == 'tsv':
+			data = '\t'.join(Output.value(record[f]).translate(Output.ESCAPES) for f, t in self._fields) + '\n'
+		else:
+			data = ''.join(Output.value(record[f]).replace('\0', '') + '\0' for f, t in self._fields)
+
+		self._count += 1
+		self._write(data.encode('utf8'))
+
+	def flush(self):
+		''' Writes the buffered chunks '''
+		self._stream.write(b''.join(self._chunks))
+		self._stream.flush()
+		self._chunks, self._size = [], 0
+
+	def close(self):
+		''' Finishes the output and flushes it '''
+		if self._format == 'json':
+			self._write(b'\n]\n' if self._count else b']\n')
+
+		self.flush()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *args):
+		self.close()
@@ -1,21 +1,15 @@
 # package.py
 # vim:ts=4:sw=4:noexpandtab
 
-from os import listdir, remove
+from os import listdir, remove, stat
 from os.path import abspath, basename, dirname, getsize, isabs, isfile, isdir, join, normpath
-from shutil import copytree, move, rmtree
-from subprocess import call
-from hashlib import md5, sha256
-from urllib.request import urlretrieve
-from tempfile import mkdtemp
-from tarfile import is_tarfile, open as open_tarfile
-from distutils.version import LooseVersion
-
-from localrepo.pacman import Pacman, PacmanError
-from localrepo.parser import PkgbuildParser, PkginfoParser
-from localrepo.utils import Humanizer, LocalRepoError, Msg
+from time import perf_counter
+
+from localrepo.utils import Checksum, Humanizer, LocalRepoError, Msg
+from localrepo.vercmp import vercmp
 from localrepo.config import Config
 from localrepo.log import BuildLog, PkgbuildLog
+from localrepo.metrics import Metrics
 
 class PackageError(LocalRepoError):
 	''' Handles package errors '''
@@ -55,6 +49,9 @@ class Package:
 	EXT = ('.pkg.tar', '.pkg.tar.gz', '.pkg.tar.bz2', '.pkg.tar.xz')
 	# '.pkg.tar.Z' would also be possible, but it's not supported by tarfile
 
+	#: Supported protocols of remote files
+	PROTOCOLS = ('http://', 'https://', 'ftp://')
+
 	#: Tarball extensions
 	TARBALLEXT = ('.tar', '.tar.gz', '.tar.bz2')
 
@@ -79,6 +76,8 @@ class Package:
 	@staticmethod
 	def get_tmpdir():
 		''' Creates a temporary directory '''
+		from tempfile import mkdtemp
+
 		if Package.tmpdir is None or not isdir(Package.tmpdir):
 			Package.tmpdir = mkdtemp(prefix='local-repo-')
 		return Package.tmpdir
@@ -87,24 +86,44 @@ class Package:
 	def clean():
 		''' Removes the temporary directory '''
 		if Package.tmpdir is not None and isdir(Package.tmpdir):
+			from shutil import rmtree
+
 			rmtree(Package.tmpdir)
 		Package.tmpdir = None
 
 	@staticmethod
-	def from_remote_file(url, force=False):
-		''' Downloads a remote tarball and forwards it to the package builder '''
-		path = join(Package.get_tmpdir(), basename(url))
+	def is_remote(path):
+		''' Tests if a path is an url '''
+		return path.startswith(Package.PROTOCOLS)
+
+	@staticmethod
+	@Metrics.timed('download')
+	def download(urls):
+		''' Downloads several remote files at once, every file into a directory of its
+		own, and returns a dict mapping the urls to the local paths '''
+		from localrepo.download import DownloadCache, DownloadError
+		from tempfile import mkdtemp
+
+		paths = dict((url, join(mkdtemp(dir=Package.get_tmpdir()), basename(url))) for url in urls)
 
 		try:
-			urlretrieve(url, path, reporthook=Msg.progress)
-		except:
-			raise BuildError(_('Could not download file: {0}').format(url))
+			DownloadCache().fetch_all(paths.items())
+		except DownloadError as e:
+			raise BuildError(e.message)
 
-		return Package.forge(path, force=force)
+		return paths
 
 	@staticmethod
-	def from_tarball(path, force=False):
-		''' Extracts a pkgbuild tarball and forward it to the package builder '''
+	def _download(url):
+		''' Downloads a remote file into a directory of its own '''
+		return Package.download([url])[url]
+
+	@staticmethod
+	def _extract(path):
+		''' Extracts a pkgbuild tarball into a directory of its own and returns the pkgbuild dir '''
+		from tarfile import open as open_tarfile
+		from tempfile import mkdtemp
+
 		path = abspath(path)
 
 		try:
@@ -112,7 +131,7 @@ class Package:
 		except:
 			raise BuildError(_('Could not open tarball: {0}').format(path))
 
-		tmpdir = Package.get_tmpdir()
+		tmpdir = mkdtemp(dir=Package.get_tmpdir())
 		root = None
 
 		for member in archive.getmembers():
@@ -132,20 +151,44 @@ class Package:
 			elif root != _root:
 				root = False
 
-		if not root:
-			tmpdir = mkdtemp(dir=tmpdir)
-
 		try:
 			archive.extractall(tmpdir)
 			archive.close()
 		except:
 			raise BuildError(_('Could not extract tarball: {0}').format(path))
 
-		return Package.from_pkgbuild(join(tmpdir, root) if root else tmpdir, force=force)
+		return join(tmpdir, root) if root else tmpdir
+
+	@staticmethod
+	def locate(path):
+		''' Downloads and extracts path if needed and returns the path to a local
+		package file or pkgbuild dir '''
+		if Package.is_remote(path):
+			path = Package._download(path)
+
+		if path.endswith(Package.EXT) or basename(path) == Package.PKGBUILD or isdir(path):
+			return path
+
+		if path.endswith(Package.TARBALLEXT):
+			return Package._extract(path)
+
+		raise BuildError(_('Invalid file name: {0}').format(path))
+
+	@staticmethod
+	def from_remote_file(url, force=False):
+		''' Downloads a remote tarball and forwards it to the package builder '''
+		return Package.forge(Package._download(url), force=force)
+
+	@staticmethod
+	def from_tarball(path, force=False):
+		''' Extracts a pkgbuild tarball and forward it to the package builder '''
+		return Package.from_pkgbuild(Package._extract(path), force=force)
 
 	@staticmethod
 	def _process_pkgbuild(path):
 		''' Parses the PKGBUILD and stores or loads it in/from the pkgbuild dir '''
+		from localrepo.parser import PkgbuildParser
+
 		info = PkgbuildParser(path).parse()
 		path = dirname(path)
 
@@ -180,8 +223,8 @@ class Package:
 		return pkgfile
 
 	@staticmethod
-	def from_pkgbuild(path, ignore_deps=False, force=False):
-		''' Makes a package from a pkgbuild '''
+	def find_pkgbuild(path):
+		''' Returns the absolute path to the PKGBUILD in a pkgbuild dir '''
 		path = abspath(path)
 
 		if basename(path) != Package.PKGBUILD:
@@ -190,13 +233,17 @@ class Package:
 		if not isfile(path):
 			raise BuildError(_('Could not find PKGBUILD: {0}').format(path))
 
-		path, info = Package._process_pkgbuild(path)
+		return path
 
-		if not ignore_deps:
-			unresolved = Pacman.check_deps(info['depends'] + info['makedepends'])
+	@staticmethod
+	def prepare(path):
+		''' Finds and parses the PKGBUILD and returns the build dir and the info dict '''
+		return Package._process_pkgbuild(Package.find_pkgbuild(path))
 
-			if unresolved:
-				raise DependencyError(path, unresolved)
+	@staticmethod
+	def build(path, info, force=False):
+		''' Makes a package in a prepared build dir '''
+		from localrepo.pacman import Pacman, PacmanError
 
 		try:
 			Pacman.make_package(path, force=force)
@@ -210,42 +257,83 @@ class Package:
 
 		raise BuildError(_('Could not find any package: {0}').format(path))
 
+	@staticmethod
+	def from_pkgbuild(path, ignore_deps=False, force=False):
+		''' Makes a package from a pkgbuild '''
+		from localrepo.pacman import Pacman
+
+		path, info = Package.prepare(path)
+
+		if not ignore_deps:
+			unresolved = Pacman.check_deps(info['depends'] + info['makedepends'])
+
+			if unresolved:
+				raise DependencyError(path, unresolved)
+
+		return Package.build(path, info, force=force)
+
+	@staticmethod
+	def _read_pkginfo(fileobj):
+		''' Reads the PKGINFO from a package file object in stream mode '''
+		from tarfile import open as open_tarfile
+
+		with open_tarfile(fileobj=fileobj, mode='r|*') as pkg:
+			for member in pkg:
+				if member.name == Package.PKGINFO:
+					return pkg.extractfile(member).read().decode('utf8')
+
+		raise BuildError(_('Could not find package info'))
+
 	@staticmethod
 	def from_file(path):
-		''' Creates a package object from a package file '''
+		''' Creates a package object from a package file. The PKGINFO is extracted
+		and the checksums are calculated in a single pass over the file. '''
+		from localrepo.parser import PkginfoParser
+
 		path = abspath(path)
 
 		try:
-			pkg = open_tarfile(path)
+			f = open(path, 'rb')
 		except:
 			raise BuildError(_('Could not open package: {0}').format(path))
 
 		try:
-			pkginfo = pkg.extractfile('.PKGINFO').read().decode('utf8')
-		except:
-			raise BuildError(_('Could not read package info: {0}').format(path))
+			start = perf_counter()
+			checksum = Checksum(f, ('md5', 'sha256'))
+
+			try:
+				pkginfo = Package._read_pkginfo(checksum)
+			except:
+				raise BuildError(_('Could not read package info: {0}').format(path))
+
+			try:
+				checksum.drain()
+			except:
+				raise BuildError(_('Could not calculate package checksums: {0}').format(path))
+
+			Metrics.add('checksum', perf_counter() - start)
+			Metrics.count('checksum_bytes', f.tell())
 		finally:
-			pkg.close()
+			f.close()
 
-		info = PkginfoParser(pkginfo).parse()
+		parser = PkginfoParser(pkginfo)
+		info = parser.parse()
 		info['pgpsig'] = isfile(path + Package.SIGEXT)
+		digests = checksum.hexdigests()
+		info['md5sum'] = digests['md5']
+		info['sha256sum'] = digests['sha256']
 
 		try:
 			info['csize'] = getsize(path)
-			data = open(path, 'rb').read()
-			info['md5sum'] = md5(data).hexdigest()
-			info['sha256sum'] = sha256(data).hexdigest()
 		except OSError:
 			raise BuildError(_('Could not determine package size: {0}').format(path))
-		except:
-			raise BuildError(_('Could not calculate package checksums: {0}').format(path))
 
-		return Package(info['name'], info['version'], path, info)
+		return Package(info['name'], info['version'], path, info, parser.lists())
 
 	@staticmethod
 	def forge(path, force=False):
 		''' Forwards the path to an package builder '''
-		if path.startswith(('http://', 'https://', 'ftp://')):
+		if Package.is_remote(path):
 			return Package.from_remote_file(path, force=force)
 
 		if path.endswith(Package.EXT):
@@ -259,14 +347,19 @@ class Package:
 
 		raise BuildError(_('Invalid file name: {0}').format(path))
 
-	def __init__(self, name, version, path, info):
-		''' Creates new package object, additional package infos must be a dict '''
+	#: Packages are kept in large numbers, so no instance dicts
+	__slots__ = ('_name', '_version', '_filename', '_path', '_info', '_lists')
+
+	def __init__(self, name, version, path, info, lists=None):
+		''' Creates new package object, additional package infos must be a dict or a
+		callable returning the dict. The callable is called on first access. lists
+		are the multi-valued PKGINFO entries like depends. '''
 		self._name = name
 		self._version = version
 		self._filename = basename(path)
 		self._path = abspath(path)
-		self._sigfile = self._path + Package.SIGEXT
 		self._info = info
+		self._lists = lists
 
 	@property
 	def name(self):
@@ -278,6 +371,11 @@ class Package:
 		''' Return the package vesion '''
 		return self._version
 
+	@property
+	def filename(self):
+		''' Returns the filename of the package '''
+		return self._filename
+
 	@property
 	def path(self):
 		''' Return absolute the path to the package '''
@@ -286,25 +384,34 @@ class Package:
 	@property
 	def sigfile(self):
 		''' Returns the path to the signature file '''
-		return self._sigfile
+		return self._path + Package.SIGEXT
 
 	@property
 	def is_signed(self):
 		''' Am I signed? '''
 		try:
-			return bool(self._info['pgpsig'])
+			return bool(self.info['pgpsig'])
 		except:
 			return False
 
 	@property
 	def info(self):
 		''' Returns package infos '''
+		if callable(self._info):
+			self._info = self._info()
+
 		info = self._info
 		info['name'] = self._name
 		info['version'] = self._version
 		info['filename'] = self._filename
 		return info
 
+	@property
+	def lists(self):
+		''' Returns the multi-valued PKGINFO entries, which are written to the database.
+		They are only known for packages read from a package file. '''
+		return self._lists or {}
+
 	def __eq__(self, other):
 		''' Two packages are equal, if they have the same path '''
 		return self._path == other.path
@@ -317,11 +424,11 @@ class Package:
 	def has_valid_sha256sum(self):
 		''' Compares the checksum of the package file with the sum in the info dict '''
 		try:
-			if self._info['sha256sum'] is None:
+			if self.info['sha256sum'] is None:
 				return False
 
-			data = open(self._path, 'rb').read()
-			return sha256(data).hexdigest() == self._info['sha256sum']
+			with Metrics.timer('checksum'):
+				return Checksum.file(self._path)['sha256'] == self.info['sha256sum']
 		except:
 			return False
 
@@ -331,14 +438,14 @@ class Package:
 		return self._name.endswith(Package.VCS)
 
 	def has_smaller_version_than(self, version):
-		''' Compares the current package version with another one '''
-		try:
-			return LooseVersion(self._version) < LooseVersion(version)
-		except:
-			return self._version < version
+		''' Compares the current package version with another one like pacman does '''
+		return vercmp(self._version, version) < 0
 
 	def move(self, path, force=False):
-		''' Moves the package to a new location '''
+		''' Moves the package to a new location. Files with other hard links, like the
+		objects of the download cache, are copied, so they do not share an inode. '''
+		from shutil import copy2, move
+
 		path = abspath(path)
 
 		if not isdir(path):
@@ -352,8 +459,15 @@ class Package:
 		if not force and isfile(path):
 			raise PackageError(_('File already exists: {0}').format(path))
 
+		sigfile = self.sigfile
+
 		try:
-			move(self._path, path)
+			if stat(self._path).st_nlink > 1:
+				copy2(self._path, path)
+				remove(self._path)
+			else:
+				move(self._path, path)
+
 			self._path = path
 		except:
 			raise PackageError(_('Could not move package: {0} -> {1}').format(self._path, path))
@@ -361,13 +475,10 @@ class Package:
 		if not self.is_signed:
 			return
 
-		path += Package.SIGEXT
-
 		try:
-			move(self._sigfile, path)
-			self._sigfile = path
+			move(sigfile, self.sigfile)
 		except:
-			raise PackageError(_('Could not move sig file: {0} -> {1}').format(self._sigfile, path))
+			raise PackageError(_('Could not move sig file: {0} -> {1}').format(sigfile, self.sigfile))
 
 	def remove(self):
 		''' Removes the package file '''
@@ -375,8 +486,8 @@ class Package:
 			if isfile(self._path):
 				remove(self._path)
 
-			if isfile(self._sigfile):
-				remove(self._sigfile)
+			if isfile(self.sigfile):
+				remove(self.sigfile)
 		except:
 			raise PackageError(_('Could not remove package: {0}').format(self._path))
 
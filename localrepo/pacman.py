@@ -1,12 +1,14 @@
 # pacman.py
 # vim:ts=4:sw=4:noexpandtab
 
-from os import access, chdir, getuid, X_OK
+from os import access, getuid, X_OK
+from os.path import isdir
 from re import compile as compile_pattern
 from subprocess import call, check_output, CalledProcessError
 
 from localrepo.utils import LocalRepoError
 from localrepo.config import Config
+from localrepo.metrics import Metrics
 
 class PacmanError(LocalRepoError):
 	''' Handles pacman errors '''
@@ -49,18 +51,18 @@ class Pacman:
 	VERSION_SEP = compile_pattern('<|>|=')
 
 	@staticmethod
-	def call(cmd):
-		''' Calls a command '''
+	def call(cmd, cwd=None):
+		''' Calls a command, optionally in another working directory '''
 		if type(cmd) is str:
 			cmd = [cmd]
 
-		if call(cmd) is not 0:
+		if call(cmd, cwd=cwd) != 0:
 			raise PacmanCallError(' '.join(cmd))
 
 	@staticmethod
 	def _run_as_root(cmd):
 		''' Runs a command as root '''
-		if getuid() is not 0:
+		if getuid() != 0:
 			if access(Pacman.SUDO, X_OK):
 				cmd.insert(0, Pacman.SUDO)
 			else:
@@ -78,6 +80,16 @@ class Pacman:
 
 		Pacman._run_as_root(cmd)
 
+	@staticmethod
+	def install_files(paths, as_deps=False):
+		''' Installs package files '''
+		cmd = [Pacman.PACMAN, '-U'] + paths
+
+		if as_deps:
+			cmd.append('--asdeps')
+
+		Pacman._run_as_root(cmd)
+
 	@staticmethod
 	def uninstall(pkgs):
 		''' Unnstalls packages '''
@@ -95,17 +107,16 @@ class Pacman:
 			check_output(cmd)
 			return []
 		except CalledProcessError as e:
-			if e.returncode is 127:
+			if e.returncode == 127:
 				return e.output.decode('utf8').split()
 
 			raise PacmanCallError(' '.join(cmd))
 
 	@staticmethod
+	@Metrics.timed('makepkg')
 	def make_package(path, force=False):
-		''' Calls makepkg '''
-		try:
-			chdir(path)
-		except:
+		''' Calls makepkg in path, this does not change the working directory '''
+		if not isdir(path):
 			raise PacmanError(_('Could not change working directory: {0}').format(path))
 
 		cmd = [Pacman.MAKEPKG, '-d']
@@ -121,7 +132,7 @@ class Pacman:
 		else:
 			cmd.append('--nosign')
 
-		Pacman.call(cmd)
+		Pacman.call(cmd, cwd=path)
 
 	@staticmethod
 	def _repo_script(script, db, pkgs):
@@ -134,11 +145,13 @@ class Pacman:
 		Pacman.call(cmd)
 
 	@staticmethod
+	@Metrics.timed('repo-add')
 	def repo_add(db, pkgs):
 		''' Calls repo-add  '''
 		Pacman._repo_script(Pacman.REPO_ADD, db, pkgs)
 
 	@staticmethod
+	@Metrics.timed('repo-remove')
 	def repo_remove(db, pkgs):
 		''' Calls repo-remove '''
 		Pacman._repo_script(Pacman.REPO_REMOVE, db, pkgs)
@@ -146,5 +159,5 @@ class Pacman:
 	@staticmethod
 	def repo_elephant():
 		''' The elephant never forgets '''
-		if call([Pacman.REPO_ELEPHANT]) is not 0:
+		if call([Pacman.REPO_ELEPHANT]) != 0:
 			raise PacmanError(_('Ooh no! Somebody killed the repo elephant'))
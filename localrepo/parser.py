@@ -1,10 +1,16 @@
 # parser.py
 # vim:ts=4:sw=4:noexpandtab
 
+from os import makedirs, urandom
+from os.path import dirname, expanduser, join
 from re import compile as compile_pattern
+from shlex import quote
 from subprocess import check_output
+from hashlib import sha256
+from json import dump, load
 
-from localrepo.utils import LocalRepoError
+from localrepo.utils import Checksum, LocalRepoError, Utils
+from localrepo.config import Config
 
 class ParserError(LocalRepoError):
 	''' Handles parser errors '''
@@ -44,22 +50,77 @@ class PkgbuildParser(Parser):
 	#: Bash command that prints needed info 'key=val' style
 	ECHO = ' && '.join(('echo "{0}=${{{0}[@]}}"'.format(k) for k in TRANS))
 
-	def parse(self):
-		''' Parses a PKGBUILD - self._data must be the path to a PKGBUILD file'''
-		cmd = 'source {0} && source {1} && {2}'.format(PkgbuildParser.MAKEPKG_CONF, self._data,
-		                                               PkgbuildParser.ECHO)
+	#: Default path to the memo of parsed PKGBUILDs
+	MEMO = expanduser(join('~', '.cache', 'local-repo', 'pkgbuild.json'))
+
+	#: Max number of memorized PKGBUILDs, the oldest are dropped first
+	MEMO_SIZE = 4096
+
+	#: Parsed PKGBUILDs by the sha256 of their content and makepkg.conf
+	_memo = None
+
+	#: The sha256 of makepkg.conf, it does not change while running
+	_conf = None
+
+	@staticmethod
+	def _memo_path():
+		''' Returns the path to the memo file '''
+		return expanduser(Config.get('pkgbuild-cache', PkgbuildParser.MEMO))
+
+	@staticmethod
+	def _load_memo():
+		''' Loads the memo on first use. A broken memo is simply discarded. '''
+		if PkgbuildParser._memo is None:
+			try:
+				with open(PkgbuildParser._memo_path(), encoding='utf8') as f:
+					PkgbuildParser._memo = dict(load(f))
+			except:
+				PkgbuildParser._memo = {}
+
+		return PkgbuildParser._memo
+
+	@staticmethod
+	def _save_memo():
+		''' Writes the memo atomically. The memo is just a cache, so errors are ignored. '''
+		memo = PkgbuildParser._memo
+		path = PkgbuildParser._memo_path()
+
+		for key in list(memo)[:max(len(memo) - PkgbuildParser.MEMO_SIZE, 0)]:
+			del(memo[key])
 
 		try:
-			data = check_output([PkgbuildParser.BASH, '-c', cmd]).decode('utf8')
+			makedirs(dirname(path), mode=0o755, exist_ok=True)
+
+			with Utils.atomic_write(path) as tmp, open(tmp, 'w', encoding='utf8') as f:
+				dump(memo, f, separators=(',', ':'))
 		except:
-			raise ParserError(_('Could not parse PKGBUILD: {0}').format(self._data))
+			pass
+
+	@staticmethod
+	def key(path):
+		''' Returns the memo key of a PKGBUILD: the sha256 of makepkg.conf and the
+		PKGBUILD. Returns None, if the PKGBUILD is not readable. '''
+		if PkgbuildParser._conf is None:
+			try:
+				PkgbuildParser._conf = Checksum.file(PkgbuildParser.MAKEPKG_CONF)['sha256']
+			except:
+				PkgbuildParser._conf = ''
 
+		try:
+			with open(path, 'rb') as f:
+				return sha256(PkgbuildParser._conf.encode('utf8') + f.read()).hexdigest()
+		except OSError:
+			return None
+
+	@staticmethod
+	def _decode(path, data):
+		''' Builds the info dict from the output of ECHO '''
 		data = dict(PkgbuildParser.PATTERN.findall(data))
 		info = {}
 
 		for k, t in PkgbuildParser.TRANS.items():
 			if k not in data:
-				raise ParserError(_('Could not parse PKGBUILD: {0}').format(self._data))
+				raise ParserError(_('Could not parse PKGBUILD: {0}').format(path))
 
 			if t is list:
 				info[k] = data[k].split()
@@ -70,6 +131,91 @@ class PkgbuildParser(Parser):
 
 		return info
 
+	@staticmethod
+	def _copy(info):
+		''' Returns a copy of a memorized info, so callers can not change the memo '''
+		return dict((k, list(v) if type(v) is list else v) for k, v in info.items())
+
+	@staticmethod
+	def parse_all(paths):
+		''' Parses many PKGBUILDs at once and returns a dict mapping the paths to
+		their infos. Unknown PKGBUILDs are evaluated by a single bash process, which
+		sources makepkg.conf once and every PKGBUILD in its own subshell. Broken
+		PKGBUILDs are left out, parse() reports them. '''
+		memo = PkgbuildParser._load_memo()
+		infos, todo = {}, {}
+
+		for path in paths:
+			key = PkgbuildParser.key(path)
+
+			if key in memo:
+				infos[path] = PkgbuildParser._copy(memo[key])
+			elif key is not None:
+				todo[path] = key
+
+		if not todo:
+			return infos
+
+		# The script is read from stdin, so the PKGBUILDs must not read it
+		marker = urandom(16).hex()
+		script = ['source {0} || exit 1'.format(quote(PkgbuildParser.MAKEPKG_CONF)),
+		          'info() {{ ( source "$1" && {0} ) </dev/null; echo "{1} $?"; }}'.format(PkgbuildParser.ECHO, marker)]
+		script.extend('info {0}'.format(quote(path)) for path in todo)
+
+		try:
+			data = check_output([PkgbuildParser.BASH, '-s'], input='\n'.join(script).encode('utf8'))
+			data = data.decode('utf8').split(marker + ' ')
+		except:
+			return infos
+
+		# Every chunk but the first starts with the exit status of the previous PKGBUILD
+		outputs, codes = data[:1], []
+
+		for chunk in data[1:]:
+			code, sep, output = chunk.partition('\n')
+			codes.append(code)
+			outputs.append(output)
+
+		for (path, key), output, code in zip(todo.items(), outputs, codes):
+			if code != '0':
+				continue
+
+			try:
+				info = PkgbuildParser._decode(path, output)
+			except ParserError:
+				continue
+
+			memo[key] = info
+			infos[path] = PkgbuildParser._copy(info)
+
+		PkgbuildParser._save_memo()
+		return infos
+
+	def parse(self):
+		''' Parses a PKGBUILD - self._data must be the path to a PKGBUILD file. Results
+		are memorized, until the PKGBUILD or makepkg.conf changes. '''
+		key = PkgbuildParser.key(self._data)
+		memo = PkgbuildParser._load_memo()
+
+		if key in memo:
+			return PkgbuildParser._copy(memo[key])
+
+		cmd = 'source {0} && source {1} && {2}'.format(quote(PkgbuildParser.MAKEPKG_CONF),
+		                                               quote(self._data), PkgbuildParser.ECHO)
+
+		try:
+			data = check_output([PkgbuildParser.BASH, '-c', cmd]).decode('utf8')
+		except:
+			raise ParserError(_('Could not parse PKGBUILD: {0}').format(self._data))
+
+		info = PkgbuildParser._decode(self._data, data)
+
+		if key is not None:
+			memo[key] = info
+			PkgbuildParser._save_memo()
+
+		return PkgbuildParser._copy(info)
+
 
 class PkginfoParser(Parser):
 	''' The PKGINFO parser '''
@@ -88,15 +234,43 @@ class PkginfoParser(Parser):
 	         'builddate': 'builddate',
 	         'packager': 'packager'}
 
+	#: Translations of multi-valued entries from PKGINFO to local-repo, they are
+	#: only needed for the database and not part of the info
+	LISTS = {'group': 'groups',
+	         'depend': 'depends',
+	         'optdepend': 'optdepends',
+	         'makedepend': 'makedepends',
+	         'checkdepend': 'checkdepends',
+	         'conflict': 'conflicts',
+	         'provides': 'provides',
+	         'replaces': 'replaces'}
+
 	def parse(self):
 		''' Parses a PKGINFO '''
 		info = dict(PkginfoParser.PATTERN.findall(self._data))
 
 		try:
-			return {t: info[k] for k, t in PkginfoParser.TRANS.items()}
+			info = {t: info[k] for k, t in PkginfoParser.TRANS.items()}
 		except KeyError as e:
 			raise ParserError(_('Missing PKGINFO entry: {0}').format(e))
 
+		try:
+			info['isize'] = int(info['isize'])
+		except ValueError:
+			raise ParserError(_('Invalid PKGINFO entry: {0}').format('size'))
+
+		return info
+
+	def lists(self):
+		''' Parses the multi-valued entries of a PKGINFO '''
+		lists = {t: [] for t in PkginfoParser.LISTS.values()}
+
+		for k, v in PkginfoParser.PATTERN.findall(self._data):
+			if k in PkginfoParser.LISTS:
+				lists[PkginfoParser.LISTS[k]].append(v)
+
+		return lists
+
 
 class DescParser(Parser):
 	''' The database desc parser '''
@@ -114,6 +288,9 @@ class DescParser(Parser):
 	#: List of fields of which we just want to know wether they are availble or not
 	BOOL = ['pgpsig']
 
+	#: List of numeric fields
+	INT = ['csize', 'isize']
+
 	def parse(self):
 		''' Parses a desc file '''
 		info = {k.lower(): v for k, v in DescParser.PATTERN.findall(self._data)}
@@ -128,4 +305,10 @@ class DescParser(Parser):
 		for opt in DescParser.BOOL:
 			info[opt] = bool(info[opt]) if opt in info else False
 
+		try:
+			for opt in (o for o in DescParser.INT if info[o] is not None):
+				info[opt] = int(info[opt])
+		except ValueError:
+			raise ParserError(_('Invalid field: {0}').format(opt))
+
 		return info
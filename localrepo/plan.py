@@ -0,0 +1,109 @@
+# plan.py
+# vim:ts=4:sw=4:noexpandtab
+
+from os.path import abspath
+from time import time
+from json import dump, load
+
+from localrepo.utils import LocalRepoError, Utils
+from localrepo.vercmp import Version
+
+class PlanError(LocalRepoError):
+	''' Handles upgrade plan errors '''
+	pass
+
+
+class UpgradePlan:
+	''' The result of comparing the repo with the AUR. A plan can be saved as JSON,
+	reviewed and applied later without asking the AUR again. '''
+
+	#: Format version, bump it whenever the format changes
+	VERSION = 1
+
+	#: Lists of {'name', 'old', 'new', 'uri'} dicts
+	CHANGES = ('upgrades', 'downgrades')
+
+	#: Lists of package names
+	NAMES = ('missing', 'ignored')
+
+	@staticmethod
+	def create(repo, versions, infos, ignored=()):
+		''' Creates a plan in a single pass over the AUR infos. versions yields
+		(name, version) pairs of the repo, infos yields AUR package infos. Packages
+		in ignored are not compared. '''
+		local = dict((name, Version(version)) for name, version in versions)
+		ignored = set(ignored) & set(local)
+		plan = UpgradePlan(repo, ignored=sorted(ignored))
+		found = set()
+
+		for info in infos:
+			name = info['name']
+
+			if name not in local or name in ignored:
+				continue
+
+			found.add(name)
+			old = local[name]
+
+			if old < info['version']:
+				changes = plan.upgrades
+			elif old > info['version']:
+				changes = plan.downgrades
+			else:
+				continue
+
+			changes.append({'name': name, 'old': str(old), 'new': info['version'], 'uri': info['uri']})
+
+		plan.upgrades.sort(key=lambda c: c['name'])
+		plan.downgrades.sort(key=lambda c: c['name'])
+		plan.missing = sorted(set(local) - found - ignored)
+		return plan
+
+	@staticmethod
+	def load(path):
+		''' Loads a plan from a JSON file '''
+		try:
+			with open(path, encoding='utf8') as f:
+				data = load(f)
+		except:
+			raise PlanError(_('Could not load upgrade plan: {0}').format(path))
+
+		if type(data) is not dict or data.get('version') != UpgradePlan.VERSION:
+			raise PlanError(_('Invalid upgrade plan: {0}').format(path))
+
+		try:
+			lists = dict((k, list(data[k])) for k in UpgradePlan.CHANGES + UpgradePlan.NAMES)
+			return UpgradePlan(data['repo'], data['created'], **lists)
+		except:
+			raise PlanError(_('Invalid upgrade plan: {0}').format(path))
+
+	def __init__(self, repo, created=None, upgrades=None, downgrades=None, missing=None, ignored=None):
+		''' Sets the path of the repo, the creation time and the lists '''
+		self.repo = repo
+		self.created = time() if created is None else created
+		self.upgrades = upgrades or []
+		self.downgrades = downgrades or []
+		self.missing = missing or []
+		self.ignored = ignored or []
+
+	def to_dict(self):
+		''' Returns the plan as a JSON serializable dict '''
+		data = {'version': UpgradePlan.VERSION, 'repo': self.repo, 'created': self.created}
+		data.update((k, getattr(self, k)) for k in UpgradePlan.CHANGES + UpgradePlan.NAMES)
+		return data
+
+	def save(self, path):
+		''' Writes the plan atomically into a JSON file '''
+		path = abspath(path)
+
+		try:
+			with Utils.atomic_write(path) as tmp, open(tmp, 'w', encoding='utf8') as f:
+				dump(self.to_dict(), f, indent=1, sort_keys=True)
+		except:
+			raise PlanError(_('Could not save upgrade plan: {0}').format(path))
+
+	def stale(self, versions):
+		''' Returns the names of all planned upgrades, whose packages changed in the
+		repo since the plan was created. versions yields (name, version) pairs. '''
+		versions = dict(versions)
+		return [c['name'] for c in self.upgrades if versions.get(c['name']) != c['old']]
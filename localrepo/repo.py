@@ -1,16 +1,17 @@
 # repo.py
 # vim:ts=4:sw=4:noexpandtab
 
-from os import listdir, makedirs, remove
-from os.path import abspath, basename, dirname, getctime, isabs, isdir, isfile, join, normpath, splitext
-from tarfile import open as open_tarfile
-from pickle import dump as pickle, load as unpickle
+from os import cpu_count, link, listdir, makedirs, remove, rename, scandir, stat, symlink, urandom
+from os.path import abspath, basename, dirname, getctime, isabs, isdir, isfile, islink, join, normpath, splitext
+from time import time
+from contextlib import contextmanager
 
-from localrepo.pacman import Pacman, PacmanError
+from localrepo.cache import Cache, CacheError
 from localrepo.package import Package
-from localrepo.parser import DescParser, ParserError
-from localrepo.utils import Humanizer, LocalRepoError
+from localrepo.search import Index, Query
+from localrepo.utils import Checksum, Humanizer, LocalRepoError, Utils
 from localrepo.config import Config
+from localrepo.metrics import Metrics
 
 class RepoError(LocalRepoError):
 	''' Handles repo errors '''
@@ -20,9 +21,194 @@ class DbError(RepoError):
 	''' Handles database errors '''
 	pass
 
-class CacheError(RepoError):
-	''' Handles cache errors '''
-	pass
+class Database:
+	''' Writes the repo database directly, without calling repo-add '''
+
+	#: Fields of the desc file
+	DESC = (('FILENAME', 'filename'),
+	        ('NAME', 'name'),
+	        ('VERSION', 'version'),
+	        ('DESC', 'desc'),
+	        ('GROUPS', 'groups'),
+	        ('CSIZE', 'csize'),
+	        ('ISIZE', 'isize'),
+	        ('MD5SUM', 'md5sum'),
+	        ('SHA256SUM', 'sha256sum'),
+	        ('PGPSIG', 'pgpsig'),
+	        ('URL', 'url'),
+	        ('LICENSE', 'license'),
+	        ('ARCH', 'arch'),
+	        ('BUILDDATE', 'builddate'),
+	        ('PACKAGER', 'packager'),
+	        ('REPLACES', 'replaces'))
+
+	#: Fields of the depends file
+	DEPENDS = (('DEPENDS', 'depends'),
+	           ('CONFLICTS', 'conflicts'),
+	           ('PROVIDES', 'provides'),
+	           ('OPTDEPENDS', 'optdepends'),
+	           ('MAKEDEPENDS', 'makedepends'),
+	           ('CHECKDEPENDS', 'checkdepends'))
+
+	#: Filename of the depends file
+	DEPENDSFILE = 'depends'
+
+	#: Filename of the files file in the files database
+	FILESFILE = 'files'
+
+	def __init__(self, path):
+		''' Sets the path to the database file '''
+		self._path = path
+
+	@staticmethod
+	def entry_name(member):
+		''' Returns the package name of a database member like 'name-pkgver-pkgrel/desc' '''
+		return member.split('/')[0].rsplit('-', 2)[0]
+
+	@staticmethod
+	def format(info, fields):
+		''' Turns an info dict into a pacman database file '''
+		lines = []
+
+		for key, field in fields:
+			val = info.get(field)
+
+			if val is None or val is False or val == '' or val == []:
+				continue
+
+			if type(val) not in (list, tuple):
+				val = [val]
+
+			lines += ['%{0}%'.format(key)] + [str(v) for v in val] + ['']
+
+		return '\n'.join(lines) + '\n'
+
+	@staticmethod
+	def _add_file(db, name, data, mtime):
+		''' Adds a file to an open database '''
+		from io import BytesIO
+		from tarfile import TarInfo
+
+		member = TarInfo(name)
+		member.size = len(data)
+		member.mode = 0o644
+		member.mtime = mtime
+		db.addfile(member, BytesIO(data))
+
+	@staticmethod
+	def filelist(path):
+		''' Returns the files file of a package like repo-add writes it: all members
+		without the dot files at the top, directories with a trailing slash '''
+		from tarfile import open as open_tarfile
+
+		try:
+			with open_tarfile(path, 'r|*') as pkg:
+				names = set(m.name + '/' if m.isdir() else m.name for m in pkg if not m.name.startswith('.'))
+		except:
+			raise DbError(_('Could not read package files: {0}').format(path))
+
+		return '\n'.join(['%FILES%'] + sorted(names)) + '\n'
+
+	@staticmethod
+	def _add_entry(db, pkg, mtime, files=False):
+		''' Adds the desc and depends files of a package to an open database. files
+		adds the files file of the files database. '''
+		from base64 import b64encode
+		from tarfile import DIRTYPE, TarInfo
+
+		info = dict(pkg.info, **pkg.lists)
+		info['pgpsig'] = None
+
+		if pkg.is_signed:
+			with open(pkg.sigfile, 'rb') as f:
+				info['pgpsig'] = b64encode(f.read()).decode('ascii')
+
+		entry = '{0}-{1}'.format(pkg.name, pkg.version)
+		member = TarInfo(entry)
+		member.type = DIRTYPE
+		member.mode = 0o755
+		member.mtime = mtime
+		db.addfile(member)
+
+		for filename, fields in ((Repo.DESC, Database.DESC), (Database.DEPENDSFILE, Database.DEPENDS)):
+			data = Database.format(info, fields).encode('utf8')
+			Database._add_file(db, join(entry, filename), data, mtime)
+
+		if files:
+			data = Database.filelist(pkg.path).encode('utf8')
+			Database._add_file(db, join(entry, Database.FILESFILE), data, mtime)
+
+	@staticmethod
+	def read(path, wanted):
+		''' Iterates the database once in sequential order and yields (member, data)
+		for all wanted members. The data of other members is never read and data is
+		None for directories. '''
+		from tarfile import open as open_tarfile
+
+		with open_tarfile(path, 'r|*') as db:
+			for member in iter(db.next, None):
+				# Do not collect every member like getmembers() does
+				db.members = []
+
+				if wanted(member):
+					yield member, db.extractfile(member).read() if member.isfile() else None
+
+	@staticmethod
+	def _link(path, link):
+		''' Creates a database link like repo-add does '''
+		try:
+			if not islink(link) and not isfile(link):
+				symlink(basename(path), link)
+		except:
+			raise DbError(_('Could not create database link: {0}').format(link))
+
+	@staticmethod
+	def _unsign(path, link):
+		''' Removes the signature of a rewritten database and its link like repo-add
+		does, because it does not match anymore '''
+		for sig in (path + Repo.SIGEXT, link + Repo.SIGEXT):
+			try:
+				if islink(sig) or isfile(sig):
+					remove(sig)
+			except OSError:
+				raise DbError(_('Could not remove database signature: {0}').format(sig))
+
+	@staticmethod
+	def _rewrite(path, pkgs, drop, mtime, files=False):
+		''' Rewrites a database without the entries in drop and with the packages '''
+		from io import BytesIO
+		from tarfile import open as open_tarfile
+
+		try:
+			with Utils.atomic_write(path) as tmp, open_tarfile(tmp, 'w:gz') as db:
+				if isfile(path):
+					wanted = lambda m: Database.entry_name(m.name) not in drop
+
+					for member, data in Database.read(path, wanted):
+						db.addfile(member, None if data is None else BytesIO(data))
+
+				for pkg in pkgs:
+					Database._add_entry(db, pkg, mtime, files)
+		except:
+			raise DbError(_('Could not write database: {0}').format(path))
+
+	def update(self, pkgs, names=[]):
+		''' Adds and removes packages in a single rewrite of the database. The files
+		database, which repo-add of pacman >= 5 keeps next to it, is rewritten as
+		well, if it exists. Old signatures are removed, the databases are not signed. '''
+		drop = set(names) | set(pkg.name for pkg in pkgs)
+		mtime = round(time())
+		base = self._path[:-len(Repo.EXT)]
+
+		Database._rewrite(self._path, pkgs, drop, mtime)
+		Database._unsign(self._path, base + Repo.LINKEXT)
+		Database._link(self._path, base + Repo.LINKEXT)
+
+		if isfile(base + Repo.FILESEXT):
+			Database._rewrite(base + Repo.FILESEXT, pkgs, drop, mtime, files=True)
+			Database._unsign(base + Repo.FILESEXT, base + Repo.FILESLINKEXT)
+			Database._link(base + Repo.FILESEXT, base + Repo.FILESLINKEXT)
+
 
 class Repo:
 	''' A class handles a repository '''
@@ -33,12 +219,21 @@ class Repo:
 	#: Database link extension
 	LINKEXT = '.db'
 
+	#: Files database extension
+	FILESEXT = '.files.tar.gz'
+
+	#: Files database link extension
+	FILESLINKEXT = '.files'
+
 	#: Signature file extension
 	SIGEXT = '.sig'
 
 	#: Default cache filename
 	CACHE = '.cache'
 
+	#: Extension of the fingerprint index, stored next to the cache
+	FINGERPRINTEXT = '.fingerprints'
+
 	#: Filename of the description file
 	DESC = 'desc'
 
@@ -47,11 +242,15 @@ class Repo:
 		self._db = self.find_db(path)
 		self._path = dirname(self._db)
 		self._packages = {}
+		self._files = None
+		self._pending = None
 		self._cache = Config.get('cache', Repo.CACHE)
 
 		if not isabs(self._cache):
 			self._cache = join(self._path, self._cache)
 
+		self._fingerprints = self._cache + Repo.FINGERPRINTEXT
+
 	@property
 	def path(self):
 		''' Return the path to the repo '''
@@ -73,63 +272,283 @@ class Repo:
 		''' Returns a package '''
 		return self._packages[name]
 
+	def versions(self):
+		''' Yields (name, version) pairs sorted by name without loading whole packages '''
+		if type(self._packages) is Cache:
+			return self._packages.field('version')
+
+		return ((name, self._packages[name].version) for name in sorted(self._packages))
+
+	def search(self, q):
+		''' Returns the sorted names of all packages matching a query, see Query '''
+		query = Query(q)
+		return query.run(self._packages if type(self._packages) is Cache else Index(self._packages))
+
 	def add(self, pkg, force=False):
 		''' Adds a new package to the repo '''
 		if pkg.name in self:
 			if not force or self._packages[pkg.name] == pkg:
 				raise RepoError(_('Package is already in the repo: {0}').format(pkg.name))
 
-			self._packages[pkg.name].remove()
+		with self.batch():
+			self._queue(pkg.name, pkg, force)
 
-		pkg.move(self._path, force)
-		self._packages[pkg.name] = pkg
+			if pkg.name in self:
+				del(self._filenames()[self._packages[pkg.name].filename])
 
-		try:
-			Pacman.repo_add(self._db, [pkg.path])
-		except PacmanError as e:
-			self.clear_cache()
-			raise DbError(_('Could not add packages to the db: {0}').format(e.message))
-
-		self.update_cache()
+			self._packages[pkg.name] = pkg
+			self._filenames()[pkg.filename] = pkg.name
 
 	def remove(self, names):
 		''' Removes one or more packages from the repo '''
 		if type(names) is not list:
 			names = [names]
 
-		for name in (n for n in names if n in self):
-			 self[name].remove()
-			 del(self._packages[name])
+		with self.batch():
+			for name in (n for n in names if n in self):
+				self._queue(name, None)
+				del(self._filenames()[self._packages[name].filename])
+				del(self._packages[name])
+
+	@contextmanager
+	def batch(self):
+		''' Queues all adds and removes and applies them with one database update and
+		one cache write at the end. If anything fails, the repo stays untouched. '''
+		if self._pending is not None:
+			yield self
+			return
+
+		packages, files = self._packages, self._files
+		self._packages, self._files = dict(packages), dict(self._filenames())
+		self._pending = {}
 
 		try:
-			Pacman.repo_remove(self._db, names)
+			yield self
+			self._commit(self._pending)
+		except:
+			self._packages, self._files = packages, files
+			raise
+		finally:
+			self._pending = None
+
+	def _filenames(self):
+		''' Returns the filename -> package name index, it's built on first use '''
+		if self._files is None:
+			if type(self._packages) is Cache:
+				self._files = {f: name for name, f in self._packages.field('filename')}
+			else:
+				self._files = {pkg.filename: name for name, pkg in self._packages.items()}
+
+		return self._files
+
+	def _queue(self, name, pkg, force=False):
+		''' Queues a package for the next commit, None means removal '''
+		if name in self._pending:
+			orig = self._pending[name][1]
+		else:
+			orig = self._packages.get(name)
+
+		self._pending[name] = (pkg, orig, force)
+
+	def _commit(self, pending):
+		''' Moves the queued packages in and updates database and cache. All
+		destinations are checked first. Replaced and removed files are only deleted,
+		when database and cache are written, otherwise all moves are undone. '''
+		if not pending:
+			return
+
+		dests = {}
+
+		for pkg, orig, force in (p for p in pending.values() if p[0] is not None):
+			dest = join(self._path, pkg.filename)
+
+			if pkg.path != dest and not force and isfile(dest):
+				raise RepoError(_('File already exists: {0}').format(dest))
+
+			dests[dest] = pkg
+
+		pkgs = list(dests.values())
+		names = [name for name, (pkg, orig, force) in pending.items() if pkg is None and orig is not None]
+		backups, moved, created = [], [], []
+
+		try:
+			for dest, pkg in ((d, p) for d, p in dests.items() if p.path != d):
+				backups += [Repo._backup(f) for f in (dest, dest + Package.SIGEXT) if isfile(f)]
+				moved.append((pkg, dirname(pkg.path)))
+				pkg.move(self._path, True)
+
+			for db in self._dbfiles():
+				if isfile(db):
+					backups.append(Repo._backup(db, keep=True))
+				else:
+					created.append(db)
+
+			self._update_db(pkgs, names)
+			self.update_cache()
+		except:
+			for pkg, path in reversed(moved):
+				try:
+					pkg.move(path, True)
+				except LocalRepoError:
+					pass
+
+			for path in (p for p in created if isfile(p)):
+				remove(path)
+
+			for backup, path in backups:
+				rename(backup, path)
+
+			raise
+
+		# The database is written, leftovers are just reported by check
+		for backup, path in backups:
+			try:
+				remove(backup)
+			except OSError:
+				pass
+
+		for pkg, orig, force in pending.values():
+			if orig is not None and orig.path not in dests:
+				try:
+					orig.remove()
+				except LocalRepoError:
+					pass
+
+	def _dbfiles(self):
+		''' Returns the paths of the database, the files database and their signatures '''
+		base = self._db[:-len(Repo.EXT)]
+		sigs = [base + ext + Repo.SIGEXT for ext in (Repo.LINKEXT, Repo.FILESLINKEXT)]
+		return [p + ext for p in (self._db, base + Repo.FILESEXT) for ext in ('', Repo.SIGEXT)] + sigs
+
+	@staticmethod
+	def _backup(path, keep=False):
+		''' Moves a file aside, or links it, if keep is set, and returns (backup, path) '''
+		from shutil import copy2
+
+		backup = join(dirname(path), '.{0}.{1}'.format(basename(path), urandom(4).hex()))
+
+		try:
+			if not keep:
+				rename(path, backup)
+			else:
+				try:
+					link(path, backup)
+				except OSError:
+					copy2(path, backup)
+		except OSError:
+			raise RepoError(_('Could not back up file: {0}').format(path))
+
+		return backup, path
+
+	def _update_db(self, pkgs, names):
+		''' Writes added and removed packages to the database. Signed databases are
+		left to repo-add and repo-remove, because they know how to sign them. '''
+		from localrepo.pacman import Pacman, PacmanError
+
+		try:
+			if not Config.get('signdb', False):
+				Database(self._db).update(pkgs, names)
+				return
+
+			if names:
+				Pacman.repo_remove(self._db, names)
+
+			if pkgs:
+				Pacman.repo_add(self._db, [pkg.path for pkg in pkgs])
 		except PacmanError as e:
 			self.clear_cache()
-			raise DbError(_('Could not remove packages from the db: {0}').format(e.message))
+			raise DbError(_('Could not update the db: {0}').format(e.message))
+		except DbError:
+			self.clear_cache()
+			raise
 
-		self.update_cache()
+	@staticmethod
+	def _verify(pkg, known):
+		''' Verifies a package and returns (package, valid, fingerprint). The package is
+		only rehashed, if its (size, mtime, inode) fingerprint differs from the known one. '''
+		try:
+			st = stat(pkg.path)
+			expected = pkg.info['sha256sum']
+		except:
+			return pkg, False, None
+
+		fingerprint = (st.st_size, st.st_mtime_ns, st.st_ino)
+
+		if known is not None and known[:3] == fingerprint and known[3] == expected:
+			return pkg, True, known
+
+		try:
+			with Metrics.timer('checksum'):
+				sha256sum = Checksum.file(pkg.path)['sha256']
+		except:
+			return pkg, False, None
 
-	def check(self):
-		''' Runs an integrity check '''
-		errors, paths = [], []
+		return pkg, expected is not None and sha256sum == expected, fingerprint + (sha256sum,)
 
-		for pkg in self._packages.values():
-			paths.append(pkg.path)
+	def verify(self, pkgs=None, jobs=None, deep=False):
+		''' Verifies the checksums of packages (default: all) in a thread pool and
+		yields (package, valid) tuples in the order they finish. Unless deep is set,
+		only packages with changed fingerprints are rehashed. '''
+		from concurrent.futures import ThreadPoolExecutor, as_completed
 
-			if not pkg.has_valid_sha256sum:
-				errors.append(_('Package has no valid checksum: {0}').format(pkg.path))
+		if pkgs is None:
+			pkgs = list(self._packages.values())
 
-			if pkg.is_signed and not isfile(pkg.sigfile):
-				errors.append(_('Missing signature for package: {0}').format(pkg.name))
+		if jobs is None:
+			jobs = Config.get('check-jobs', cpu_count() or 1)
 
+		known = {} if deep else self.load_fingerprints()
+		fingerprints = {}
+
+		with ThreadPoolExecutor(max_workers=max(jobs, 1)) as pool:
+			futures = [pool.submit(Repo._verify, pkg, known.get(pkg.filename))
+			           for pkg in pkgs]
+
+			for future in as_completed(futures):
+				pkg, valid, fingerprint = future.result()
+
+				if fingerprint is not None:
+					fingerprints[pkg.filename] = fingerprint
+
+				yield pkg, valid
+
+		self.update_fingerprints(fingerprints)
+
+	def check(self, progress=None, deep=False):
+		''' Runs an integrity check and yields errors as soon as they are found.
+		progress is called like an urlretrieve reporthook. '''
 		try:
-			for p in (join(self._path, f) for f in listdir(self._path) if f.endswith(Package.EXT)):
-				if p not in paths:
-					errors.append(_('Package is not listed in repo database: {0}').format(p))
+			files = set(e.name for e in scandir(self._path) if e.is_file())
 		except OSError:
-			errors.append(_('Could not list directory: {0}').format(self._path))
+			yield _('Could not list directory: {0}').format(self._path)
+			files = None
+
+		pkgs = list(self._packages.values())
 
-		return errors
+		if files is not None:
+			index = self._filenames()
+
+			for f in sorted(index.keys() - files):
+				yield _('Package file is missing: {0}').format(join(self._path, f))
+
+			for pkg in (self[name] for name in index.values()):
+				if pkg.is_signed and pkg.filename + Package.SIGEXT not in files:
+					yield _('Missing signature for package: {0}').format(pkg.name)
+
+			pkgs = [pkg for pkg in pkgs if pkg.filename in files]
+
+		for i, (pkg, valid) in enumerate(self.verify(pkgs, deep=deep), 1):
+			if not valid:
+				yield _('Package has no valid checksum: {0}').format(pkg.path)
+
+			if progress:
+				progress(i, 1, len(pkgs))
+
+		if files is None:
+			return
+
+		for f in sorted(f for f in files - self._filenames().keys() if f.endswith(Package.EXT)):
+			yield _('Package is not listed in repo database: {0}').format(join(self._path, f))
 
 	def find_db(self, path):
 		''' Finds the repo database '''
@@ -159,34 +578,31 @@ class Repo:
 			self._packages = self.load_from_db()
 			self.update_cache()
 
+		self._files = None
+
 	def load_from_db(self):
 		''' Loads the package list from a repo database file '''
+		from localrepo.parser import DescParser, ParserError
+
 		if not isfile(self._db):
 			return {}
 
-		try:
-			db = open_tarfile(self._db)
-		except:
-			raise DbError(_('Could not open database: {0}').format(self._db))
-
 		packages = {}
-
-		for member in (m for m in db.getmembers() if m.isfile() and basename(m.name) == Repo.DESC):
-			try:
-				desc = db.extractfile(member).read().decode('utf8')
-				info = DescParser(desc).parse()
-			except ParserError as e:
-				raise DbError(_('Invalid db entry: {0}: {1}').format(member.name, e.message))
-			except:
-				raise DbError(_('Could not read db entry: {0}').format(member.name))
-
-			path = join(self._path, info['filename'])
-			packages[info['name']] = Package(info['name'], info['version'], path, info)
+		wanted = lambda m: m.isfile() and basename(m.name) == Repo.DESC
+		member = None
 
 		try:
-			db.close()
+			for member, desc in Database.read(self._db, wanted):
+				info = DescParser(desc.decode('utf8')).parse()
+				path = join(self._path, info['filename'])
+				packages[info['name']] = Package(info['name'], info['version'], path, info)
+		except ParserError as e:
+			raise DbError(_('Invalid db entry: {0}: {1}').format(member.name, e.message))
 		except:
-			raise DbError(_('Could not close database: {0}').format(self._db))
+			if member is None:
+				raise DbError(_('Could not open database: {0}').format(self._db))
+
+			raise DbError(_('Could not read db entry: {0}').format(member.name))
 
 		return packages
 
@@ -206,44 +622,59 @@ class Repo:
 			raise DbError(_('Could not remove database: {0}').format(self._db))
 
 		if pkgs:
-			Pacman.repo_add(self._db, pkgs)
+			self._update_db([Package.from_file(p) for p in pkgs], [])
 
 	def load_from_cache(self):
 		''' Loads the package dict from a cache file '''
 		try:
-			ctime = getctime(self._cache)
-
-			if getctime(self._db) > ctime or getctime(__file__) > ctime:
+			if getctime(self._db) > getctime(self._cache):
 				raise CacheError(_('Cache is outdated: {0}').format(self._cache))
 		except OSError:
 			raise CacheError(_('Cache is outdated: {0}').format(self._cache))
 
-		try:
-			with open(self._cache, 'rb') as f:
-				return unpickle(f)
-		except:
-			raise CacheError(_('Could not load cache: {0}').format(self._cache))
+		return Cache(self._cache, self._path)
 
+	@Metrics.timed('cache')
 	def update_cache(self):
 		''' Saves the package list in a cache file '''
 		try:
 			if not isdir(dirname(self._cache)):
 				makedirs(dirname(self._cache), mode=0o755)
 
-			with open(self._cache, 'wb') as f:
-				pickle(self._packages, f)
+			Cache.write(self._cache, self._packages, stat(self._db).st_mode if isfile(self._db) else 0o644)
 		except:
 			self.clear_cache()
 			raise CacheError(_('Could not update cache: {0}').format(self._cache))
 
 	def clear_cache(self):
-		''' Removes the cache file '''
+		''' Removes the cache file and the fingerprint index '''
 		try:
-			if isfile(self._cache):
-				remove(self._cache)
+			for path in (p for p in (self._cache, self._fingerprints) if isfile(p)):
+				remove(path)
 		except:
 			raise CacheError(_('Could not clear cache: {0}').format(self._cache))
 
+	def load_fingerprints(self):
+		''' Loads the fingerprint index, a broken or missing index is just empty '''
+		from pickle import load
+
+		try:
+			with open(self._fingerprints, 'rb') as f:
+				return load(f)
+		except:
+			return {}
+
+	def update_fingerprints(self, fingerprints):
+		''' Saves the fingerprint index. The index is just a cache like the one
+		load_fingerprints reads, so errors are ignored. '''
+		from pickle import dump
+
+		try:
+			with open(self._fingerprints, 'wb') as f:
+				dump(fingerprints, f)
+		except:
+			pass
+
 	def __str__(self):
 		''' Returns a nice string with some repo info '''
 		info = {'location': self._path,
@@ -0,0 +1,187 @@
+# search.py
+# vim:ts=4:sw=4:noexpandtab
+
+from bisect import bisect_left
+from re import compile as compile_pattern, error as PatternError
+
+from localrepo.utils import LocalRepoError
+
+class SearchError(LocalRepoError):
+	''' Handles invalid search queries '''
+	pass
+
+
+class Index:
+	''' An in-memory search index over a package dict. It answers the same lookups
+	as the index stored in the cache file: name prefixes by bisecting the sorted
+	names and tokens of the info fields by an inverted index. '''
+
+	#: Info fields in the inverted index
+	FIELDS = ('desc', 'url', 'license', 'packager')
+
+	#: Pattern matches a token: letters and digits
+	TOKEN = compile_pattern('[^\W_]+')
+
+	@staticmethod
+	def tokenize(value):
+		''' Returns the set of lower case tokens of an info value '''
+		if value is None:
+			return set()
+
+		if type(value) is list:
+			value = ' '.join(str(v) for v in value)
+
+		return set(Index.TOKEN.findall(str(value).lower()))
+
+	@staticmethod
+	def keys(info):
+		''' Returns the index keys 'field:token' of an info dict '''
+		return set('{0}:{1}'.format(f, t) for f in Index.FIELDS for t in Index.tokenize(info.get(f)))
+
+	def __init__(self, packages):
+		''' Builds the index of a package dict '''
+		self._packages = packages
+		self._names = sorted(packages)
+		self._postings = {}
+
+		for i, name in enumerate(self._names):
+			for key in Index.keys(packages[name].info):
+				self._postings.setdefault(key, []).append(i)
+
+		self._keys = sorted(self._postings)
+
+	def __iter__(self):
+		''' Returns an iterator over the sorted package names '''
+		return iter(self._names)
+
+	def __getitem__(self, name):
+		''' Returns a package '''
+		return self._packages[name]
+
+	def name(self, i):
+		''' Returns the name of the i-th package '''
+		return self._names[i]
+
+	def prefix(self, prefix):
+		''' Returns the range of package numbers, whose names start with prefix '''
+		lo = hi = bisect_left(self._names, prefix)
+
+		while hi < len(self._names) and self._names[hi].startswith(prefix):
+			hi += 1
+
+		return range(lo, hi)
+
+	def tokens(self, field, token, prefix=False):
+		''' Returns the set of package numbers, whose field contains the token or, if
+		prefix is set, a token starting with it '''
+		key = '{0}:{1}'.format(field, token)
+
+		if not prefix:
+			return set(self._postings.get(key, ()))
+
+		found, i = set(), bisect_left(self._keys, key)
+
+		while i < len(self._keys) and self._keys[i].startswith(key):
+			found.update(self._postings[self._keys[i]])
+			i += 1
+
+		return found
+
+
+class Query:
+	''' A search query. Terms are separated by whitespace and all of them must match.
+
+	  foo          name contains foo
+	  foo*         name starts with foo
+	  /regex/      name matches the regex
+	  field:foo    field contains the token foo, field is one of Index.FIELDS
+	  field:foo*   field contains a token starting with foo
+	  field:/re/   field matches the regex
+
+	name: may be used for the name terms. Tokens are case insensitive, a field
+	term with several tokens like 'packager:joe@example.com' needs all of them. '''
+
+	def __init__(self, q):
+		''' Parses the query string '''
+		self._terms = [t for term in q.split() for t in Query._parse(term)]
+
+		if not self._terms:
+			raise SearchError(_('Empty search query'))
+
+	@staticmethod
+	def _parse(term):
+		''' Splits a term into a list of (field, kind, value), kind is one of 'token',
+		'prefix', 'regex' or 'substring' '''
+		field, sep, value = term.partition(':') if not term.startswith('/') else ('', '', term)
+
+		if not sep:
+			field, value = 'name', term
+		elif field != 'name' and field not in Index.FIELDS:
+			raise SearchError(_('Unknown search field: {0}').format(field))
+
+		if len(value) > 1 and value.startswith('/') and value.endswith('/'):
+			try:
+				return [(field, 'regex', compile_pattern(value[1:-1]))]
+			except PatternError:
+				raise SearchError(_('Invalid regular expression: {0}').format(value))
+
+		prefix = value.endswith('*')
+		value = value.rstrip('*')
+
+		if not value:
+			raise SearchError(_('Invalid search term: {0}').format(term))
+
+		if field == 'name':
+			return [(field, 'prefix' if prefix else 'substring', value)]
+
+		tokens = Index.TOKEN.findall(value.lower())
+
+		if not tokens:
+			raise SearchError(_('Invalid search term: {0}').format(term))
+
+		# 'joe@example.com' needs all of its tokens, only the last one may be a prefix
+		terms = [(field, 'token', token) for token in tokens]
+		terms[-1] = field, 'prefix' if prefix else 'token', tokens[-1]
+		return terms
+
+	@staticmethod
+	def _lookup(index, field, kind, value):
+		''' Returns the package numbers matching an indexed term '''
+		if field == 'name':
+			return set(index.prefix(value))
+
+		return index.tokens(field, value, prefix=kind == 'prefix')
+
+	@staticmethod
+	def _match(index, name, field, kind, value):
+		''' Tests a term, that can not be looked up in the index '''
+		if field == 'name':
+			return value in name if kind == 'substring' else value.search(name) is not None
+
+		data = index[name].info.get(field)
+
+		if type(data) is list:
+			data = ' '.join(str(v) for v in data)
+
+		return data is not None and value.search(str(data)) is not None
+
+	def run(self, index):
+		''' Returns the sorted names matching all terms. index is an Index or a Cache.
+		Indexed terms narrow the package numbers first, names are decoded only for
+		the remaining ones and the other terms scan only them. '''
+		found = None
+		scans = []
+
+		for field, kind, value in self._terms:
+			if kind in ('token', 'prefix'):
+				ids = Query._lookup(index, field, kind, value)
+				found = ids if found is None else found & ids
+			else:
+				scans.append((field, kind, value))
+
+		names = list(index) if found is None else [index.name(i) for i in sorted(found)]
+
+		for field, kind, value in scans:
+			names = [name for name in names if Query._match(index, name, field, kind, value)]
+
+		return names
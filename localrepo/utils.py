@@ -1,6 +1,9 @@
 # utils.py
 # vim:ts=4:sw=4:noexpandtab
 
+from contextlib import contextmanager
+from os import chmod, close, remove, rename, stat
+from os.path import dirname, isfile
 from sys import stderr, stdout
 from time import gmtime, strftime
 
@@ -33,6 +36,77 @@ class Utils:
 		except:
 			return False
 
+	@staticmethod
+	@contextmanager
+	def atomic_write(path, mode=0o644):
+		''' Yields the path to a temporary file next to path. The file replaces path,
+		if the block succeeds, and is removed otherwise. It gets the mode of the
+		replaced file or mode, if there is none. '''
+		from tempfile import mkstemp
+
+		fd, tmp = mkstemp(prefix='.', dir=dirname(path) or '.')
+		close(fd)
+
+		try:
+			yield tmp
+			chmod(tmp, stat(path).st_mode if isfile(path) else mode)
+			rename(tmp, path)
+		except:
+			if isfile(tmp):
+				remove(tmp)
+			raise
+
+
+class Checksum:
+	''' Calculates checksums of a file in a single pass with constant memory. It can be
+	handed to tarfile as a file object, so the checksums are calculated while reading. '''
+
+	#: Size of the chunks read at once
+	CHUNK = 1024 * 1024
+
+	@staticmethod
+	def file(path, algorithms=('sha256',)):
+		''' Returns a dict with the hex digests of a file '''
+		with open(path, 'rb') as f:
+			checksum = Checksum(f, algorithms)
+			checksum.drain()
+
+		return checksum.hexdigests()
+
+	def __init__(self, fileobj, algorithms=('md5', 'sha256')):
+		''' Sets the file object and the hash algorithms '''
+		from hashlib import new as new_hash
+
+		self._file = fileobj
+		self._hashes = {a: new_hash(a) for a in algorithms}
+
+	def read(self, size=-1):
+		''' Reads from the file and feeds the hashes '''
+		data = self._file.read(size)
+
+		for h in self._hashes.values():
+			h.update(data)
+
+		return data
+
+	def drain(self):
+		''' Feeds the rest of the file into the hashes, reusing a single buffer '''
+		buf = bytearray(Checksum.CHUNK)
+		view = memoryview(buf)
+
+		while True:
+			n = self._file.readinto(buf)
+
+			if not n:
+				break
+
+			for h in self._hashes.values():
+				h.update(view[:n])
+
+	def hexdigests(self):
+		''' Returns a dict with the hex digests '''
+		return {a: h.hexdigest() for a, h in self._hashes.items()}
+
 
 class Msg:
 	''' A simple class with some static methods for fancy colored output '''
@@ -110,18 +184,26 @@ class Humanizer:
 	TRANS = {'arch':         _('Architecture'),
 	         'bugs':         _('Bugs'),
 	         'builddate':    _('Build Date'),
+	         'checkdepends': _('Check Depends On'),
+	         'conflicts':    _('Conflicts With'),
 	         'csize':        _('Package size'),
+	         'depends':      _('Depends On'),
 	         'desc':         _('Description'),
 	         'filename':     _('Filename'),
+	         'groups':       _('Groups'),
 	         'isize':        _('Installed size'),
 	         'last update':  _('Last update'),
 	         'license':      _('License'),
 	         'location':     _('Location'),
+	         'makedepends':  _('Make Depends On'),
 	         'md5sum':       _('MD5sum'),
 	         'name':         _('Name'),
+	         'optdepends':   _('Optional Deps'),
 	         'packager':     _('Packager'),
 	         'packages':     _('Packages'),
 	         'pgpsig':       _('Signed'),
+	         'provides':     _('Provides'),
+	         'replaces':     _('Replaces'),
 	         'sha256sum':    _('SHA256sum'),
 	         'translations': _('Translations'),
 	         'url':          _('URL'),
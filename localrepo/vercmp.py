@@ -0,0 +1,170 @@
+# vercmp.py
+# vim:ts=4:sw=4:noexpandtab
+
+from functools import lru_cache
+from string import ascii_letters, digits
+
+#: Characters, which start or continue a version segment. Like pacman, only ASCII counts.
+ALPHA = frozenset(ascii_letters)
+DIGITS = frozenset(digits)
+ALNUM = ALPHA | DIGITS
+
+#: Classes of the first character behind the compared segments, see _showdown
+END, SEP, NUM, ALPHANUM = range(4)
+
+def _segments(s):
+	''' Splits a version part into segments like pacman's rpmvercmp walks through it.
+	Returns a tuple of (separator length, is numeric, value, first char class) and the
+	trailing separators. Numeric values are ints, so leading zeros do not count. '''
+	segments, i, n = [], 0, len(s)
+
+	while i < n:
+		start = i
+
+		while i < n and s[i] not in ALNUM:
+			i += 1
+
+		if i == n:
+			return tuple(segments), s[start:]
+
+		sep, begin = i - start, i
+		chars = DIGITS if s[i] in DIGITS else ALPHA
+
+		while i < n and s[i] in chars:
+			i += 1
+
+		if chars is DIGITS:
+			segments.append((sep, True, int(s[begin:i]), NUM))
+		else:
+			segments.append((sep, False, s[begin:i], ALPHANUM))
+
+	return tuple(segments), ''
+
+def _showdown(segments, tail, i, skip):
+	''' Returns the class of the char rpmvercmp looks at after the loop. If skip is
+	set, rpmvercmp skipped the separators before it broke out of the loop. '''
+	if i < len(segments):
+		return SEP if segments[i][0] and not skip else segments[i][3]
+
+	return SEP if tail and not skip else END
+
+def _compare(a, b):
+	''' Compares two split version parts like pacman's rpmvercmp '''
+	if a == b:
+		return 0
+
+	one, tail1 = a
+	two, tail2 = b
+
+	for (sep1, num1, val1, c1), (sep2, num2, val2, c2) in zip(one, two):
+		# Different separator lengths decide, e.g. 2___a > 2_a
+		if sep1 != sep2:
+			return -1 if sep1 < sep2 else 1
+
+		# Numeric segments are always newer than alpha segments
+		if num1 != num2:
+			return 1 if num1 else -1
+
+		if val1 != val2:
+			return -1 if val1 < val2 else 1
+
+	i = min(len(one), len(two))
+
+	# The loop stops at the top, if one string ends right behind the last compared
+	# segment, otherwise it stops after skipping the separators
+	skip = (i < len(one) or tail1) and (i < len(two) or tail2)
+	c1 = _showdown(one, tail1, i, skip)
+	c2 = _showdown(two, tail2, i, skip)
+
+	if c1 == END and c2 == END:
+		return 0
+
+	# The final showdown: a remaining alpha segment never beats the end
+	if (c1 == END and c2 != ALPHANUM) or c1 == ALPHANUM:
+		return -1
+
+	return 1
+
+def rpmvercmp(a, b):
+	''' Compares two version parts like pacman's rpmvercmp and returns -1, 0 or 1 '''
+	return 0 if a == b else _compare(_segments(a), _segments(b))
+
+def parse(evr):
+	''' Splits a version in [epoch:]version[-release] like pacman's parseEVR. The
+	epoch defaults to '0', a missing release is None. '''
+	i = 0
+
+	while i < len(evr) and evr[i] in DIGITS:
+		i += 1
+
+	if evr[i:i + 1] == ':':
+		epoch, version = evr[:i] or '0', evr[i + 1:]
+	else:
+		epoch, version = '0', evr
+
+	version, sep, release = version.rpartition('-') if '-' in evr[i:] else (version, '', None)
+	return epoch, version, release
+
+@lru_cache(maxsize=65536)
+def key(evr):
+	''' Returns the split epoch, version and release of a version. The keys are
+	cached, because the same versions are compared over and over again. '''
+	epoch, version, release = parse(evr)
+	return _segments(epoch), _segments(version), None if release is None else _segments(release)
+
+def _vercmp(key1, key2):
+	''' Compares two version keys '''
+	ret = _compare(key1[0], key2[0]) or _compare(key1[1], key2[1])
+
+	if ret == 0 and key1[2] is not None and key2[2] is not None:
+		ret = _compare(key1[2], key2[2])
+
+	return ret
+
+def vercmp(a, b):
+	''' Compares two package versions like pacman's alpm_pkg_vercmp and returns -1,
+	0 or 1. The release is only compared, if both versions have one. '''
+	return 0 if a == b else _vercmp(key(a), key(b))
+
+
+class Version:
+	''' A sortable package version, compared with vercmp. Versions are not hashable,
+	because vercmp is no total order: 1.0 equals 1.0-1 and 1.0-2, but 1.0-1 does
+	not equal 1.0-2. '''
+
+	__slots__ = ('_version', '_key')
+
+	__hash__ = None
+
+	def __init__(self, version):
+		''' Sets the version string '''
+		self._version = str(version)
+		self._key = key(self._version)
+
+	def _cmp(self, other):
+		''' Compares with another version or a version string '''
+		return _vercmp(self._key, other._key if isinstance(other, Version) else key(str(other)))
+
+	def __lt__(self, other):
+		return self._cmp(other) < 0
+
+	def __le__(self, other):
+		return self._cmp(other) <= 0
+
+	def __eq__(self, other):
+		return self._cmp(other) == 0
+
+	def __ne__(self, other):
+		return self._cmp(other) != 0
+
+	def __gt__(self, other):
+		return self._cmp(other) > 0
+
+	def __ge__(self, other):
+		return self._cmp(other) >= 0
+
+	def __str__(self):
+		return self._version
+
+	def __repr__(self):
+		return 'Version({0!r})'.format(self._version)
@@ -0,0 +1,245 @@
+# test/aur.py
+# vim:ts=4:sw=4:noexpandtab
+
+import sys
+
+from gzip import compress
+from os import listdir, remove, stat
+from os.path import isfile, join
+from shutil import rmtree
+from tempfile import mkdtemp
+from tempfile import mkstemp
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from json import dumps
+from socketserver import ThreadingMixIn
+from threading import Lock, Thread
+from urllib.parse import parse_qs, urlsplit
+from unittest import TestCase, main
+
+if '..' not in sys.path:
+	sys.path.append('..')
+
+from localrepo.aur import Aur, AurCache, AurRequest, AurSnapshot
+from localrepo.config import Config
+
+
+class AurServer(ThreadingMixIn, HTTPServer):
+	''' A local stand-in for the AUR RPC interface '''
+
+	daemon_threads = True
+
+	def __init__(self):
+		super().__init__(('127.0.0.1', 0), AurHandler)
+		self.lock = Lock()
+		self.connections = set()
+		self.requests = 0
+		self.failures = 0
+		self.dump = b''
+
+
+class AurHandler(BaseHTTPRequestHandler):
+
+	protocol_version = 'HTTP/1.1'
+	disable_nagle_algorithm = True
+
+	def log_message(self, *args):
+		pass
+
+	def do_GET(self):
+		with self.server.lock:
+			self.server.connections.add(self.client_address)
+			self.server.requests += 1
+			fail = self.server.failures > 0
+			self.server.failures -= int(fail)
+
+		if self.path == AurSnapshot.DUMP:
+			self.send_response(200)
+			self.send_header('Content-Length', str(len(self.server.dump)))
+			self.end_headers()
+			self.wfile.write(self.server.dump)
+			return
+
+		if fail:
+			self.send_response(503)
+			self.send_header('Content-Length', '0')
+			self.end_headers()
+			return
+
+		query = parse_qs(urlsplit(self.path).query)
+		names = self.server.names = query.get('arg[]', [])
+		results = [{'Name': n, 'Version': '1.0-1', 'URLPath': '/packages/{0}.tar.gz'.format(n)}
+		           for n in names if not n.startswith('missing')]
+		body = dumps({'type': 'multiinfo', 'results': results}).encode('utf8')
+		self.send_response(200)
+		self.send_header('Content-Type', 'application/json')
+		self.send_header('Content-Length', str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+
+
+class AurServerTest(TestCase):
+
+	def setUp(self):
+		self.server = AurServer()
+		Thread(target=self.server.serve_forever, daemon=True).start()
+		self.host, self.backoff = AurRequest.HOST, AurRequest.BACKOFF
+		AurRequest.HOST = 'http://127.0.0.1:{0}'.format(self.server.server_address[1])
+		AurRequest.BACKOFF = 0
+		l, self.cache = mkstemp(prefix='local-repo-test-aur-')
+		remove(self.cache)
+		Config._parser.read_dict({Config.ALL: {'aur-jobs': '2', 'aur-retries': '2', 'aur-cache': self.cache}})
+
+	def tearDown(self):
+		AurRequest.pool().close()
+		AurRequest.HOST, AurRequest.BACKOFF = self.host, self.backoff
+		Config._parser.remove_section(Config.ALL)
+		self.server.shutdown()
+		self.server.server_close()
+
+		if isfile(self.cache):
+			remove(self.cache)
+
+
+class AurTest(AurServerTest):
+
+	def test_packages(self):
+		names = ['pkg{0}'.format(i) for i in range(4 * AurRequest.MAX)] + ['missing']
+		results, errors = Aur.packages(names)
+		self.assertEqual([], errors)
+		self.assertEqual(4 * AurRequest.MAX, len(results))
+		self.assertEqual('1.0-1', results['pkg0']['version'])
+		self.assertEqual(AurRequest.HOST + '/packages/pkg0.tar.gz', results['pkg0']['uri'])
+		self.assertNotIn('missing', results)
+
+	def test_stream(self):
+		Aur.packages(['cached'])
+		errors = []
+		stream = Aur.stream(['pkg{0}'.format(i) for i in range(2 * AurRequest.MAX)] + ['cached'], errors)
+		self.assertEqual('cached', next(stream)['name'])
+		self.assertEqual(1, self.server.requests)
+		self.assertEqual(2 * AurRequest.MAX, len(list(stream)))
+		self.assertEqual(3, self.server.requests)
+		self.assertEqual([], errors)
+		self.assertEqual(True, AurCache().get('pkg0')[0])
+
+	def test_stream_close(self):
+		stream = Aur.stream(['pkg{0}'.format(i) for i in range(2 * AurRequest.MAX)], [])
+		name = next(stream)['name']
+		stream.close()
+		self.assertEqual(True, AurCache().get(name)[0])
+
+	def test_keep_alive(self):
+		Config._parser.set(Config.ALL, 'aur-cache-ttl', '0')
+
+		for i in range(3):
+			Aur.packages(['pkg{0}'.format(i) for i in range(4 * AurRequest.MAX)])
+
+		self.assertEqual(12, self.server.requests)
+		self.assertLessEqual(len(self.server.connections), 2)
+
+	def test_retry(self):
+		self.server.failures = 2
+		results, errors = Aur.packages(['pkg'])
+		self.assertEqual([], errors)
+		self.assertIn('pkg', results)
+		self.assertEqual(3, self.server.requests)
+
+	def test_retry_exhausted(self):
+		self.server.failures = 3
+		results, errors = Aur.packages(['pkg'])
+		self.assertEqual({}, results)
+		self.assertEqual(1, len(errors))
+		self.assertEqual(3, self.server.requests)
+
+	def test_cache(self):
+		results, errors = Aur.packages(['pkg', 'missing'])
+		self.assertEqual(1, self.server.requests)
+		self.assertEqual(results, Aur.packages(['pkg', 'missing'])[0])
+		self.assertEqual(1, self.server.requests)
+		self.assertEqual((True, None), AurCache().get('missing'))
+		self.assertEqual(0o644, stat(self.cache).st_mode & 0o777)
+
+		Aur.packages(['pkg', 'other'])
+		self.assertEqual(2, self.server.requests)
+		self.assertEqual(['other'], self.server.names)
+
+	def test_cache_ttl(self):
+		Aur.packages(['pkg'])
+		Config._parser.set(Config.ALL, 'aur-cache-ttl', '0')
+		Aur.packages(['pkg'])
+		self.assertEqual(2, self.server.requests)
+
+	def test_cache_fallback(self):
+		Aur.packages(['pkg'])
+		Config._parser.set(Config.ALL, 'aur-cache-ttl', '0')
+		self.server.failures = 3
+		results, errors = Aur.packages(['pkg', 'other'])
+		self.assertEqual(1, len(errors))
+		self.assertEqual(['pkg'], list(results))
+
+	def test_broken_cache(self):
+		with open(self.cache, 'w') as f:
+			f.write('{"pkg": ')
+
+		results, errors = Aur.packages(['pkg'])
+		self.assertEqual([], errors)
+		self.assertIn('pkg', results)
+		self.assertEqual((True, results['pkg']), AurCache().get('pkg'))
+
+
+class AurSnapshotTest(AurServerTest):
+
+	DUMP = [{'ID': 1, 'Name': 'foo', 'Version': '1.0-1', 'URLPath': '/cgit/aur.git/snapshot/foo.tar.gz',
+	         'Description': 'A foo tool'},
+	        {'ID': 2, 'Name': 'foo-git', 'Version': 'r10.abc-1', 'URLPath': '/cgit/aur.git/snapshot/foo-git.tar.gz',
+	         'Description': None},
+	        {'ID': 3, 'Name': 'bar', 'Version': '2:0.1-2', 'URLPath': '/cgit/aur.git/snapshot/bar.tar.gz',
+	         'Description': 'Works with foo and 100% of_all bars'}]
+
+	def setUp(self):
+		super().setUp()
+		self.tmpdir = mkdtemp(prefix='local-repo-test-aur-')
+		self.snapshot = join(self.tmpdir, 'aur.sqlite')
+		self.server.dump = compress(dumps(AurSnapshotTest.DUMP).encode('utf8'))
+		Config._parser.set(Config.ALL, 'aur-snapshot', self.snapshot)
+
+	def tearDown(self):
+		super().tearDown()
+		rmtree(self.tmpdir)
+
+	def test_update(self):
+		self.assertEqual(3, AurSnapshot.update())
+		self.assertEqual(1, self.server.requests)
+		results, errors = Aur.packages(['foo', 'bar', 'pkg'])
+		self.assertEqual([], errors)
+		self.assertEqual(['bar', 'foo'], sorted(results))
+		self.assertEqual('2:0.1-2', results['bar']['version'])
+		self.assertEqual(AurRequest.HOST + '/cgit/aur.git/snapshot/foo.tar.gz', results['foo']['uri'])
+		self.assertEqual(1, self.server.requests)
+
+	def test_build(self):
+		path = join(self.tmpdir, 'dump.json')
+
+		with open(path, 'w') as f:
+			f.write(dumps(AurSnapshotTest.DUMP))
+
+		self.assertEqual(3, AurSnapshot.build(self.snapshot, path))
+		self.assertEqual(['foo-git'], list(Aur.packages(['foo-git'])[0]))
+		self.assertEqual(0o644, stat(self.snapshot).st_mode & 0o777)
+		self.assertEqual(['aur.sqlite', 'dump.json'], sorted(listdir(self.tmpdir)))
+
+	def test_search(self):
+		AurSnapshot.update()
+		self.assertEqual(['bar', 'foo', 'foo-git'], list(Aur.search('foo')[0]))
+		self.assertEqual(['bar'], list(Aur.search('0% of_')[0]))
+		self.assertEqual({}, Aur.search('%%')[0])
+
+	def test_no_snapshot(self):
+		self.assertEqual(None, AurSnapshot.open())
+		self.assertIn('pkg', Aur.packages(['pkg'])[0])
+		self.assertEqual(1, self.server.requests)
+
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,148 @@
+# test/build.py
+# vim:ts=4:sw=4:noexpandtab
+
+import sys
+
+from threading import Lock
+from time import sleep
+from unittest import TestCase, main
+
+if '..' not in sys.path:
+	sys.path.append('..')
+
+from localrepo.build import BuildScheduler, DependencyResolver
+from localrepo.package import Package, BuildError
+from localrepo.pacman import Pacman
+
+
+class BuildTestCase(TestCase):
+
+	DEPS = {'a': ['b>=1.0'],
+	        'b': [],
+	        'c': [],
+	        'd': ['a', 'glibc']}
+
+	def setUp(self):
+		self.started, self.running, self.max = [], 0, 0
+		self.lock = Lock()
+		self.orig = Package.locate, Package.find_pkgbuild, Package.prepare, Package.build
+		Package.locate = lambda path: path
+		Package.find_pkgbuild = lambda path: path
+		Package.prepare = lambda path: (path, {'name': path, 'version': '1', 'makedepends': [],
+		                                       'depends': BuildTestCase.DEPS[path]})
+		Package.build = self.build
+
+	def tearDown(self):
+		Package.locate, Package.find_pkgbuild, Package.prepare, Package.build = self.orig
+
+	def build(self, path, info, force=False):
+		with self.lock:
+			self.started.append(path)
+			self.running += 1
+			self.max = max(self.max, self.running)
+
+		sleep(0.05)
+
+		with self.lock:
+			self.running -= 1
+
+		return Package(info['name'], info['version'], '/tmp/{0}.pkg.tar.xz'.format(path), info)
+
+
+class BuildTest(BuildTestCase):
+
+	def test_order(self):
+		scheduler = BuildScheduler(['d', 'a', 'b', 'c'], jobs=4)
+		scheduler.prepare()
+		before = []
+		done = [job.name for job in scheduler.run(before=lambda job: before.append(job.name))]
+
+		self.assertEqual(sorted(before), sorted(done))
+		self.assertEqual(['a', 'b', 'c', 'd'], sorted(done))
+
+		for first, then in (('b', 'a'), ('a', 'd')):
+			self.assertLess(done.index(first), done.index(then))
+			self.assertLess(self.started.index(first), self.started.index(then))
+
+		self.assertEqual(2, self.max)
+
+	def test_serial(self):
+		scheduler = BuildScheduler(['b', 'c'], jobs=1)
+		scheduler.prepare()
+		self.assertEqual(['b', 'c'], [job.name for job in scheduler.run()])
+		self.assertEqual(1, self.max)
+
+	def test_prebuilt(self):
+		names = ['c', 'b', 'a', 'd']
+		scheduler = BuildScheduler(names)
+		scheduler.prepare()
+
+		for job in scheduler.jobs:
+			job.pkg = Package(job.name, '1', '/tmp/{0}.pkg.tar.xz'.format(job.name), {})
+
+		self.assertEqual(names, [job.name for job in scheduler.run()])
+		self.assertEqual([], self.started)
+
+	def test_circular(self):
+		BuildTestCase.DEPS['b'] = ['d']
+
+		try:
+			scheduler = BuildScheduler(['a', 'b', 'c', 'd'], jobs=2)
+			scheduler.prepare()
+			self.assertRaises(BuildError, list, scheduler.run())
+			self.assertEqual(['c'], self.started)
+		finally:
+			BuildTestCase.DEPS['b'] = []
+
+
+class DependencyResolverTest(BuildTestCase):
+
+	#: Packages of the local repo
+	REPO = {'e': Package('e', '1', '/repo/e.pkg.tar.xz', {})}
+
+	def setUp(self):
+		super().setUp()
+		self.calls = []
+		self.pacman = Pacman.check_deps, Pacman.install, Pacman.install_files
+		Pacman.check_deps = self.check_deps
+		Pacman.install = lambda pkgs, as_deps=False: self.calls.append(('-S', list(pkgs)))
+		Pacman.install_files = lambda paths, as_deps=False: self.calls.append(('-U', list(paths)))
+
+	def tearDown(self):
+		super().tearDown()
+		Pacman.check_deps, Pacman.install, Pacman.install_files = self.pacman
+
+	def check_deps(self, pkgs):
+		self.calls.append(('-T', list(pkgs)))
+		return [d for d in pkgs if Pacman.VERSION_SEP.split(d)[0] not in ('c', 'glibc')]
+
+	def test_resolve(self):
+		BuildTestCase.DEPS['c'] = ['e', 'f']
+
+		try:
+			scheduler = BuildScheduler(['d', 'a', 'b', 'c'], jobs=2)
+			scheduler.prepare()
+			resolver = DependencyResolver(scheduler.jobs, DependencyResolverTest.REPO)
+			resolver.resolve()
+			self.assertEqual(['f', 'e'], resolver.missing)
+			resolver.install()
+			list(scheduler.run(before=resolver.prepare))
+		finally:
+			BuildTestCase.DEPS['c'] = []
+
+		self.assertEqual([('-T', ['a', 'glibc', 'b>=1.0', 'e', 'f']), ('-S', ['f']),
+		                  ('-U', ['/repo/e.pkg.tar.xz'])], self.calls[:3])
+		self.assertEqual([('-U', ['/tmp/b.pkg.tar.xz']), ('-U', ['/tmp/a.pkg.tar.xz'])], self.calls[3:])
+		self.assertEqual(['f', 'e', 'b', 'a'], resolver.installed)
+
+	def test_resolved(self):
+		scheduler = BuildScheduler(['c'])
+		scheduler.prepare()
+		resolver = DependencyResolver(scheduler.jobs)
+		resolver.resolve()
+		self.assertEqual([], resolver.missing)
+		self.assertEqual([], self.calls)
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,75 @@
+# test/cache.py
+# vim:ts=4:sw=4:noexpandtab
+
+import sys
+
+from os import chmod, remove, stat
+from tempfile import mkstemp
+from unittest import TestCase, main
+
+if '..' not in sys.path:
+	sys.path.append('..')
+
+from localrepo.cache import Cache, CacheError
+from localrepo.package import Package
+
+
+class CacheTest(TestCase):
+
+	NAMES = ['zlib', 'bash', 'glibc', 'übertool', 'a']
+
+	def setUp(self):
+		l, self.path = mkstemp(prefix='local-repo-test-cache-')
+		self.packages = {}
+
+		for i, name in enumerate(CacheTest.NAMES):
+			info = {'desc': 'Package {0}'.format(name), 'csize': i, 'pgpsig': False,
+			        'url': None, 'depends': ['glibc']}
+			path = '/repo/{0}-1.{1}-1-any.pkg.tar.xz'.format(name, i)
+			self.packages[name] = Package(name, '1.{0}-1'.format(i), path, info)
+
+		Cache.write(self.path, self.packages)
+
+	def tearDown(self):
+		remove(self.path)
+
+	def test_lookup(self):
+		cache = Cache(self.path, '/repo')
+		self.assertEqual(len(CacheTest.NAMES), len(cache))
+		self.assertEqual(sorted(CacheTest.NAMES), list(cache))
+
+		for name, pkg in self.packages.items():
+			self.assertIn(name, cache)
+			self.assertEqual(pkg.path, cache[name].path)
+			self.assertEqual(pkg.info, cache[name].info)
+
+		self.assertIs(True, callable(cache['bash']._info))
+		self.assertIs(False, hasattr(cache['bash'], '__dict__'))
+		self.assertNotIn('missing', cache)
+		self.assertNotIn('zzz', cache)
+		self.assertRaises(KeyError, lambda: cache['missing'])
+		self.assertIs(None, cache.get('missing'))
+
+	def test_empty(self):
+		Cache.write(self.path, {})
+		cache = Cache(self.path, '/repo')
+		self.assertEqual(0, len(cache))
+		self.assertNotIn('bash', cache)
+
+	def test_mode(self):
+		remove(self.path)
+		Cache.write(self.path, self.packages)
+		self.assertEqual(0o644, stat(self.path).st_mode & 0o777)
+		chmod(self.path, 0o640)
+		Cache.write(self.path, self.packages, 0o600)
+		self.assertEqual(0o640, stat(self.path).st_mode & 0o777)
+
+	def test_invalid(self):
+		with open(self.path, 'wb') as f:
+			f.write(b'\x80\x03}q\x00.')
+
+		self.assertRaises(CacheError, Cache, self.path, '/repo')
+
+
+if __name__ == '__main__':
+	main()
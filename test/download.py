@@ -0,0 +1,220 @@
+# test/download.py
+# vim:ts=4:sw=4:noexpandtab
+
+import sys
+
+from hashlib import sha256
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from os import stat, walk
+from os.path import isfile, join
+from shutil import rmtree
+from socketserver import ThreadingMixIn
+from tempfile import mkdtemp
+from threading import Thread
+from unittest import TestCase, main
+
+if '..' not in sys.path:
+	sys.path.append('..')
+
+from localrepo.download import DownloadCache, DownloadError, Transfer
+
+
+class FileServer(ThreadingMixIn, HTTPServer):
+	''' Serves files from a dict with optional ETags '''
+
+	daemon_threads = True
+
+	def __init__(self):
+		super().__init__(('127.0.0.1', 0), FileHandler)
+		self.files = {}
+		self.etags = True
+		self.ranges = True
+		self.drop = None
+		self.requests = []
+
+
+class FileHandler(BaseHTTPRequestHandler):
+
+	protocol_version = 'HTTP/1.1'
+	disable_nagle_algorithm = True
+
+	def log_message(self, *args):
+		pass
+
+	def do_GET(self):
+		data = self.server.files.get(self.path)
+		etag = '"{0}"'.format(sha256(data or b'').hexdigest())
+		self.server.requests.append((self.path, self.headers.get('If-None-Match') or self.headers.get('Range')))
+		ranged = self.headers.get('Range') and self.headers.get('If-Range') in (None, etag)
+
+		if data is None:
+			self.send_response(404)
+			self.send_header('Content-Length', '0')
+			self.end_headers()
+		elif self.server.etags and self.headers.get('If-None-Match') == etag:
+			self.send_response(304)
+			self.send_header('Content-Length', '0')
+			self.end_headers()
+		elif self.server.ranges and ranged:
+			start, end = (int(i) for i in self.headers['Range'][6:].split('-'))
+			self.send_response(206)
+			self.send_header('Content-Length', str(end + 1 - start))
+			self.send_header('Content-Range', 'bytes {0}-{1}/{2}'.format(start, end, len(data)))
+			self.end_headers()
+			self.wfile.write(data[start:end + 1])
+		else:
+			self.send_response(200)
+			self.send_header('Content-Length', str(len(data)))
+
+			if self.server.etags:
+				self.send_header('ETag', etag)
+
+			if self.server.ranges:
+				self.send_header('Accept-Ranges', 'bytes')
+
+			self.end_headers()
+
+			# Simulate a dropped connection
+			if self.server.drop is not None:
+				self.wfile.write(data[:self.server.drop])
+				self.server.drop = None
+				self.close_connection = True
+				return
+
+			self.wfile.write(data)
+
+
+class DownloadCacheTest(TestCase):
+
+	def setUp(self):
+		self.server = FileServer()
+		Thread(target=self.server.serve_forever, daemon=True).start()
+		self.host = 'http://127.0.0.1:{0}'.format(self.server.server_address[1])
+		self.tmpdir = mkdtemp(prefix='local-repo-test-download-')
+		self.cache = DownloadCache(join(self.tmpdir, 'cache'), 1)
+		self.server.files['/foo.tar.gz'] = b'foo' * 1000
+
+	def tearDown(self):
+		self.server.shutdown()
+		self.server.server_close()
+		rmtree(self.tmpdir)
+
+	def fetch(self, path, name='dest'):
+		dest = join(self.tmpdir, name)
+		self.cache.fetch(self.host + path, dest)
+
+		with open(dest, 'rb') as f:
+			return f.read()
+
+	def test_fetch(self):
+		self.assertEqual(b'foo' * 1000, self.fetch('/foo.tar.gz'))
+		self.assertEqual(b'foo' * 1000, self.fetch('/foo.tar.gz', 'dest2'))
+		self.assertEqual([None, '"{0}"'.format(sha256(b'foo' * 1000).hexdigest())],
+		                 [etag for path, etag in self.server.requests])
+
+		obj = join(self.tmpdir, 'cache', 'objects', sha256(b'foo' * 1000).hexdigest()[:2],
+		           sha256(b'foo' * 1000).hexdigest())
+		self.assertEqual(stat(obj).st_ino, stat(join(self.tmpdir, 'dest2')).st_ino)
+		self.assertEqual(0o644, stat(obj).st_mode & 0o777)
+		self.assertEqual(0o644, stat(join(self.tmpdir, 'cache', DownloadCache.INDEX)).st_mode & 0o777)
+
+	def objects(self):
+		return sorted(f for d, ds, fs in walk(join(self.tmpdir, 'cache', 'objects')) for f in fs)
+
+	def test_changed(self):
+		for i in range(5):
+			self.server.files['/foo.tar.gz'] = b'foo' * 1000 + bytes([i])
+			self.assertEqual(b'foo' * 1000 + bytes([i]), self.fetch('/foo.tar.gz'))
+
+		self.assertEqual([sha256(b'foo' * 1000 + bytes([4])).hexdigest()], self.objects())
+
+	def test_changed_shared(self):
+		self.server.files['/mirror/foo.tar.gz'] = b'foo' * 1000
+		self.fetch('/foo.tar.gz')
+		self.fetch('/mirror/foo.tar.gz', 'dest2')
+		self.server.files['/foo.tar.gz'] = b'bar'
+		self.assertEqual(b'bar', self.fetch('/foo.tar.gz'))
+		self.assertEqual(sorted(sha256(d).hexdigest() for d in (b'bar', b'foo' * 1000)), self.objects())
+
+	def test_shared(self):
+		self.server.files['/mirror/foo.tar.gz'] = b'foo' * 1000
+		self.fetch('/foo.tar.gz')
+		self.fetch('/mirror/foo.tar.gz', 'dest2')
+		self.assertEqual(stat(join(self.tmpdir, 'dest')).st_ino, stat(join(self.tmpdir, 'dest2')).st_ino)
+
+	def test_concurrent_runs(self):
+		self.server.files['/bar.tar.gz'] = b'bar' * 1000
+		other = DownloadCache(join(self.tmpdir, 'cache'), 1)
+		self.fetch('/foo.tar.gz')
+		other.fetch(self.host + '/bar.tar.gz', join(self.tmpdir, 'bar'))
+		index = DownloadCache(join(self.tmpdir, 'cache'), 1)._index
+		self.assertEqual(sorted(self.host + p for p in ('/bar.tar.gz', '/foo.tar.gz')), sorted(index))
+
+	def test_size(self):
+		self.server.etags = False
+		self.fetch('/foo.tar.gz')
+		self.server.files['/foo.tar.gz'] = b'oof' * 1000
+		self.assertEqual(b'foo' * 1000, self.fetch('/foo.tar.gz'))
+		self.server.files['/foo.tar.gz'] = b'bar'
+		self.assertEqual(b'bar', self.fetch('/foo.tar.gz'))
+
+	def test_offline(self):
+		self.fetch('/foo.tar.gz')
+		del self.server.files['/foo.tar.gz']
+		self.assertEqual(b'foo' * 1000, self.fetch('/foo.tar.gz'))
+		self.assertRaises(DownloadError, self.fetch, '/missing.tar.gz')
+
+	def test_evict(self):
+		self.server.files['/a'] = b'a' * 600 * 1024
+		self.server.files['/b'] = b'b' * 600 * 1024
+		self.fetch('/a')
+		self.fetch('/foo.tar.gz')
+		self.fetch('/b')
+		cache = DownloadCache(join(self.tmpdir, 'cache'), 1)
+		self.assertEqual(None, cache._cached(self.host + '/a'))
+		self.assertNotEqual(None, cache._cached(self.host + '/foo.tar.gz'))
+		self.assertNotEqual(None, cache._cached(self.host + '/b'))
+
+	def test_resume(self):
+		self.server.drop = 1000
+		self.assertEqual(b'foo' * 1000, self.fetch('/foo.tar.gz'))
+		self.assertEqual([None, 'bytes=1000-2999'], [r for path, r in self.server.requests])
+
+	def test_resume_unsupported(self):
+		self.server.ranges = False
+		self.server.drop = 1000
+		self.assertRaises(DownloadError, self.fetch, '/foo.tar.gz')
+
+	def test_segments(self):
+		self.server.files['/big'] = bytes(range(256)) * 40
+		segment_min, Transfer.SEGMENT_MIN = Transfer.SEGMENT_MIN, 1024
+
+		try:
+			self.assertEqual(bytes(range(256)) * 40, self.fetch('/big'))
+		finally:
+			Transfer.SEGMENT_MIN = segment_min
+
+		self.assertEqual(['bytes=0-2559', 'bytes=2560-5119', 'bytes=5120-7679', 'bytes=7680-10239'],
+		                 sorted(r for path, r in self.server.requests[1:]))
+
+	def test_fetch_all(self):
+		downloads = []
+
+		for i in range(10):
+			self.server.files['/{0}'.format(i)] = str(i).encode('utf8') * 100
+			downloads.append((self.host + '/{0}'.format(i), join(self.tmpdir, str(i))))
+
+		self.assertEqual([dest for url, dest in downloads], self.cache.fetch_all(downloads))
+
+		for i in range(10):
+			with open(join(self.tmpdir, str(i)), 'rb') as f:
+				self.assertEqual(str(i).encode('utf8') * 100, f.read())
+
+	def test_disabled(self):
+		self.cache = DownloadCache(join(self.tmpdir, 'cache'), 0)
+		self.assertEqual(b'foo' * 1000, self.fetch('/foo.tar.gz'))
+		self.assertEqual(False, isfile(join(self.tmpdir, 'cache', DownloadCache.INDEX)))
+
+
+if __name__ == '__main__':
+	main()
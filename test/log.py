@@ -3,7 +3,8 @@
 
 import sys
 
-from os.path import basename, join, isdir, isfile
+from os import listdir, makedirs, remove, stat
+from os.path import basename, dirname, join, isdir, isfile
 from tempfile import mkdtemp, mkstemp
 from shutil import rmtree
 from unittest import TestCase, main
@@ -11,8 +12,13 @@ from unittest import TestCase, main
 if '..' not in sys.path:
 	sys.path.append('..')
 
+import gzip
+
+from json import loads
+
 from localrepo.config import Config
 from localrepo.log import Log, BuildLog, PkgbuildLog
+from localrepo.utils import Msg
 
 
 class LogTest(TestCase):
@@ -29,8 +35,13 @@ class LogTest(TestCase):
 		Config.set('pkgbuild', self.pkgbuild)
 
 	def tearDown(self):
+		Config._parser.remove_section(Config.ALL)
 		rmtree(self.repo)
 
+	def json_log(self, **options):
+		Config._parser.read_dict({Config.ALL: dict({'log-format': 'json'}, **options)})
+		Log.init(self.repo)
+
 	def test_log(self, error=False):
 		msgs = ['Hello!', 'This is just a test...', 'Everything is fine... hopefully']
 		Log.init(self.repo)
@@ -54,6 +65,116 @@ class LogTest(TestCase):
 	def test_error(self):
 		self.test_log(error=True)
 
+	def test_json(self):
+		self.json_log()
+
+		with Log.operation('add') as op:
+			Log.log('Added Package: pkg1 1.0-1', pkg='pkg1', version='1.0-1', action='add')
+			Log.error('Oops')
+
+		Log.close()
+
+		with open(self.log) as f:
+			records = [loads(line) for line in f]
+
+		self.assertEqual(['start', None, None, 'end'], [r.get('event') for r in records])
+		self.assertEqual([op] * 4, [r['op'] for r in records])
+		self.assertEqual(['info', 'info', 'error', 'info'], [r['level'] for r in records])
+		self.assertEqual('pkg1', records[1]['pkg'])
+		self.assertEqual('Oops', records[2]['msg'])
+		self.assertEqual('ok', records[3]['status'])
+		self.assertGreaterEqual(records[3]['duration'], 0)
+
+	def test_buffer(self):
+		Log.init(self.repo)
+		Log.log('Hello!')
+		self.assertEqual(0, len(open(self.log).read()))
+		Log.flush()
+		self.assertRegex(open(self.log).read(), 'Hello!\n$')
+		Log.close()
+
+	def test_operation_flush(self):
+		self.json_log()
+
+		with Log.operation('add'):
+			self.assertEqual(['start'], [loads(l)['event'] for l in open(self.log)])
+			Log.log('Added Package: pkg1 1.0-1', pkg='pkg1')
+
+		self.assertEqual(3, len(open(self.log).readlines()))
+		Log.close()
+
+	def test_flush_error(self):
+		Log.init(self.repo)
+		Log.log('Hello!')
+		f, Log._file = Log._file, open(self.log, 'rb')
+		errors, error = [], Msg.error
+		Msg.error = lambda *args: errors.append(args)
+
+		try:
+			Log.flush()
+			Log.flush()
+		finally:
+			Msg.error = error
+			Log._file.close()
+			Log._file = f
+
+		self.assertEqual(1, len(errors))
+		self.assertEqual(0, len(open(self.log).read()))
+		Log.close()
+		self.assertRegex(open(self.log).read(), 'Hello!\n$')
+
+	def test_history(self):
+		self.json_log()
+
+		for version in ('1.0-1', '1.1-1'):
+			Log.log('Added Package', pkg='pkg1', version=version, action='upgrade')
+			Log.log('Added Package', pkg='pkg2', version='2.0-1', action='add')
+
+		self.assertEqual(['1.0-1', '1.1-1'], [r['version'] for r in Log.history('pkg1')])
+		Log.close()
+		self.assertEqual(stat(self.log).st_mode, stat(self.log + Log.INDEX).st_mode)
+
+		Log.init(self.repo)
+		self.assertEqual(['2.0-1', '2.0-1'], [r['version'] for r in Log.history('pkg2')])
+		self.assertEqual([], Log.history('pkg3'))
+		Log.close()
+
+		remove(self.log + Log.INDEX)
+		Log.init(self.repo)
+		self.assertEqual(['1.0-1', '1.1-1'], [r['version'] for r in Log.history('pkg1')])
+		Log.close()
+
+		with open(self.log, 'a') as f:
+			f.write('{"time":0,"pkg":"pkg1","version":"1.2-1"}\n')
+
+		Log.init(self.repo)
+		self.assertEqual(['1.0-1', '1.1-1', '1.2-1'], [r['version'] for r in Log.history('pkg1')])
+		Log.close()
+
+	def test_rotate(self):
+		makedirs(dirname(self.log))
+
+		with open(self.log, 'w') as f:
+			f.write('{"time":0,"pkg":"pkg1","version":"1.0-1"}\n')
+
+		self.json_log(**{'log-max-age': 0})
+		Log.close()
+		self.assertEqual(['path'], sorted(listdir(dirname(self.log))))
+
+		self.json_log(**{'log-max-age': 1})
+		Log.log('Added Package', pkg='pkg1', version='1.1-1', action='upgrade')
+		Log.close()
+
+		rotated = [f for f in listdir(dirname(self.log)) if f.endswith('.gz')]
+		self.assertEqual(1, len(rotated))
+
+		with gzip.open(join(dirname(self.log), rotated[0]), 'rt') as f:
+			self.assertIn('1.0-1', f.read())
+
+		Log.init(self.repo)
+		self.assertEqual(['1.0-1', '1.1-1'], [r['version'] for r in Log.history('pkg1')])
+		Log.close()
+
 	def test_store_buildlog(self):
 		BuildLog.init(self.repo)
 
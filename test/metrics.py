@@ -0,0 +1,99 @@
+# test/metrics.py
+# vim:ts=4:sw=4:noexpandtab
+
+import sys
+
+from os import stat
+from os.path import isfile, join
+from pstats import Stats
+from shutil import rmtree
+from tempfile import mkdtemp
+from unittest import TestCase, main
+
+if '..' not in sys.path:
+	sys.path.append('..')
+
+from localrepo.download import DownloadCache
+from localrepo.metrics import Metrics, MetricsError
+from localrepo.package import Package
+
+
+class MetricsTest(TestCase):
+
+	def setUp(self):
+		self.tmpdir = mkdtemp(prefix='local-repo-test-metrics-')
+		Metrics.reset()
+
+	def tearDown(self):
+		rmtree(self.tmpdir)
+
+	def test_timers(self):
+		@Metrics.timed('makepkg')
+		def make(fail=False):
+			if fail:
+				raise ValueError()
+
+			return 'pkg'
+
+		self.assertEqual('pkg', make())
+		self.assertRaises(ValueError, make, fail=True)
+
+		with Metrics.timer('cache'):
+			pass
+
+		Metrics.add('aur', 10.0, calls=3)
+		self.assertEqual([('aur', 3, 10.0)], Metrics.phases()[:1])
+		self.assertEqual(['aur', 'cache', 'makepkg'], sorted(p[0] for p in Metrics.phases()))
+		self.assertEqual(2, dict((p[0], p[1]) for p in Metrics.phases())['makepkg'])
+
+	def test_counters(self):
+		Metrics.count('aur_packages')
+		Metrics.count('aur_packages', 2)
+		Metrics.count('checksum_bytes', 1024)
+		self.assertEqual([('aur_packages', 3), ('checksum_bytes', 1024)], Metrics.counters())
+
+	def test_prometheus(self):
+		Metrics.add('repo-add', 1.5)
+		Metrics.count('aur_packages', 4)
+		lines = Metrics.prometheus().splitlines()
+		self.assertIn('# TYPE localrepo_phase_seconds_total counter', lines)
+		self.assertIn('localrepo_phase_seconds_total{phase="repo-add"} 1.500000', lines)
+		self.assertIn('localrepo_phase_calls_total{phase="repo-add"} 1', lines)
+		self.assertIn('localrepo_aur_packages_total 4', lines)
+		self.assertRegex(Metrics.prometheus(), '\nlocalrepo_run_seconds [0-9.]+\n')
+
+	def test_export(self):
+		path = join(self.tmpdir, 'localrepo.prom')
+		Metrics.add('cache', 0.25)
+		Metrics.export(path)
+
+		with open(path) as f:
+			self.assertIn('localrepo_phase_seconds_total{phase="cache"} 0.250000\n', f.read())
+
+		self.assertEqual(0o644, stat(path).st_mode & 0o777)
+		self.assertRaises(MetricsError, Metrics.export, join(self.tmpdir, 'missing', 'localrepo.prom'))
+
+	def test_download(self):
+		fetch_all = DownloadCache.fetch_all
+		DownloadCache.fetch_all = lambda self, items: None
+
+		try:
+			Package._download('http://example.com/foo-1.0-1-any.pkg.tar.xz')
+		finally:
+			DownloadCache.fetch_all = fetch_all
+			Package.clean()
+
+		self.assertEqual([('download', 1)], [p[:2] for p in Metrics.phases()])
+
+	def test_profile(self):
+		path = join(self.tmpdir, 'localrepo.prof')
+		Metrics.profile(path)
+		sorted(range(1000))
+		Metrics.dump()
+		self.assertIs(True, isfile(path))
+		self.assertGreater(Stats(path).total_calls, 0)
+		Metrics.dump()
+
+
+if __name__ == '__main__':
+	main()
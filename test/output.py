@@ -0,0 +1,78 @@
+# test/output.py
+# vim:ts=4:sw=4:noexpandtab
+
+import sys
+
+from io import BytesIO
+from json import loads
+from unittest import TestCase, main
+
+if '..' not in sys.path:
+	sys.path.append('..')
+
+from localrepo.output import Output, OutputError
+
+
+class OutputTest(TestCase):
+
+	RECORDS = [{'name': 'foo', 'version': '1.0-1', 'depends': ['bar', 'baz'], 'pgpsig': False},
+	           {'name': 'über', 'version': '2.0-1', 'desc': 'Tab\there\nand a \\', 'url': None}]
+
+	FIELDS = (('name', str), ('version', str), ('depends', list), ('pgpsig', bool), ('desc', str))
+
+	PROJECTED = [{'name': 'foo', 'version': '1.0-1', 'depends': ['bar', 'baz'], 'pgpsig': False, 'desc': None},
+	             {'name': 'über', 'version': '2.0-1', 'depends': [], 'pgpsig': False, 'desc': 'Tab\there\nand a \\'}]
+
+	def output(self, fmt, records=RECORDS):
+		stream = BytesIO()
+
+		with Output(fmt, OutputTest.FIELDS, stream) as out:
+			for record in records:
+				out.write(record)
+
+		return stream.getvalue()
+
+	def test_json(self):
+		self.assertEqual(OutputTest.PROJECTED, loads(self.output('json').decode('utf8')))
+		self.assertEqual([], loads(self.output('json', []).decode('utf8')))
+
+	def test_jsonl(self):
+		lines = self.output('jsonl').decode('utf8').splitlines()
+		self.assertEqual(OutputTest.PROJECTED, [loads(l) for l in lines])
+		self.assertEqual(b'', self.output('jsonl', []))
+
+	def test_tsv(self):
+		self.assertEqual('foo\t1.0-1\tbar baz\tfalse\t\n'
+		                 'über\t2.0-1\t\tfalse\tTab\\there\\nand a \\\\\n', self.output('tsv').decode('utf8'))
+
+	def test_null(self):
+		self.assertEqual('foo\x001.0-1\x00bar baz\x00false\x00\x00'
+		                 'über\x002.0-1\x00\x00false\x00Tab\there\nand a \\\x00', self.output('null').decode('utf8'))
+
+	def test_types(self):
+		fields = (('name', str), ('csize', int), ('depends', list))
+		records = [{'name': 'foo', 'csize': '300', 'depends': ('bar',), 'isize': 1},
+		           {'name': 'bar', 'csize': 300, 'url': None},
+		           {'name': 'baz', 'csize': 'huge', 'depends': 'foo'}]
+		stream = BytesIO()
+
+		with Output('jsonl', fields, stream) as out:
+			for record in records:
+				out.write(record)
+
+		self.assertEqual([{'name': 'foo', 'csize': 300, 'depends': ['bar']},
+		                  {'name': 'bar', 'csize': 300, 'depends': []},
+		                  {'name': 'baz', 'csize': None, 'depends': ['foo']}],
+		                 [loads(l) for l in stream.getvalue().decode('utf8').splitlines()])
+
+	def test_chunks(self):
+		records = [{'name': 'package-{0}'.format(i), 'version': '1.0-1'} for i in range(10000)]
+		lines = self.output('jsonl', records).decode('utf8').splitlines()
+		self.assertEqual(records, [{'name': r['name'], 'version': r['version']} for r in map(loads, lines)])
+
+	def test_invalid(self):
+		self.assertRaises(OutputError, Output, 'xml', OutputTest.FIELDS, BytesIO())
+
+
+if __name__ == '__main__':
+	main()
@@ -15,7 +15,7 @@ class PacmanTest(TestCase):
 	cmd = ''
 
 	@staticmethod
-	def call(cmd):
+	def call(cmd, cwd=None):
 		PacmanTest.cmd = ' '.join(cmd)
 
 	def setUp(self):
@@ -29,6 +29,14 @@ class PacmanTest(TestCase):
 
 		self.assertIn(PacmanTest.cmd, cmds)
 
+	def test_install_files(self):
+		Pacman.install_files(['/tmp/pkg1.pkg.tar.xz'], as_deps=True)
+
+		cmds = ['/usr/bin/sudo /usr/bin/pacman -U /tmp/pkg1.pkg.tar.xz --asdeps',
+		        '/bin/su -c \'/usr/bin/pacman -U /tmp/pkg1.pkg.tar.xz --asdeps\'']
+
+		self.assertIn(PacmanTest.cmd, cmds)
+
 	def test_check_deps(self):
 		self.assertEqual(['pkg1', 'pkg2'], Pacman.check_deps(['pkg1', 'pkg2', 'pacman']))
 		self.assertEqual([], Pacman.check_deps(['pacman']))
@@ -4,13 +4,16 @@
 import sys
 
 from os import remove
-from tempfile import mkstemp
+from os.path import join
+from shutil import rmtree
+from tempfile import mkdtemp, mkstemp
 from unittest import TestCase, main
 
 if '..' not in sys.path:
 	sys.path.append('..')
 
 from localrepo.parser import PkgbuildParser, PkginfoParser, DescParser, ParserError
+from localrepo.config import Config
 
 
 class ParserTest(TestCase):
@@ -104,6 +107,76 @@ ushi <martin.kalcher@gmail.com>
 local-repo
 '''
 
+	INFO = {'depends': ['tar', 'pacman', 'python', 'huiii'],
+	        'version': '1.6.2',
+	        'makedepends': ['gettext'],
+	        'name': 'local-repo'}
+
+	def setUp(self):
+		self.tmpdir = mkdtemp(prefix='local-repo-test-parser-')
+		self.conf = PkgbuildParser.MAKEPKG_CONF
+		PkgbuildParser.MAKEPKG_CONF = join(self.tmpdir, 'makepkg.conf')
+		PkgbuildParser._memo = PkgbuildParser._conf = None
+		Config._parser.read_dict({Config.ALL: {'pkgbuild-cache': join(self.tmpdir, 'pkgbuild.json')}})
+
+		with open(PkgbuildParser.MAKEPKG_CONF, 'w') as f:
+			f.write('CARCH=any\n')
+
+	def tearDown(self):
+		PkgbuildParser.MAKEPKG_CONF = self.conf
+		PkgbuildParser._memo = PkgbuildParser._conf = None
+		Config._parser.remove_section(Config.ALL)
+		rmtree(self.tmpdir)
+
+	def write_pkgbuild(self, name, data):
+		path = join(self.tmpdir, name)
+
+		with open(path, 'w') as f:
+			f.write(data)
+
+		return path
+
+	def test_pkgbuild_memo(self):
+		pkgbuild = self.write_pkgbuild('PKGBUILD', ParserTest.PKGBUILD + ParserTest.VERSION)
+		self.assertEqual(ParserTest.INFO, PkgbuildParser(pkgbuild).parse())
+
+		# A memorized PKGBUILD never reaches bash
+		bash, PkgbuildParser.BASH = PkgbuildParser.BASH, '/nonexistent/bash'
+
+		try:
+			PkgbuildParser._memo = None
+			info = PkgbuildParser(pkgbuild).parse()
+			self.assertEqual(ParserTest.INFO, info)
+			info['depends'].append('changed')
+			self.assertEqual(ParserTest.INFO, PkgbuildParser(pkgbuild).parse())
+
+			# Changes of the PKGBUILD invalidate the memo
+			self.write_pkgbuild('PKGBUILD', ParserTest.PKGBUILD + ParserTest.VERSION + '#\n')
+			self.assertRaises(ParserError, PkgbuildParser(pkgbuild).parse)
+		finally:
+			PkgbuildParser.BASH = bash
+
+	def test_pkgbuild_parse_all(self):
+		paths = [self.write_pkgbuild('PKGBUILD-{0}'.format(i), ParserTest.PKGBUILD.replace(
+		         'pkgname=local-repo', 'pkgname=pkg{0}'.format(i)) + ParserTest.VERSION) for i in range(20)]
+		broken = self.write_pkgbuild('PKGBUILD-broken', ParserTest.PKGBUILD + 'exit 1\n')
+		empty = self.write_pkgbuild('PKGBUILD-empty', ParserTest.PKGBUILD)
+		missing = join(self.tmpdir, 'PKGBUILD-missing')
+		infos = PkgbuildParser.parse_all(paths[:10] + [broken, empty, missing] + paths[10:])
+
+		self.assertEqual(set(paths), set(infos))
+
+		for i, path in enumerate(paths):
+			self.assertEqual('pkg{0}'.format(i), infos[path]['name'])
+			self.assertEqual(ParserTest.INFO['depends'], infos[path]['depends'])
+
+		self.assertRaises(ParserError, PkgbuildParser(broken).parse)
+		self.assertRaises(ParserError, PkgbuildParser(empty).parse)
+
+		# Everything was memorized
+		PkgbuildParser._memo = None
+		self.assertEqual(20, len(PkgbuildParser._load_memo()))
+
 	def test_pkgbuild_parser(self):
 		l, pkgbuild = mkstemp(prefix='local-repo-test-pkgbuild-')
 		self.assertRaises(ParserError, PkgbuildParser(pkgbuild).parse)
@@ -116,12 +189,7 @@ local-repo
 		with open(pkgbuild, 'w') as f:
 			f.write(ParserTest.PKGBUILD + ParserTest.VERSION)
 
-		info = {'depends': ['tar', 'pacman', 'python', 'huiii'],
-		        'version': '1.6.2',
-		        'makedepends': ['gettext'],
-		        'name': 'local-repo'}
-
-		self.assertEqual(info, PkgbuildParser(pkgbuild).parse())
+		self.assertEqual(ParserTest.INFO, PkgbuildParser(pkgbuild).parse())
 		remove(pkgbuild)
 
 	def test_pkginfo_parser(self):
@@ -133,11 +201,22 @@ local-repo
 		        'builddate': '1332727351',
 		        'version': '1.6.2-1',
 		        'packager': 'ushi <martin.kalcher@gmail.com>',
-		        'isize': '303104',
+		        'isize': 303104,
 		        'arch': 'any',
 		        'desc': 'Local repository manager'}
 
-		self.assertEqual(info, (PkginfoParser(ParserTest.PKGINFO + ParserTest.PACK).parse()))
+		lists = {'groups': [],
+		         'depends': ['tar', 'pacman', 'python'],
+		         'optdepends': [],
+		         'makedepends': [],
+		         'checkdepends': [],
+		         'conflicts': [],
+		         'provides': [],
+		         'replaces': []}
+
+		parser = PkginfoParser(ParserTest.PKGINFO + ParserTest.PACK)
+		self.assertEqual(info, parser.parse())
+		self.assertEqual(lists, parser.lists())
 
 	def test_desc_parser(self):
 		self.assertRaises(ParserError, DescParser(ParserTest.DESC).parse)
@@ -146,8 +225,8 @@ local-repo
 		        'name': 'local-repo',
 		        'version': '1.6.2-1',
 		        'desc': 'Local repository manager',
-		        'csize': '46336',
-		        'isize': '303104',
+		        'csize': 46336,
+		        'isize': 303104,
 		        'md5sum': 'somefancymd5',
 		        'sha256sum': 'somefancysha256',
 		        'pgpsig': True,
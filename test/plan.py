@@ -0,0 +1,71 @@
+# test/plan.py
+# vim:ts=4:sw=4:noexpandtab
+
+import sys
+
+from os import remove, stat
+from tempfile import mkstemp
+from unittest import TestCase, main
+
+if '..' not in sys.path:
+	sys.path.append('..')
+
+from localrepo.plan import PlanError, UpgradePlan
+
+
+class UpgradePlanTest(TestCase):
+
+	VERSIONS = [('bar', '1.0-1'), ('baz', '2:1.0-1'), ('foo', '1.0-1'), ('ignored', '1.0-1'),
+	            ('local', '1.0-1'), ('same', '1.0-2')]
+
+	INFOS = [{'name': 'foo', 'version': '1.0.1-1', 'uri': 'http://aur/foo.tar.gz'},
+	         {'name': 'baz', 'version': '1:2.0-1', 'uri': 'http://aur/baz.tar.gz'},
+	         {'name': 'bar', 'version': '1.0a-1', 'uri': 'http://aur/bar.tar.gz'},
+	         {'name': 'same', 'version': '1.0-2', 'uri': 'http://aur/same.tar.gz'},
+	         {'name': 'ignored', 'version': '2.0-1', 'uri': 'http://aur/ignored.tar.gz'},
+	         {'name': 'other', 'version': '1.0-1', 'uri': 'http://aur/other.tar.gz'}]
+
+	def setUp(self):
+		l, self.path = mkstemp(prefix='local-repo-test-plan-')
+		self.plan = UpgradePlan.create('/repo', UpgradePlanTest.VERSIONS, iter(UpgradePlanTest.INFOS),
+		                               ['ignored', 'unknown'])
+
+	def tearDown(self):
+		remove(self.path)
+
+	def test_create(self):
+		self.assertEqual([{'name': 'foo', 'old': '1.0-1', 'new': '1.0.1-1', 'uri': 'http://aur/foo.tar.gz'}],
+		                 self.plan.upgrades)
+		self.assertEqual(['bar', 'baz'], [c['name'] for c in self.plan.downgrades])
+		self.assertEqual(['local'], self.plan.missing)
+		self.assertEqual(['ignored'], self.plan.ignored)
+
+	def test_save_and_load(self):
+		self.plan.save(self.path)
+		plan = UpgradePlan.load(self.path)
+		self.assertEqual(self.plan.to_dict(), plan.to_dict())
+		self.assertEqual('/repo', plan.repo)
+
+	def test_save_mode(self):
+		remove(self.path)
+		self.plan.save(self.path)
+		self.assertEqual(0o644, stat(self.path).st_mode & 0o777)
+
+	def test_invalid(self):
+		with open(self.path, 'w') as f:
+			f.write('{"version": 1, "repo": "/repo"}')
+
+		self.assertRaises(PlanError, UpgradePlan.load, self.path)
+
+		with open(self.path, 'w') as f:
+			f.write('[')
+
+		self.assertRaises(PlanError, UpgradePlan.load, self.path)
+
+	def test_stale(self):
+		self.assertEqual([], self.plan.stale(UpgradePlanTest.VERSIONS))
+		self.assertEqual(['foo'], self.plan.stale([('foo', '1.0.1-1')]))
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,340 @@
+# test/repo.py
+# vim:ts=4:sw=4:noexpandtab
+
+import sys
+
+from hashlib import md5, sha256
+from io import BytesIO
+from os import link, listdir, mkdir, remove, stat, utime
+from os.path import isfile, islink, join
+from shutil import rmtree
+from tarfile import DIRTYPE, TarInfo, open as open_tarfile
+from tempfile import mkdtemp
+from unittest import TestCase, main
+
+if '..' not in sys.path:
+	sys.path.append('..')
+
+from localrepo.config import Config
+from localrepo.package import Package
+from localrepo.cache import Cache, CacheError
+from localrepo.repo import Database, Repo, RepoError
+
+
+class RepoTest(TestCase):
+
+	PKGINFO = '''pkgname = {0}
+pkgver = {1}
+pkgdesc = Test package {0}
+url = http://example.com/{0}
+builddate = 1332727351
+packager = Test <test@example.com>
+size = 1024
+arch = any
+license = GPL
+depend = tar
+depend = python
+'''
+
+	@staticmethod
+	def make_package(path, name, version, files=()):
+		data = RepoTest.PKGINFO.format(name, version).encode('utf8')
+		info = TarInfo('.PKGINFO')
+		info.size = len(data)
+		path = join(path, '{0}-{1}-any.pkg.tar.xz'.format(name, version))
+
+		with open_tarfile(path, 'w:xz') as pkg:
+			pkg.addfile(info, BytesIO(data))
+
+			for f in files:
+				member = TarInfo(f.rstrip('/'))
+
+				if f.endswith('/'):
+					member.type = DIRTYPE
+
+				pkg.addfile(member, None if f.endswith('/') else BytesIO())
+
+		return Package.from_file(path)
+
+	def setUp(self):
+		self.path = mkdtemp(prefix='local-repo-test-repo-')
+		Config.init('repotest')
+		Config.set('signdb', False)
+		self.repo = Repo(self.path)
+		self.db = join(self.path, 'repotest' + Repo.EXT)
+
+	def tearDown(self):
+		rmtree(self.path)
+
+	def test_database_update(self):
+		pkgs = [RepoTest.make_package(self.path, n, '1.0-1') for n in ('pkg1', 'pkg2', 'pkg3')]
+		Database(self.db).update(pkgs)
+		self.assertIs(True, islink(join(self.path, 'repotest' + Repo.LINKEXT)))
+		self.assertIs(False, isfile(join(self.path, 'repotest' + Repo.FILESEXT)))
+
+		loaded = self.repo.load_from_db()
+		self.assertEqual(['pkg1', 'pkg2', 'pkg3'], sorted(loaded))
+
+		for pkg in pkgs:
+			self.assertEqual(pkg.version, loaded[pkg.name].version)
+			self.assertEqual(pkg.path, loaded[pkg.name].path)
+			self.assertEqual(pkg.info['sha256sum'], loaded[pkg.name].info['sha256sum'])
+			self.assertEqual(pkg.info['packager'], loaded[pkg.name].info['packager'])
+
+		with open_tarfile(self.db) as db:
+			depends = db.extractfile('pkg1-1.0-1/depends').read().decode('utf8')
+
+		self.assertEqual('%DEPENDS%\ntar\npython\n\n', depends)
+
+	def test_info_sources(self):
+		pkg = RepoTest.make_package(self.path, 'pkg1', '1.0-1')
+		Database(self.db).update([pkg])
+		loaded = self.repo.load_from_db()
+		cache = join(self.path, Repo.CACHE)
+		Cache.write(cache, loaded)
+
+		self.assertNotIn('depends', pkg.info)
+		self.assertEqual(['tar', 'python'], pkg.lists['depends'])
+		self.assertEqual({}, loaded['pkg1'].lists)
+		self.assertIs(int, type(pkg.info['csize']))
+		self.assertIs(int, type(pkg.info['isize']))
+		self.assertEqual(pkg.info, loaded['pkg1'].info)
+		self.assertEqual(pkg.info, Cache(cache, self.path)['pkg1'].info)
+
+	def test_database_unsign(self):
+		sigs = [self.db + Repo.SIGEXT, join(self.path, 'repotest' + Repo.LINKEXT + Repo.SIGEXT)]
+
+		for sig in sigs:
+			open(sig, 'w').close()
+
+		Database(self.db).update([RepoTest.make_package(self.path, 'pkg1', '1.0-1')])
+		self.assertEqual([False, False], [isfile(sig) for sig in sigs])
+
+	def test_database_replace_and_remove(self):
+		pkgs = [RepoTest.make_package(self.path, n, '1.0-1') for n in ('pkg1', 'pkg2', 'pkg-3')]
+		Database(self.db).update(pkgs)
+		Database(self.db).update([RepoTest.make_package(self.path, 'pkg2', '2.0-1')], ['pkg-3'])
+
+		loaded = self.repo.load_from_db()
+		self.assertEqual(['pkg1', 'pkg2'], sorted(loaded))
+		self.assertEqual('2.0-1', loaded['pkg2'].version)
+
+		with open_tarfile(self.db) as db:
+			self.assertEqual(6, len(db.getnames()))
+
+	def test_database_files(self):
+		files = join(self.path, 'repotest' + Repo.FILESEXT)
+		open_tarfile(files, 'w:gz').close()
+		pkgs = [RepoTest.make_package(self.path, 'pkg1', '1.0-1', ['usr/', 'usr/bin/', 'usr/bin/pkg1']),
+		        RepoTest.make_package(self.path, 'pkg2', '1.0-1')]
+		Database(self.db).update(pkgs)
+		Database(self.db).update([], ['pkg2'])
+		self.assertIs(True, islink(join(self.path, 'repotest' + Repo.FILESLINKEXT)))
+
+		with open_tarfile(files) as db:
+			self.assertEqual(['pkg1-1.0-1', 'pkg1-1.0-1/depends', 'pkg1-1.0-1/desc', 'pkg1-1.0-1/files'],
+			                 sorted(db.getnames()))
+			data = db.extractfile('pkg1-1.0-1/files').read().decode('utf8')
+
+		self.assertEqual('%FILES%\nusr/\nusr/bin/\nusr/bin/pkg1\n', data)
+
+	def test_batch(self):
+		tmpdir = join(self.path, 'tmp')
+		mkdir(tmpdir)
+		pkgs = [RepoTest.make_package(tmpdir, n, '1.0-1') for n in ('pkg1', 'pkg2', 'pkg3')]
+
+		with self.repo.batch():
+			for pkg in pkgs:
+				self.repo.add(pkg)
+
+			self.repo.remove('pkg2')
+			self.assertIs(False, isfile(self.db))
+
+		self.assertEqual(['pkg1', 'pkg3'], sorted(self.repo))
+		self.assertEqual(['pkg1', 'pkg3'], sorted(self.repo.load_from_db()))
+		self.assertEqual(['pkg1', 'pkg3'], sorted(self.repo.load_from_cache()))
+		self.assertEqual(stat(self.db).st_mode, stat(join(self.path, Repo.CACHE)).st_mode)
+		self.assertIs(True, isfile(join(self.path, 'pkg1-1.0-1-any.pkg.tar.xz')))
+		self.assertIs(True, isfile(join(tmpdir, 'pkg2-1.0-1-any.pkg.tar.xz')))
+
+	def test_search(self):
+		with self.repo.batch():
+			for name in ('pkg1', 'pkg2', 'other'):
+				self.repo.add(RepoTest.make_package(self.path, name, '1.0-1'))
+
+		for i in range(2):
+			self.assertEqual(['pkg1', 'pkg2'], self.repo.search('pkg'))
+			self.assertEqual(['pkg2'], self.repo.search('desc:pkg2'))
+			self.assertEqual(['other'], self.repo.search('url:example license:GPL /^o/'))
+			self.repo.load()
+
+	def test_batch_rollback(self):
+		self.repo.add(RepoTest.make_package(self.path, 'pkg1', '1.0-1'))
+		tmpdir = join(self.path, 'tmp')
+		mkdir(tmpdir)
+		pkg = RepoTest.make_package(tmpdir, 'pkg1', '2.0-1')
+
+		try:
+			with self.repo.batch():
+				self.repo.add(pkg, force=True)
+				self.repo.add(RepoTest.make_package(tmpdir, 'pkg2', '1.0-1'))
+				raise KeyboardInterrupt()
+		except KeyboardInterrupt:
+			pass
+
+		self.assertEqual(['pkg1'], list(self.repo))
+		self.assertEqual('1.0-1', self.repo['pkg1'].version)
+		self.assertEqual('1.0-1', self.repo.load_from_db()['pkg1'].version)
+		self.assertIs(True, isfile(join(self.path, 'pkg1-1.0-1-any.pkg.tar.xz')))
+		self.assertIs(True, isfile(pkg.path))
+
+	def test_add_linked(self):
+		tmpdir = join(self.path, 'tmp')
+		mkdir(tmpdir)
+		pkg = RepoTest.make_package(tmpdir, 'pkg1', '1.0-1')
+		obj = join(self.path, 'object')
+		link(pkg.path, obj)
+		self.repo.add(pkg)
+
+		self.assertEqual(join(self.path, 'pkg1-1.0-1-any.pkg.tar.xz'), pkg.path)
+		self.assertIs(False, isfile(join(tmpdir, 'pkg1-1.0-1-any.pkg.tar.xz')))
+		self.assertNotEqual(stat(obj).st_ino, stat(pkg.path).st_ino)
+		self.assertEqual(1, stat(pkg.path).st_nlink)
+
+	def test_commit_rollback(self):
+		self.repo.add(RepoTest.make_package(self.path, 'pkg1', '1.0-1'))
+		tmpdir = join(self.path, 'tmp')
+		mkdir(tmpdir)
+		pkgs = [RepoTest.make_package(tmpdir, 'pkg1', '2.0-1'), RepoTest.make_package(tmpdir, 'pkg2', '1.0-1')]
+
+		def fail():
+			raise CacheError('Oops')
+
+		self.repo.update_cache = fail
+		open(self.db + Repo.SIGEXT, 'w').close()
+
+		with self.assertRaises(CacheError):
+			with self.repo.batch():
+				self.repo.add(pkgs[0], force=True)
+				self.repo.add(pkgs[1])
+
+		del(self.repo.update_cache)
+		self.assertEqual(['pkg1'], list(self.repo))
+		self.assertEqual({'pkg1': '1.0-1'}, dict(self.repo.versions()))
+		self.assertEqual('1.0-1', self.repo.load_from_db()['pkg1'].version)
+		self.assertEqual([join(tmpdir, f) for f in ('pkg1-2.0-1-any.pkg.tar.xz', 'pkg2-1.0-1-any.pkg.tar.xz')],
+		                 [pkg.path for pkg in pkgs])
+		self.assertEqual(['pkg1-1.0-1-any.pkg.tar.xz', 'repotest.db', 'repotest.db.tar.gz',
+		                  'repotest.db.tar.gz.sig', 'tmp'],
+		                 sorted(f for f in listdir(self.path) if not f.startswith('.')))
+		self.assertEqual([], list(self.repo.check()))
+
+	def test_commit_file_exists(self):
+		self.repo.add(RepoTest.make_package(self.path, 'pkg1', '1.0-1'))
+		tmpdir = join(self.path, 'tmp')
+		mkdir(tmpdir)
+		RepoTest.make_package(self.path, 'pkg2', '1.0-1')
+
+		with self.assertRaises(RepoError):
+			with self.repo.batch():
+				self.repo.add(RepoTest.make_package(tmpdir, 'pkg1', '2.0-1'), force=True)
+				self.repo.add(RepoTest.make_package(tmpdir, 'pkg2', '1.0-1'))
+
+		self.assertEqual('1.0-1', self.repo.load_from_db()['pkg1'].version)
+		self.assertIs(True, isfile(join(self.path, 'pkg1-1.0-1-any.pkg.tar.xz')))
+		self.assertIs(True, isfile(join(tmpdir, 'pkg1-2.0-1-any.pkg.tar.xz')))
+
+	def test_check(self):
+		for name in ('pkg1', 'pkg2', 'pkg3'):
+			self.repo.add(RepoTest.make_package(self.path, name, '1.0-1'))
+
+		self.assertEqual([], list(self.repo.check()))
+
+		with open(self.repo['pkg2'].path, 'ab') as f:
+			f.write(b'broken')
+
+		orphan = RepoTest.make_package(self.path, 'orphan', '1.0-1')
+		progress = []
+		errors = list(self.repo.check(progress=lambda i, s, t: progress.append((i, t))))
+
+		self.assertEqual([(1, 3), (2, 3), (3, 3)], progress)
+		self.assertEqual(2, len(errors))
+		self.assertIn(self.repo['pkg2'].path, errors[0])
+		self.assertIn(orphan.path, errors[1])
+
+	def test_check_missing_file(self):
+		for name in ('pkg1', 'pkg2'):
+			self.repo.add(RepoTest.make_package(self.path, name, '1.0-1'))
+
+		remove(self.repo['pkg1'].path)
+		errors = list(self.repo.check())
+		self.assertEqual(1, len(errors))
+		self.assertIn(self.repo['pkg1'].path, errors[0])
+
+	def test_check_incremental(self):
+		for name in ('pkg1', 'pkg2'):
+			self.repo.add(RepoTest.make_package(self.path, name, '1.0-1'))
+
+		self.assertEqual([], list(self.repo.check()))
+		self.assertEqual(['pkg1-1.0-1-any.pkg.tar.xz', 'pkg2-1.0-1-any.pkg.tar.xz'],
+		                 sorted(self.repo.load_fingerprints()))
+
+		path = self.repo['pkg1'].path
+		st = stat(path)
+
+		with open(path, 'r+b') as f:
+			f.seek(-1, 2)
+			f.write(b'x')
+
+		utime(path, ns=(st.st_atime_ns, st.st_mtime_ns))
+		self.assertEqual([], list(self.repo.check()))
+		self.assertEqual(1, len(list(self.repo.check(deep=True))))
+		self.assertEqual(1, len(list(self.repo.check())))
+
+	def test_check_fingerprints_unwritable(self):
+		self.repo.add(RepoTest.make_package(self.path, 'pkg1', '1.0-1'))
+		mkdir(join(self.path, Repo.CACHE + Repo.FINGERPRINTEXT))
+		self.assertEqual([], list(self.repo.check()))
+		self.assertEqual({}, self.repo.load_fingerprints())
+
+	def test_package_checksums(self):
+		pkg = RepoTest.make_package(self.path, 'pkg1', '1.0-1')
+
+		with open(pkg.path, 'rb') as f:
+			data = f.read()
+
+		self.assertEqual(md5(data).hexdigest(), pkg.info['md5sum'])
+		self.assertEqual(sha256(data).hexdigest(), pkg.info['sha256sum'])
+		self.assertEqual('Test package pkg1', pkg.info['desc'])
+		self.assertIs(True, pkg.has_valid_sha256sum)
+
+	def test_load_from_db_skips_files(self):
+		Database(self.db).update([RepoTest.make_package(self.path, 'pkg1', '1.0-1')])
+		files = ('%FILES%\n' + '\n'.join('usr/share/pkg1/{0}'.format(i) for i in range(1000))).encode('utf8')
+		read = []
+
+		with open_tarfile(self.db) as db:
+			members = [(m, db.extractfile(m).read() if m.isfile() else None) for m in db.getmembers()]
+
+		with open_tarfile(self.db, 'w:gz') as db:
+			for member, data in members:
+				db.addfile(member, None if data is None else BytesIO(data))
+
+			member = TarInfo('pkg1-1.0-1/files')
+			member.size = len(files)
+			db.addfile(member, BytesIO(files))
+
+		for member, data in Database.read(self.db, lambda m: m.name.endswith('/files')):
+			read.append((member.name, len(data)))
+
+		self.assertEqual([('pkg1-1.0-1/files', len(files))], read)
+		self.assertEqual(['pkg1'], list(self.repo.load_from_db()))
+
+	def test_database_entry_name(self):
+		self.assertEqual('pkg', Database.entry_name('pkg-1.0-1/desc'))
+		self.assertEqual('my-pkg', Database.entry_name('my-pkg-1:2.0-3/depends'))
+		self.assertEqual('my-pkg-git', Database.entry_name('my-pkg-git-20120101-1'))
+
+
+if __name__ == '__main__':
+	main()
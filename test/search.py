@@ -0,0 +1,85 @@
+# test/search.py
+# vim:ts=4:sw=4:noexpandtab
+
+import sys
+
+from os import remove
+from tempfile import mkstemp
+from unittest import TestCase, main
+
+if '..' not in sys.path:
+	sys.path.append('..')
+
+from localrepo.cache import Cache
+from localrepo.package import Package
+from localrepo.search import Index, Query, SearchError
+
+
+class SearchTest(TestCase):
+
+	INFOS = {'local-repo': {'desc': 'Local repository manager', 'url': 'https://github.com/ushis/local-repo',
+	                        'license': 'GPL', 'packager': 'ushi <ushi@porkbox.net>'},
+	         'libfoo': {'desc': 'The foo library', 'url': None, 'license': ['MIT', 'BSD'],
+	                    'packager': 'Joe <joe@example.com>'},
+	         'libfoo-git': {'desc': 'The foo library (git version)', 'url': 'https://example.com/foo',
+	                        'license': 'MIT', 'packager': 'Joe <joe@example.com>'},
+	         'repository': {'desc': None, 'url': None, 'license': None, 'packager': None},
+	         'übertool': {'desc': 'Über tool', 'url': None, 'license': 'GPL', 'packager': None}}
+
+	def setUp(self):
+		l, self.path = mkstemp(prefix='local-repo-test-search-')
+		self.packages = dict((name, Package(name, '1.0-1', '/repo/{0}.pkg.tar.xz'.format(name), dict(info)))
+		                     for name, info in SearchTest.INFOS.items())
+		Cache.write(self.path, self.packages)
+		self.indexes = [Index(self.packages), Cache(self.path, '/repo')]
+
+	def tearDown(self):
+		remove(self.path)
+
+	def search(self, q):
+		results = [Query(q).run(index) for index in self.indexes]
+		self.assertEqual(results[0], results[1])
+		return results[0]
+
+	def test_name(self):
+		self.assertEqual(['libfoo', 'libfoo-git'], self.search('foo'))
+		self.assertEqual(['local-repo', 'repository'], self.search('repo'))
+		self.assertEqual(['libfoo', 'libfoo-git'], self.search('lib*'))
+		self.assertEqual(['libfoo-git'], self.search('name:libfoo-*'))
+		self.assertEqual(['übertool'], self.search('über*'))
+		self.assertEqual(['libfoo-git', 'local-repo'], self.search('/-(git|repo)$/'))
+		self.assertEqual([], self.search('nothing*'))
+
+	def test_fields(self):
+		self.assertEqual(['libfoo', 'libfoo-git'], self.search('desc:library'))
+		self.assertEqual(['libfoo', 'libfoo-git'], self.search('desc:LIB*'))
+		self.assertEqual(['local-repo', 'übertool'], self.search('license:gpl'))
+		self.assertEqual(['libfoo'], self.search('license:bsd'))
+		self.assertEqual(['libfoo', 'libfoo-git'], self.search('packager:joe@example.com*'))
+		self.assertEqual(['libfoo-git', 'local-repo'], self.search('url:https'))
+		self.assertEqual(['libfoo-git'], self.search('desc:/\\(git/'))
+		self.assertEqual(['übertool'], self.search('desc:über'))
+		self.assertEqual([], self.search('desc:ber'))
+		self.assertEqual(['libfoo-git'], self.search('desc:git-vers*'))
+
+	def test_and(self):
+		self.assertEqual(['libfoo-git'], self.search('lib* license:mit url:example'))
+		self.assertEqual(['libfoo'], self.search('desc:foo license:/BSD/'))
+		self.assertEqual([], self.search('repo license:mit'))
+
+	def test_invalid(self):
+		for q in ('', 'foo:bar', '/(/', 'desc:*', 'desc:--', '*'):
+			self.assertRaises(SearchError, Query, q)
+
+	def test_lookups(self):
+		for index in self.indexes:
+			self.assertEqual(['libfoo', 'libfoo-git'], [index.name(i) for i in index.prefix('libf')])
+			self.assertEqual(0, len(index.prefix('zzz')))
+			self.assertEqual({0, 1}, index.tokens('license', 'mit'))
+			self.assertEqual(set(), index.tokens('license', 'mi'))
+			self.assertEqual({0, 1}, index.tokens('license', 'mi', prefix=True))
+			self.assertEqual(set(), index.tokens('url', 'zzz', prefix=True))
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,98 @@
+# test/startup.py
+# vim:ts=4:sw=4:noexpandtab
+
+import sys
+
+from io import BytesIO
+from os.path import abspath, dirname, join
+from shutil import rmtree
+from subprocess import PIPE, STDOUT, run
+from tarfile import TarInfo, open as open_tarfile
+from tempfile import mkdtemp
+from time import perf_counter
+from unittest import TestCase, main
+
+ROOT = dirname(dirname(abspath(__file__)))
+
+if ROOT not in sys.path:
+	sys.path.append(ROOT)
+
+from localrepo.package import Package
+from localrepo.repo import Database
+
+
+class StartupTest(TestCase):
+	''' Guards the startup time of read-only commands '''
+
+	#: Modules, which must not be loaded by read-only commands
+	HEAVY = ('argparse', 'asyncio', 'concurrent.futures', 'hashlib', 'http.client', 'pickle', 'shutil',
+	         'sqlite3', 'subprocess', 'tarfile', 'tempfile', 'urllib.request', 'localrepo.aur',
+	         'localrepo.build', 'localrepo.download', 'localrepo.pacman', 'localrepo.parser',
+	         'localrepo.plan')
+
+	#: Max time a read-only command may take, relative to the start of a bare python.
+	#: The banned modules are the real guard, this only catches gross regressions.
+	BUDGET = 20
+
+	#: .PKGINFO of the package in the test repo
+	PKGINFO = '''pkgname = foo
+pkgver = 1.0-1
+pkgdesc = Test package foo
+url = http://example.com/foo
+builddate = 1332727351
+packager = Test <test@example.com>
+size = 1024
+arch = any
+license = GPL
+'''
+
+	def setUp(self):
+		self.tmpdir = mkdtemp(prefix='local-repo-test-startup-')
+		data = StartupTest.PKGINFO.encode('utf8')
+		info = TarInfo('.PKGINFO')
+		info.size = len(data)
+		path = join(self.tmpdir, 'foo-1.0-1-any.pkg.tar.xz')
+
+		with open_tarfile(path, 'w:xz') as pkg:
+			pkg.addfile(info, BytesIO(data))
+
+		Database(join(self.tmpdir, 'local-repo-test-startup.db.tar.gz')).update([Package.from_file(path)])
+		self.run_python(join(ROOT, 'local-repo'), self.tmpdir)
+
+	def tearDown(self):
+		rmtree(self.tmpdir)
+
+	def run_python(self, *args):
+		''' Runs python with -X importtime and returns the output and the imported modules '''
+		res = run([sys.executable, '-X', 'importtime'] + list(args), cwd=ROOT, stdout=PIPE, stderr=STDOUT)
+		lines = res.stdout.decode('utf8').splitlines()
+		modules = set(l.split('|')[-1].strip() for l in lines if l.startswith('import time:'))
+		return [l for l in lines if not l.startswith('import time:')], modules
+
+	def test_import(self):
+		out, modules = self.run_python('-c', 'import localrepo.localrepo')
+		self.assertIn('localrepo.repo', modules)
+		self.assertEqual([], [m for m in StartupTest.HEAVY if m in modules])
+
+	def timed(self, *args):
+		''' Runs python and returns the seconds it took and the imported modules '''
+		start = perf_counter()
+		out, modules = self.run_python(*args)
+		return perf_counter() - start, modules
+
+	def test_read_only(self):
+		bare = self.timed('-c', 'pass')[0]
+
+		for args in (['-l'], ['-s', 'foo'], ['-i', 'foo'], [], ['-l', '--format', 'jsonl']):
+			seconds, modules = self.timed(join(ROOT, 'local-repo'), self.tmpdir, *args)
+			self.assertLess(seconds, StartupTest.BUDGET * bare)
+			self.assertEqual([], [m for m in StartupTest.HEAVY if m in modules])
+
+	def test_fallback(self):
+		out, modules = self.run_python(join(ROOT, 'local-repo'), self.tmpdir, '-l', '-c')
+		self.assertIn('argparse', modules)
+		self.assertIn('No errors found', ''.join(out))
+
+
+if __name__ == '__main__':
+	main()
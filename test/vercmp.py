@@ -0,0 +1,127 @@
+# test/vercmp.py
+# vim:ts=4:sw=4:noexpandtab
+
+import sys
+
+from unittest import TestCase, main
+
+if '..' not in sys.path:
+	sys.path.append('..')
+
+from localrepo.vercmp import Version, parse, vercmp
+from localrepo.package import Package
+
+
+class VercmpTest(TestCase):
+
+	#: The test table of pacman's vercmptest.sh
+	TABLE = [
+		# all similar length, no pkgrel
+		('1.5.0', '1.5.0', 0),
+		('1.5.1', '1.5.0', 1),
+
+		# mixed length
+		('1.5.1', '1.5', 1),
+
+		# with pkgrel, simple
+		('1.5.0-1', '1.5.0-1', 0),
+		('1.5.0-1', '1.5.0-2', -1),
+		('1.5.0-1', '1.5.1-1', -1),
+		('1.5.0-2', '1.5.1-1', -1),
+
+		# with pkgrel, mixed lengths
+		('1.5-1', '1.5.1-1', -1),
+		('1.5-2', '1.5.1-1', -1),
+		('1.5-2', '1.5.1-2', -1),
+
+		# mixed pkgrel inclusion
+		('1.5', '1.5-1', 0),
+		('1.5-1', '1.5', 0),
+		('1.1-1', '1.1', 0),
+		('1.0-1', '1.1', -1),
+		('1.1-1', '1.0', 1),
+
+		# alphanumeric versions
+		('1.5b-1', '1.5-1', -1),
+		('1.5b', '1.5', -1),
+		('1.5b-1', '1.5', -1),
+		('1.5b', '1.5.1', -1),
+
+		# from the manpage
+		('1.0a', '1.0alpha', -1),
+		('1.0alpha', '1.0b', -1),
+		('1.0b', '1.0beta', -1),
+		('1.0beta', '1.0rc', -1),
+		('1.0rc', '1.0', -1),
+
+		# going crazy? alpha-dotted versions
+		('1.5.a', '1.5', 1),
+		('1.5.b', '1.5.a', 1),
+		('1.5.1', '1.5.b', 1),
+
+		# alpha dots and dashes
+		('1.5.b-1', '1.5.b', 0),
+		('1.5-1', '1.5.b', -1),
+
+		# same/similar content, differing separators
+		('2.0', '2_0', 0),
+		('2.0_a', '2_0.a', 0),
+		('2.0a', '2.0.a', -1),
+		('2___a', '2_a', 1),
+
+		# epoch included version comparisons
+		('0:1.0', '0:1.0', 0),
+		('0:1.0', '0:1.1', -1),
+		('1:1.0', '0:1.0', 1),
+		('1:1.0', '0:1.1', 1),
+		('1:1.0', '2:1.1', -1),
+
+		# epoch + sometimes present pkgrel
+		('1:1.0', '0:1.0-1', 1),
+		('1:1.0-1', '0:1.1-1', 1),
+
+		# epoch included on one version
+		('0:1.0', '1.0', 0),
+		('0:1.0', '1.1', -1),
+		('0:1.1', '1.0', 1),
+		('1:1.0', '1.0', 1),
+		('1:1.0', '1.1', 1),
+		('1:1.1', '1.1', 1),
+	]
+
+	def test_table(self):
+		for a, b, expected in VercmpTest.TABLE:
+			self.assertEqual(expected, vercmp(a, b), '{0} {1}'.format(a, b))
+			self.assertEqual(-expected, vercmp(b, a), '{0} {1}'.format(b, a))
+
+	def test_more(self):
+		for a, b, expected in (('1:1.0-1', '2.0-1', 1), ('1.0', '1.0.', -1), ('1.01', '1.1', 0),
+		                       ('1.0', '1.0a', 1), ('r100.abc-1', 'r99.def-1', 1), ('1.0.', '1.0_', 0),
+		                       ('20120101', '1.0', 1), (':1.0', '1.0', 0), ('', '1.0', -1)):
+			self.assertEqual(expected, vercmp(a, b), '{0} {1}'.format(a, b))
+			self.assertEqual(-expected, vercmp(b, a), '{0} {1}'.format(b, a))
+
+	def test_parse(self):
+		self.assertEqual(('0', '1.0', '1'), parse('1.0-1'))
+		self.assertEqual(('2', '1.0', '3'), parse('2:1.0-3'))
+		self.assertEqual(('0', '1.0', None), parse(':1.0'))
+		self.assertEqual(('0', '1.0-beta', '2'), parse('1.0-beta-2'))
+		self.assertEqual(('0', 'a:1.0', None), parse('a:1.0'))
+
+	def test_version(self):
+		versions = ['1.0rc-1', '1:0.1-1', '1.0-2', '0.9-1', '1.0.1-1', '1.0-1']
+		self.assertEqual(['0.9-1', '1.0rc-1', '1.0-1', '1.0-2', '1.0.1-1', '1:0.1-1'],
+		                 [str(v) for v in sorted(Version(v) for v in versions)])
+		self.assertTrue(Version('1.0') == '1.0-1')
+		self.assertTrue(Version('1.0') < Version('1:0.1'))
+		self.assertRaises(TypeError, hash, Version('1.0'))
+
+	def test_package(self):
+		pkg = Package('foo', '1:1.0-1', '/repo/foo-1:1.0-1-any.pkg.tar.xz', {})
+		self.assertFalse(pkg.has_smaller_version_than('2.0-1'))
+		self.assertTrue(pkg.has_smaller_version_than('1:1.0-2'))
+		self.assertFalse(pkg.has_smaller_version_than('1:1.0rc-2'))
+
+
+if __name__ == '__main__':
+	main()